@@ -1,7 +1,13 @@
 from md2paper import GraduationPaper,TranslationPaper
-from md2paper.md2paper import SRC_ROOT
+from md2paper.md2paper import SRC_ROOT, FormulaCache
+from md2paper.md_paper import use_pandoc_server, ChapterCache, PaperError
+from md2paper.watch import FileWatcher
+from md2paper.batch import BatchTask, BatchSettings, find_sources, run_batch, format_summary
 import argparse, logging
+import re
 import os
+import sys
+import time
 
 """
 usage: 
@@ -29,7 +35,33 @@ parser = argparse.ArgumentParser(description="usage: python main.py [-g <paper.m
 parser.add_argument('-g','--grad', type=str, help='指定生成毕设论文的md文件名',required=False)
 parser.add_argument('-t','--trans', type=str, help='指定生成英文论文翻译的md文件名',required=False)
 parser.add_argument('-l','--level',type=str,choices=['info','debug','warning'],required=False,help='指定logging level')
+parser.add_argument('-b','--build',action='store_true',help='保留模板样式与封面，清空正文后从头生成，不在模板原有内容中查找、删除')
+parser.add_argument('--no-formula-cache',action='store_true',help='不读写公式转换结果的磁盘缓存')
+parser.add_argument('--clear-formula-cache',action='store_true',help='生成前清空公式转换结果的磁盘缓存（包括按章缓存的编译结果）')
+parser.add_argument('--no-chapter-cache',action='store_true',help='不读写按章缓存的解析、编译结果')
+parser.add_argument('--pandoc-server',type=str,required=False,metavar='URL',help='使用已启动的pandoc server转换公式，如 http://localhost:3030，不可用时改用内置的XSLT')
+parser.add_argument('-j','--jobs',type=int,default=1,metavar='N',help='并行转换公式的进程数（--batch时为并行转换论文的进程数），0表示使用全部CPU核心')
+parser.add_argument('--emit-ir',nargs='?',const='json',choices=['json','gz'],help='编译后保存中间表示到<name>.ir.json（gz为gzip压缩的<name>.ir.json.gz），不生成docx')
+parser.add_argument('--from-ir',action='store_true',help='-g/-t指定的是--emit-ir保存的中间表示，直接生成docx')
+parser.add_argument('-i','--incremental',action='store_true',help='在上次生成的docx中只重新生成改动过的章，清单保存在<name>.docx.manifest.json')
+parser.add_argument('-w','--watch',action='store_true',help='生成后继续监视md文件及其引用的图片、BibTeX文件，改动后自动增量地重新生成，Ctrl+C退出')
+parser.add_argument('--batch',action='store_true',help='批量转换：-g/-t指定的是目录（其中所有的md文件）或每行一个md文件名的列表文件，最后打印各篇的结果')
 args = vars(parser.parse_args())
+build = args.pop('build')
+jobs = args.pop('jobs') or os.cpu_count() or 1
+emit_ir = args.pop('emit_ir')
+from_ir = args.pop('from_ir')
+watch = args.pop('watch')
+batch = args.pop('batch')
+incremental = args.pop('incremental') or watch
+if batch:
+    for flag, value in [('--emit-ir', emit_ir), ('--from-ir', from_ir), ('--watch', watch)]:
+        if value: parser.error(f"--batch cannot be combined with {flag}")
+if args.pop('clear_formula_cache'): FormulaCache.clear(); ChapterCache.clear()
+if args.pop('no_chapter_cache'): ChapterCache.enabled = False
+if args.pop('no_formula_cache'): FormulaCache.enabled = False
+pandoc_server = args.pop('pandoc_server')
+if pandoc_server and not batch: use_pandoc_server(pandoc_server)
 if sum([1 if not args[i] else 0 for i in args])==len(args): logging.warning(parser.description)
 
 if args['level'] != None:
@@ -38,14 +70,73 @@ if args['level'] != None:
 else:
     logging.getLogger().setLevel(logging.WARNING)
 
-for arg in args:
-    md_fname = args[arg]
-    if not md_fname: continue
-    if not (len(md_fname) > 3 and md_fname[-3:] == ".md"): raise ValueError(f"invalid md filename:{md_fname}")
-    logging.info(f"generating {arg} content in docx: {os.path.join(os.getcwd(),md_fname[:-3])}.docx")
+def generate(arg, md_fname):
     paper = options[arg]['paper_class']()
-    paper.load_md(md_fname)
-    paper.load_contents()
-    paper.compile()
-    paper.render(options[arg]['paper_template_path'], f"{md_fname[:-3]}.docx")
-print('done')
\ No newline at end of file
+    if from_ir:
+        name = re.sub(r"\.ir\.json(\.gz)?$", "", md_fname)
+        if name == md_fname: raise ValueError(f"invalid ir filename:{md_fname}")
+        paper.load_ir(md_fname)
+    else:
+        if not (len(md_fname) > 3 and md_fname[-3:] == ".md"): raise ValueError(f"invalid md filename:{md_fname}")
+        name = md_fname[:-3]
+        paper.load_md(md_fname)
+        paper.load_contents()
+        paper.compile(jobs)
+        if emit_ir:
+            ir_fname = f"{name}.ir.json" + (".gz" if emit_ir == 'gz' else "")
+            logging.info(f"saving {arg} intermediate representation: {os.path.join(os.getcwd(),ir_fname)}")
+            paper.save_ir(ir_fname)
+            return paper
+    logging.info(f"generating {arg} content in docx: {os.path.join(os.getcwd(),name)}.docx")
+    paper.render(options[arg]['paper_template_path'], f"{name}.docx", build=build, incremental=incremental)
+    return paper
+
+# 监视模式下生成失败不退出，返回应监视的文件，失败时沿用上次的文件
+def watch_generate(arg, md_fname, sources):
+    start = time.perf_counter()
+    try:
+        paper = generate(arg, md_fname)
+    except PaperError:  # 已经报告过
+        logging.error(f"failed to generate {md_fname}")
+        return sources or [md_fname]
+    except Exception as e:
+        logging.error(f"failed to generate {md_fname}: {e!r}")
+        return sources or [md_fname]
+    print(f"{md_fname} done in {time.perf_counter() - start:.2f}s")
+    return paper.get_sources()
+
+papers = {arg: args[arg] for arg in ['grad', 'trans'] if args[arg]}
+if batch:
+    tasks = [BatchTask(options[arg]['paper_class'], options[arg]['paper_template_path'], md_fname)
+             for arg, path in papers.items() for md_fname in find_sources(path)]
+    settings = BatchSettings(logging.getLogger().level, build, incremental,
+                             FormulaCache.enabled, ChapterCache.enabled, pandoc_server)
+    start = time.perf_counter()
+    results = []
+    for result in run_batch(tasks, settings, jobs):
+        print(f"[{len(results) + 1}/{len(tasks)}] {'ok' if result.ok else 'FAILED'} {result.md_path}")
+        results.append(result)
+    print(format_summary(results, time.perf_counter() - start))
+    if not all(result.ok for result in results): sys.exit(1)
+elif not watch:
+    try:
+        for arg, md_fname in papers.items():
+            generate(arg, md_fname)
+    except PaperError:  # 已经报告过
+        sys.exit(-1)
+    print('done')
+else:
+    # 进程保持运行，已导入的模块、处理好的模板、编译好的XSLT和解析过的BibTeX都可以复用
+    sources = {arg: watch_generate(arg, md_fname, None) for arg, md_fname in papers.items()}
+    watcher = FileWatcher()
+    watcher.set_files([i for files in sources.values() for i in files])
+    print('watching for changes, press Ctrl+C to stop')
+    try:
+        while True:
+            changed = watcher.wait()
+            for arg, md_fname in papers.items():
+                if any(i in sources[arg] for i in changed):
+                    sources[arg] = watch_generate(arg, md_fname, sources[arg])
+            watcher.set_files([i for files in sources.values() for i in files])
+    except KeyboardInterrupt:
+        pass
\ No newline at end of file
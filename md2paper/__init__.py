@@ -1,2 +1,3 @@
 from md2paper.md_graduation import GraduationPaper
 from md2paper.md_translation import TranslationPaper
+from md2paper.md_paper import Diagnostic, PaperError
@@ -0,0 +1,156 @@
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Tuple, Type
+from md2paper.md2paper import DocContext, FormulaCache
+from md2paper.md_paper import Paper, PaperError, ChapterCache, use_pandoc_server
+
+
+# 批量转换
+# 在进程池中逐篇转换，每个工作进程只加载一次模板；
+# 一篇论文出错只记录在结果中，不影响其他论文
+
+
+class BatchTask:
+    def __init__(self, paper_class: Type[Paper], template: str, md_path: str) -> None:
+        self.paper_class = paper_class
+        self.template = template
+        self.md_path = md_path
+
+
+class BatchResult:
+    def __init__(self, md_path: str, ok: bool, seconds: float,
+                 warnings: int = 0, error: str = "") -> None:
+        self.md_path = md_path
+        self.ok = ok
+        self.seconds = seconds
+        self.warnings = warnings
+        self.error = error
+
+
+class BatchSettings:
+    # 传给工作进程的设置，spawn方式启动的进程不会继承主进程中修改过的状态
+    def __init__(self, level: int = logging.WARNING, build: bool = False,
+                 incremental: bool = False, formula_cache: bool = True,
+                 chapter_cache: bool = True, pandoc_server: str = None) -> None:
+        self.level = level
+        self.build = build
+        self.incremental = incremental
+        self.formula_cache = formula_cache
+        self.chapter_cache = chapter_cache
+        self.pandoc_server = pandoc_server
+
+
+# path是目录时返回其中所有的md文件，否则是每行一个md文件名的列表文件，
+# 相对路径相对于列表文件所在目录，空行和#开头的行被忽略
+def find_sources(path: str) -> List[str]:
+    if os.path.isdir(path):
+        sources = []
+        for root, dirs, files in os.walk(path):
+            dirs[:] = sorted(i for i in dirs if not i.startswith("."))
+            sources += [os.path.join(root, i) for i in sorted(files)
+                        if i.endswith(".md")]
+        return sources
+    with open(path, "r", encoding="utf-8") as f:
+        lines = [line.strip() for line in f]
+    base_dir = os.path.dirname(path)
+    return [os.path.join(base_dir, line) for line in lines
+            if line and not line.startswith("#")]
+
+
+class _LogCounter(logging.Handler):
+    # 统计一篇论文转换中的警告数，错误由PaperError给出
+    def __init__(self) -> None:
+        super().__init__(logging.WARNING)
+        self.warnings = 0
+
+    def emit(self, record: logging.LogRecord):
+        if record.levelno < logging.ERROR:
+            self.warnings += 1
+
+
+_settings = BatchSettings()  # 当前进程的设置，由_init_worker设置
+
+
+def _init_worker(settings: BatchSettings, templates: List[Tuple[str, type]]):
+    global _settings
+    _settings = settings
+    logging.basicConfig()
+    logging.getLogger().setLevel(settings.level)
+    FormulaCache.enabled = settings.formula_cache
+    ChapterCache.enabled = settings.chapter_cache
+    if settings.pandoc_server:
+        use_pandoc_server(settings.pandoc_server)
+    # 模板骨架缓存在进程中，之后的各篇论文直接复用
+    for template, paper_class in templates:
+        try:
+            paper_class.load_template(DocContext(), template, settings.build)
+        except Exception as e:
+            logging.warning(f"failed to load template {template}: {e!r}")
+
+
+def convert(task: BatchTask) -> BatchResult:
+    start = time.perf_counter()
+    counter = _LogCounter()
+    logging.getLogger().addHandler(counter)
+    try:
+        if not task.md_path.endswith(".md"):
+            raise ValueError(f"invalid md filename:{task.md_path}")
+        paper = task.paper_class()
+        paper.load_md(task.md_path)
+        paper.load_contents()
+        paper.compile()
+        paper.render(task.template, task.md_path[:-3] + ".docx",
+                     build=_settings.build, incremental=_settings.incremental)
+    except PaperError as e:
+        return BatchResult(task.md_path, False, time.perf_counter() - start,
+                           counter.warnings, str(e))
+    except Exception as e:  # 意外的错误
+        return BatchResult(task.md_path, False, time.perf_counter() - start,
+                           counter.warnings, repr(e))
+    finally:
+        logging.getLogger().removeHandler(counter)
+    return BatchResult(task.md_path, True, time.perf_counter() - start,
+                       counter.warnings)
+
+
+# 按完成顺序逐个返回结果，jobs为1时在当前进程中依次转换
+def run_batch(tasks: List[BatchTask], settings: BatchSettings, jobs: int = 1):
+    templates = []
+    for task in tasks:
+        template = (task.template, task.paper_class)
+        if template not in templates:
+            templates.append(template)
+
+    if jobs <= 1:
+        _init_worker(settings, templates)
+        for task in tasks:
+            yield convert(task)
+        return
+
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                             initargs=(settings, templates)) as executor:
+        futures = {executor.submit(convert, task): task for task in tasks}
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except BrokenProcessPool as e:
+                # 工作进程异常退出时，还没完成的论文都会失败
+                yield BatchResult(futures[future].md_path, False, 0,
+                                  error=f"worker crashed: {e}")
+
+
+def format_summary(results: List[BatchResult], wall_seconds: float) -> str:
+    lines = []
+    for result in sorted(results, key=lambda x: x.md_path):
+        status = "ok" if result.ok else "FAILED"
+        line = f"{status:<7}{result.seconds:7.2f}s {result.warnings:4d} warnings  {result.md_path}"
+        if not result.ok:
+            line += ": " + (result.error.splitlines() or [""])[0]
+        lines.append(line)
+    failed = len([i for i in results if not i.ok])
+    lines.append(f"{len(results) - failed} ok, {failed} failed, "
+                 f"{sum(i.seconds for i in results):.2f}s total, {wall_seconds:.2f}s wall")
+    return "\n".join(lines)
@@ -5,6 +5,19 @@ from typing import Dict
 import datetime
 from docx.enum.text import WD_LINE_SPACING
 
+# 毕业设计模板中各部分的示例内容，与各Component.render_template删除的范围相同，
+# 渲染时由TemplateSkeleton预先删去（英文摘要按位置删除，不在其中）
+PLACEHOLDERS: List[Placeholder] = [
+    ("摘    要", "Heading 1", 1, "关键词：", True),
+    ("引    言", "Heading 1", 2, "正文格式说明", False),
+    ("1  正文格式说明", "", 3, "结    论（设计类为设计总结", False),
+    ("结    论（设计类为设计总结）", "", 3, "参 考 文 献", False),
+    ("参 考 文 献", "", 1, "附录A", False),
+    ("附录A", "Heading 1", 1, "修改记录", False),
+    ("修改记录", "Heading 1", 0, "致    谢", False),
+    ("致    谢", "", 0, "/\\,.;'", False),
+]
+
 
 class Metadata(Component):
     school: str = None
@@ -88,9 +101,10 @@ class Metadata(Component):
             (blank_length-self.__get_data_len(data)-head_length)
         return content
 
-    def render_template(self):
+    def render_template(self, ctx: DocContext = None):
+        ctx = ctx or DM.get_context()
         # 首先设置header
-        for section in DM.get_doc().sections:
+        for section in ctx.get_doc().sections:
             p = section.header.paragraphs[0]
             if len(p.runs) == 0:
                 continue
@@ -104,22 +118,28 @@ class Metadata(Component):
             text = mapping[field].get('text')
             if not text:
                 continue
-            offset = DM.get_anchor_position(field) - 1
-            DM.get_doc().paragraphs[offset].runs[0].text = text
+            offset = ctx.get_anchor_position(field) - 1
+            ctx.get_paragraph(offset).runs[0].text = text
 
             # 这里如果标题太长导致折行，则额外删去一行，以防止封面溢出到第二页
             logging.debug(
                 f"metadata:text len = {self.__get_data_len(text)}, max len ={mapping[field]['max_len']}")
             if self.__get_data_len(text) >= mapping[field]['max_len']:
-                DM.delete_paragraph_by_index(offset + 5)
+                ctx.delete_paragraph_by_index(offset + 5)
 
         mapping = self.get_line_mapping()
         for field in mapping:
             if not mapping[field]:
                 continue
-            offset = DM.get_anchor_position(field) - 1
+            offset = ctx.get_anchor_position(field) - 1
             data = self.__fill_blank(self.BLANK_LENGTH, mapping[field])
-            DM.get_doc().paragraphs[offset].runs[-1].text = data
+            ctx.get_paragraph(offset).runs[-1].text = data
+
+    # 封面在build模式中被保留，仍然直接填充
+    def build_template(self, ctx: DocContext = None) -> Cursor:
+        ctx = ctx or DM.get_context()
+        self.render_template(ctx)
+        return ctx.get_end_cursor()
 
 
 class Abstract(Component):
@@ -146,54 +166,63 @@ class Abstract(Component):
         self.__text_en.add_content(content_list=Text.read(en))
         self.__text_zh_CN.add_content(content_list=Text.read(zh_CN))
 
-    def render_template(self) -> int:
+    def render_template(self, ctx: DocContext = None) -> int:
+        ctx = ctx or DM.get_context()
         # 64开始是摘要正文
         #abs_cn_start = 64
         #abs_cn_end = self.__text_zh_CN.render_block(abs_cn_start)
 
-        offset = DM.get_anchor_position(
+        offset = ctx.get_anchor_position(
             "摘    要", anchor_style_name="Heading 1")
-        offset = self.__text_zh_CN.render_block(offset)
+        offset = self.__text_zh_CN.render_block(ctx.get_cursor(offset)).offset
 
-        while not DM.get_paragraph(offset+1).text.startswith("关键词："):
-            DM.delete_paragraph_by_index(offset)
+        ctx.delete_paragraphs_until(offset, "关键词：", keep=1, startswith=True)
 
         # cn kw
         offset = offset + 1
-        DM.get_paragraph(offset).runs[1].text = self.__keyword_zh_CN
+        ctx.get_paragraph(offset).runs[1].text = self.__keyword_zh_CN
 
         # en start
         offset = offset+4
-        DM.get_paragraph(offset).runs[0].text = self.__title_en
+        ctx.get_paragraph(offset).runs[0].text = self.__title_en
 
         offset = offset + 3
-        offset = self.__text_en.render_block(offset)
+        offset = self.__text_en.render_block(ctx.get_cursor(offset)).offset
 
         # https://stackoverflow.com/questions/61335992/how-can-i-use-python-to-delete-certain-paragraphs-in-docx-document
-        while not DM.get_paragraph(offset+1).text.startswith("Key Words："):
-            DM.delete_paragraph_by_index(offset)
+        ctx.delete_paragraphs_until(
+            offset, "Key Words：", keep=1, startswith=True)
 
         # en kw
         offset = offset + 1
         # https://github.com/python-openxml/python-docx/issues/740
-        delete_num = len(DM.get_doc().paragraphs[offset].runs) - 4
-        for run in reversed(list(DM.get_doc().paragraphs[offset].runs)):
-            DM.get_paragraph(offset)._p.remove(run._r)
+        delete_num = len(ctx.get_paragraph(offset).runs) - 4
+        for run in reversed(list(ctx.get_paragraph(offset).runs)):
+            ctx.get_paragraph(offset)._p.remove(run._r)
             delete_num -= 1
             if delete_num < 1:
                 break
 
-        DM.get_paragraph(offset).runs[3].text = self.__keyword_en
+        ctx.get_paragraph(offset).runs[3].text = self.__keyword_en
         return offset+1
 
+    # 摘要在build模式中被保留，仍然直接填充
+    def build_template(self, ctx: DocContext = None) -> Cursor:
+        ctx = ctx or DM.get_context()
+        self.render_template(ctx)
+        return ctx.get_end_cursor()
+
 
 class Introduction(Component):
-    def render_template(self) -> int:
+    def render_template(self, ctx: DocContext = None) -> int:
         anchor_text = "引    言"
         incr_next = 2
         incr_kw = "正文格式说明"
         anchor_style_name = "Heading 1"
-        return super().render_template(anchor_text, incr_next, incr_kw, anchor_style_name=anchor_style_name)
+        return super().render_template(anchor_text, incr_next, incr_kw, anchor_style_name=anchor_style_name, ctx=ctx)
+
+    def build_template(self, ctx: DocContext = None) -> Cursor:
+        return super().build_template("引    言", anchor_style_name="Heading 1", ctx=ctx)
 
 
 class MainContent(Component):  # 正文
@@ -264,31 +293,42 @@ class MainContent(Component):  # 正文
         return section.add_sub_block(new_subsection)
 
     # 由于无法定位正文，需要先生成引言，再用引言返回的offset
-    def render_template(self) -> int:
+    def render_template(self, ctx: DocContext = None) -> int:
+        ctx = ctx or DM.get_context()
         anchor_text = "1  正文格式说明"
         incr_next = 3
         incr_kw = "结    论（设计类为设计总结"
         # 此处没有覆盖原有内容，因此还需要删去原有的大标题 1 正文格式……
-        offset = super().render_template(anchor_text, incr_next, incr_kw)
+        offset = super().render_template(anchor_text, incr_next, incr_kw, ctx=ctx)
 
         line_delete_count = 1
-        pos = DM.get_anchor_position(anchor_text) - 1
+        pos = ctx.get_anchor_position(anchor_text) - 1
         for i in range(line_delete_count):
-            DM.delete_paragraph_by_index(pos)
+            ctx.delete_paragraph_by_index(pos)
         return offset - line_delete_count
 
 
 class Conclusion(Component):
-    def render_template(self, override_title: str = None) -> int:
+    def render_template(self, override_title: str = None, ctx: DocContext = None) -> int:
+        ctx = ctx or DM.get_context()
         ANCHOR = "结    论（设计类为设计总结）"
         incr_next = 3
         incr_kw = "参 考 文 献"
-        new_offset = super().render_template(ANCHOR, incr_next, incr_kw)
+        new_offset = super().render_template(ANCHOR, incr_next, incr_kw, ctx=ctx)
         if override_title:
-            title_offset = DM.get_anchor_position(ANCHOR) - 1
-            DM.get_doc().paragraphs[title_offset].runs[1].text = override_title
+            title_offset = ctx.get_anchor_position(ANCHOR) - 1
+            ctx.get_paragraph(title_offset).runs[1].text = override_title
         return new_offset
 
+    def build_template(self, override_title: str = None, ctx: DocContext = None) -> Cursor:
+        ctx = ctx or DM.get_context()
+        ANCHOR = "结    论（设计类为设计总结）"
+        title_offset = ctx.paragraph_count()
+        cursor = super().build_template(ANCHOR, ctx=ctx)
+        if override_title:
+            ctx.get_paragraph(title_offset).runs[1].text = override_title
+        return cursor
+
 
 class Appendixes(Component):  # 附录abcdefg, 是一种特殊的正文
     def __init__(self) -> None:
@@ -303,50 +343,69 @@ class Appendixes(Component):  # 附录abcdefg, 是一种特殊的正文
         self.get_internal_text().add_sub_block(new_appendix)
         return new_appendix
 
-    def render_template(self) -> int:
+    def render_template(self, ctx: DocContext = None) -> int:
+        ctx = ctx or DM.get_context()
         anchor_text = "附录A"
         anchor_style_name = "Heading 1"
         incr_next = 1
         incr_kw = "修改记录"
-        offset = super().render_template(anchor_text, incr_next, incr_kw, anchor_style_name)
+        offset = super().render_template(anchor_text, incr_next, incr_kw, anchor_style_name, ctx=ctx)
         # 此处没有覆盖原有内容，因此还需要删去原有的附录a那一页的3段
 
         line_delete_count = 1
-        pos = DM.get_anchor_position(anchor_text=anchor_text)-1
+        pos = ctx.get_anchor_position(anchor_text=anchor_text)-1
         for i in range(line_delete_count):
-            DM.delete_paragraph_by_index(pos)
+            ctx.delete_paragraph_by_index(pos)
         return offset - line_delete_count
 
 
 class ChangeRecord(Component):  # 修改记录
-    def render_template(self) -> int:
+    def render_template(self, ctx: DocContext = None) -> int:
         ANCHOR = "修改记录"
         ANCHOR_STYLE = "Heading 1"
         incr_next = 0
         incr_kw = "致    谢"
-        return super().render_template(ANCHOR, incr_next, incr_kw, anchor_style_name=ANCHOR_STYLE)
+        return super().render_template(ANCHOR, incr_next, incr_kw, anchor_style_name=ANCHOR_STYLE, ctx=ctx)
+
+    def build_template(self, ctx: DocContext = None) -> Cursor:
+        return super().build_template("修改记录", anchor_style_name="Heading 1", ctx=ctx)
 
 
 class Acknowledgments(Component):  # 致谢
-    def render_template(self) -> int:
+    def render_template(self, ctx: DocContext = None) -> int:
         ANCHOR = "致    谢"
         incr_next = 0
 
         # hack: 致谢已经到论文末尾，因此用无法匹配上的字符串直接让他删到最后一行
         incr_kw = "/\,.;'"
-        return super().render_template(ANCHOR, incr_next, incr_kw)
+        return super().render_template(ANCHOR, incr_next, incr_kw, ctx=ctx)
+
+    def build_template(self, ctx: DocContext = None) -> Cursor:
+        return super().build_template("致    谢", ctx=ctx)
 
 
 class References(Component):  # 参考文献
-    def render_template(self) -> int:
+    def render_template(self, ctx: DocContext = None) -> int:
+        ctx = ctx or DM.get_context()
         ANCHOR = "参 考 文 献"
         incr_next = 1
         incr_kw = "附录A"
-        offset_start = DM.get_anchor_position(ANCHOR)
-        offset_end = super().render_template(ANCHOR, incr_next, incr_kw) - incr_next+1
-        _style = DM.get_doc().styles['参考文献正文']
+        offset_start = ctx.get_anchor_position(ANCHOR)
+        offset_end = super().render_template(ANCHOR, incr_next, incr_kw, ctx=ctx) - incr_next+1
+        self.__format_items(ctx, offset_start, offset_end)
+        return offset_end
+
+    def build_template(self, ctx: DocContext = None) -> Cursor:
+        ctx = ctx or DM.get_context()
+        # 标题之后的段落均为文献条目
+        offset_start = ctx.paragraph_count() + 1
+        cursor = super().build_template("参 考 文 献", ctx=ctx)
+        self.__format_items(ctx, offset_start, cursor.offset)
+        return cursor
+
+    def __format_items(self, ctx: DocContext, offset_start: int, offset_end: int):
+        _style = ctx.get_doc().styles['参考文献正文']
         for i in range(offset_start, offset_end):
-            _p = DM.get_doc().paragraphs[i]
+            _p = ctx.get_paragraph(i)
             _p.style = _style
             _p.paragraph_format.first_line_indent = Cm(-0.82)
-        return offset_end
@@ -55,54 +55,65 @@ class TranslationAbstract(Component):
     def add_keywords(self, keywords: List[str]):
         self.keywords += keywords
 
-    def render_template(self) -> int:
-        new_offset = DM.get_anchor_position(anchor_text="翻译外文的中文题目") - 1
-        DM.get_paragraph(new_offset).runs[0].text = self.title_zh_CN
-        for run in DM.get_paragraph(new_offset).runs[1:]:
+    def render_template(self, ctx: DocContext = None) -> int:
+        ctx = ctx or DM.get_context()
+        new_offset = self.__render_abstract(ctx)
+
+        # hack: 最后给正文预留锚点
+        anchor_text = "1  正文格式说明"
+        p = ctx.insert_paragraph_before(new_offset)
+        p.text = anchor_text
+        new_offset += 1
+        p = ctx.add_paragraph()
+        p = ctx.add_paragraph()
+        p = ctx.add_paragraph()
+        p.text = "结    论（设计类为设计总结"
+
+        new_offset += 4
+        # 后面删完
+        ctx.delete_paragraphs(new_offset)
+        return new_offset
+
+    # build模式中模板在关键词之后已被清空，正文直接追加到末尾
+    def build_template(self, ctx: DocContext = None) -> Cursor:
+        ctx = ctx or DM.get_context()
+        self.__render_abstract(ctx)
+        return ctx.get_end_cursor()
+
+    # 填充标题、作者等信息和摘要，返回关键词之后的offset
+    def __render_abstract(self, ctx: DocContext) -> int:
+        new_offset = ctx.get_anchor_position(anchor_text="翻译外文的中文题目") - 1
+        ctx.get_paragraph(new_offset).runs[0].text = self.title_zh_CN
+        for run in ctx.get_paragraph(new_offset).runs[1:]:
             run.text = ""
         new_offset += 1
 
-        DM.get_paragraph(new_offset).runs[0].text = self.author_en
-        for run in DM.get_paragraph(new_offset).runs[1:]:
+        ctx.get_paragraph(new_offset).runs[0].text = self.author_en
+        for run in ctx.get_paragraph(new_offset).runs[1:]:
             run.text = ""
         new_offset += 1
 
-        DM.get_paragraph(new_offset).runs[0].text = self.work_place
-        for run in DM.get_paragraph(new_offset).runs[1:]:
+        ctx.get_paragraph(new_offset).runs[0].text = self.work_place
+        for run in ctx.get_paragraph(new_offset).runs[1:]:
             run.text = ""
         new_offset += 1
 
         abstract_start = "摘要："
-        DM.get_paragraph(new_offset).runs[0].text = abstract_start
+        ctx.get_paragraph(new_offset).runs[0].text = abstract_start
         new_offset += 1
 
         incr_kw = "关键词：(黑体、小四、加粗)"
         new_offset = super().render_template(
-            anchor_text=abstract_start, incr_kw=incr_kw, incr_next=0)
-        DM.get_paragraph(
+            anchor_text=abstract_start, incr_kw=incr_kw, incr_next=0, ctx=ctx)
+        ctx.get_paragraph(
             new_offset).runs[0].text = f"关键词：{'；'.join(self.keywords)}"
         new_offset += 1
-
-        # hack: 最后给正文预留锚点
-        anchor_text = "1  正文格式说明"
-        p = DM.get_paragraph(new_offset).insert_paragraph_before()
-        p.text = anchor_text
-        new_offset += 1
-        p = DM.get_doc().add_paragraph()
-        p = DM.get_doc().add_paragraph()
-        p = DM.get_doc().add_paragraph()
-        p.text = "结    论（设计类为设计总结"
-
-        new_offset += 4
-        # 后面删完
-        while new_offset != len(DM.get_doc().paragraphs):
-            DM.delete_paragraph_by_index(new_offset)
         return new_offset
 
 
 class TranslationMainContent(MainContent):
-    def render_template(self) -> int:
-        new_offset = super().render_template()
-        while new_offset != len(DM.get_doc().paragraphs):
-            DM.delete_paragraph_by_index(new_offset)
+    def render_template(self, ctx: DocContext = None) -> int:
+        ctx = ctx or DM.get_context()
+        new_offset = super().render_template(ctx)
+        ctx.delete_paragraphs(new_offset)
         return new_offset
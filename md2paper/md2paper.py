@@ -1,125 +1,834 @@
 from __future__ import annotations
 from io import BytesIO, StringIO
-from typing import Union, List, Tuple
+from copy import deepcopy
+from functools import lru_cache
+from typing import Dict, Union, List, Tuple
+from contextvars import ContextVar
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import hashlib
+import importlib.metadata
+import json
+import tempfile
 import docx
 from docx.text.paragraph import Paragraph
 from docx.shared import Inches, Cm
 from docx.enum.text import WD_BREAK, WD_ALIGN_PARAGRAPH
 from docx.enum.table import WD_ALIGN_VERTICAL, WD_TABLE_ALIGNMENT
 import lxml
-from docx.oxml import OxmlElement
+from docx.oxml import OxmlElement, parse_xml
 from docx.oxml.ns import qn
 from lxml import etree
 import latex2mathml.converter
+from md2paper.mml2omml import mathml_to_omml, MathMLNotSupported
 from PIL import Image as PILImage
 import logging
 import os
+import shutil
 
 SRC_ROOT = os.path.split(os.path.split(os.path.abspath(__file__))[0])[0]
 logging.debug(f"resource root:{SRC_ROOT}")
 
+# 缓存目录，用于保存模板骨架等可复用的中间结果
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.join(
+    os.path.expanduser("~"), ".cache")), "md2paper")
 
-def latex_to_word(latex_input, transform_required=True):
+
+@lru_cache(maxsize=None)
+def get_mml2omml() -> etree.XSLT:
+    # 样式表很大，每个进程只解析、编译一次
+    xslt = etree.parse(
+        os.path.join(SRC_ROOT, 'md2paper', 'mml2omml.xsl')
+    )
+    return etree.XSLT(xslt)
+
+
+@lru_cache(maxsize=None)
+def get_xslt_version() -> str:
+    # 转换结果取决于latex2mathml的版本和样式表的内容
+    with open(os.path.join(SRC_ROOT, 'md2paper', 'mml2omml.xsl'), "rb") as f:
+        xsl_hash = hashlib.sha256(f.read()).hexdigest()[:16]
+    return "{}-{}".format(importlib.metadata.version("latex2mathml"), xsl_hash)
+
+
+class FormulaError(Exception):
+    # 无法转换的公式，可以从工作进程传回
+    def __init__(self, latex: str, reason: str):
+        super().__init__(latex, reason)
+        self.latex = latex
+        self.reason = reason
+
+    def __str__(self):
+        return "{}: {}".format(self.reason, self.latex)
+
+
+def latex_to_mathml(latex: str) -> etree._Element:
+    # latex2mathml不转义&等字符，错误的公式在解析时才出错
+    try:
+        return etree.fromstring(latex2mathml.converter.convert(latex))
+    except Exception as e:
+        raise FormulaError(latex, repr(e)) from e
+
+
+@lru_cache(maxsize=4096)
+def _latex_to_omml(latex_input: str, transform_required: bool):
     if not transform_required:
         return etree.fromstring(latex_input)
-    mathml = latex2mathml.converter.convert(latex_input)
-    tree = etree.fromstring(mathml)
+    xml = FormulaCache.get(latex_input, "xslt", get_xslt_version())
+    if xml is not None:
+        return etree.fromstring(xml)
+    tree = latex_to_mathml(latex_input)
+    try:
+        # 原生转换器与样式表输出一致，只有不支持的结构才走XSLT
+        omml = mathml_to_omml(tree)
+    except MathMLNotSupported:
+        omml = get_mml2omml()(tree).getroot()
+    FormulaCache.put(latex_input, "xslt", get_xslt_version(),
+                     etree.tostring(omml, encoding="unicode"))
+    return omml
+
+
+@lru_cache(maxsize=None)
+def get_mml2omml_batch() -> etree.XSLT:
+    # 导入mml2omml.xsl，把根节点下的每个<math>分别转换为一个<m:oMath>
     xslt = etree.parse(
-        os.path.join(SRC_ROOT, 'md2paper', 'mml2omml.xsl')
+        os.path.join(SRC_ROOT, 'md2paper', 'mml2omml_batch.xsl')
     )
-    transform = etree.XSLT(xslt)
-    new_dom = transform(tree)
-    return new_dom.getroot()
+    return etree.XSLT(xslt)
+
+
+# 未命中缓存的公式少于这个数时不启动进程池，进程启动的开销比转换本身大
+PARALLEL_MIN_FORMULAS = 64
+
+
+def convert_latex_list(latex_list: List[str]) -> List[str]:
+    # 转换一组公式，返回序列化的OMML，可以在工作进程中运行
+    # 有无法转换的公式时抛出FormulaError
+    omml_list: List[Union[str, None]] = []
+    fallback: List[Tuple[int, str]] = []
+    for latex in latex_list:
+        tree = latex_to_mathml(latex)
+        try:
+            # 原生转换器与样式表输出一致，只有不支持的结构才走XSLT
+            omml_list.append(etree.tostring(mathml_to_omml(tree), encoding="unicode"))
+        except MathMLNotSupported:
+            fallback.append((len(omml_list), etree.tostring(tree, encoding="unicode")))
+            omml_list.append(None)
+    if fallback:
+        # 原生转换器不支持的公式一次XSLT转换完
+        tree = etree.fromstring("<batch>{}</batch>".format(
+            "".join(mathml for _, mathml in fallback)))
+        new_dom = get_mml2omml_batch()(tree)
+        for (i, _), omml in zip(fallback, new_dom.getroot()):
+            omml_list[i] = etree.tostring(omml, encoding="unicode")
+    return omml_list
+
+
+def latex_to_omml_batch(latex_list: List[str], jobs: int = 1) -> List[str]:
+    # 转换所有公式，返回各公式的OMML xml，顺序与latex_list一致
+    # jobs > 1 时公式较多则分块交给进程池并行转换
+    version = get_xslt_version()
+    omml_map: Dict[str, str] = {}
+    for latex in latex_list:
+        if latex not in omml_map:
+            omml_map[latex] = FormulaCache.get(latex, "xslt", version)
+    miss_list = [latex for latex, xml in omml_map.items() if xml is None]
+    xml_list = None
+    if jobs > 1 and len(miss_list) >= PARALLEL_MIN_FORMULAS:
+        # 每个进程分到几块，避免个别复杂公式拖慢整体
+        size = -(-len(miss_list) // (jobs * 4))
+        chunks = [miss_list[i:i + size]
+                  for i in range(0, len(miss_list), size)]
+        try:
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                xml_list = [xml
+                            for chunk in executor.map(convert_latex_list, chunks)
+                            for xml in chunk]
+        except (OSError, BrokenProcessPool) as e:
+            logging.warning(f"process pool unavailable, converting serially: {e}")
+    if xml_list == None:
+        xml_list = convert_latex_list(miss_list)
+    for latex, xml in zip(miss_list, xml_list):
+        FormulaCache.put(latex, "xslt", version, xml)
+        omml_map[latex] = xml
+    return [omml_map[latex] for latex in latex_list]
+
+
+def latex_to_word(latex_input, transform_required=True):
+    # 缓存中的元素不能直接插入文档，否则会被移动，因此返回副本
+    return deepcopy(_latex_to_omml(latex_input, transform_required))
 
 
 class DocNotSetException(Exception):
     pass
 
 
-class DocManager():
-    __doc_target = None
+# 模板中的示例内容(锚点, 锚点样式名, 保留的段落数, 结束处的关键词, 关键词是否在段首)：
+# 从锚点之后删到关键词之前，保留keep段，同DocContext.delete_paragraphs_until
+Placeholder = Tuple[str, str, int, str, bool]
+
+
+class TemplateSkeleton():
+    # 处理好的模板：已清除表格，build模式下已截断正文，否则已删去示例内容，
+    # 对同一模板总是相同，因此按模板内容的hash缓存在内存和磁盘中
+    VERSION = 2
+
+    def __init__(self, data: bytes, texts: List[Tuple[str, str]],
+                 prototypes: List[Tuple[str, str, str]],
+                 anchors: List[Tuple[str, str, int]]) -> None:
+        # data: 骨架docx文件内容
+        # texts: 骨架中各段落的(文本, 样式名)
+        # prototypes: 被截断的模板段落(xml, 文本, 样式名)，供build模式复制标题
+        # anchors: 示例内容的锚点在骨架中的(文本, 样式名, 下标)
+        self.data = data
+        self.texts = texts
+        self.prototypes = prototypes
+        self.anchors = anchors
+
+    @classmethod
+    def get_key(cls, template: bytes, body_anchor: Tuple[str, str] = None,
+                placeholders: List[Placeholder] = None) -> str:
+        h = hashlib.sha256(template)
+        h.update(repr((cls.VERSION, body_anchor, placeholders)).encode())
+        return h.hexdigest()
+
+    @classmethod
+    def load(cls, key: str) -> Union[TemplateSkeleton, None]:
+        path = os.path.join(CACHE_DIR, "templates", key)
+        try:
+            with open(path + ".docx", "rb") as f:
+                data = f.read()
+            with open(path + ".json", "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        logging.debug(f"loaded template skeleton from {path}")
+        return TemplateSkeleton(data,
+                                [tuple(i) for i in meta["texts"]],
+                                [tuple(i) for i in meta["prototypes"]],
+                                [tuple(i) for i in meta["anchors"]])
+
+    def dump(self, key: str):
+        path = os.path.join(CACHE_DIR, "templates", key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # 先写临时文件再替换，避免并发的进程读到不完整的缓存；
+            # 临时文件名唯一，同一进程中多个线程同时写入也不会冲突
+            for ext, mode, content in [
+                (".docx", "wb", self.data),
+                (".json", "w", json.dumps({"texts": self.texts,
+                                           "prototypes": self.prototypes,
+                                           "anchors": self.anchors},
+                                          ensure_ascii=False))
+            ]:
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+                with open(fd, mode) as f:
+                    f.write(content)
+                os.replace(tmp_path, path + ext)
+        except OSError as e:
+            logging.warning(f"failed to save template skeleton: {e}")
+
+
+class DiskCache():
+    # 磁盘缓存，每个条目一个文件
+    # 用文件修改时间记录最近使用，超过大小上限时删除最久未用的条目
+    name = ""
+    enabled = True
+    max_size = 64 * 1024 * 1024
+    _size: int = None
+
+    @classmethod
+    def get_dir(cls) -> str:
+        return os.path.join(CACHE_DIR, cls.name)
+
+    @classmethod
+    def get_file(cls, key: str, ext: str) -> str:
+        return os.path.join(cls.get_dir(), key[:2], key + ext)
+
+    @classmethod
+    def read(cls, path: str) -> Union[str, None]:
+        if not cls.enabled:
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                text = f.read()
+            os.utime(path)
+        except OSError:
+            return None
+        return text
+
+    @classmethod
+    def write(cls, path: str, text: str):
+        if not cls.enabled:
+            return
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # 临时文件名唯一，同一进程中多个线程同时写入也不会冲突
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            with open(fd, "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning(f"failed to save {cls.name} cache: {e}")
+            return
+        if cls._size is None:
+            cls._size = sum(size for _, size, _ in cls._entries())
+        else:
+            cls._size += len(text.encode())
+        if cls._size > cls.max_size:
+            cls.prune()
 
     @classmethod
+    def _entries(cls) -> List[Tuple[float, int, str]]:
+        entries = []
+        for root, _, files in os.walk(cls.get_dir()):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    @classmethod
+    def prune(cls):
+        # 删到上限的3/4，避免每次写入都要扫描目录
+        entries = sorted(cls._entries())
+        size = sum(i[1] for i in entries)
+        for _, entry_size, path in entries:
+            if size <= cls.max_size * 3 // 4:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= entry_size
+        cls._size = size
+
+    @classmethod
+    def clear(cls):
+        shutil.rmtree(cls.get_dir(), ignore_errors=True)
+        cls._size = 0
+
+
+class FormulaCache(DiskCache):
+    # 公式转换结果的磁盘缓存：(LaTeX, 转换后端, 后端版本) -> OMML xml
+    VERSION = 2
+    name = "formulas"
+
+    @classmethod
+    def get_path(cls, latex: str, backend: str, version: str) -> str:
+        key = hashlib.sha256(
+            json.dumps([cls.VERSION, backend, version, latex]).encode()
+        ).hexdigest()
+        return cls.get_file(key, ".xml")
+
+    @classmethod
+    def get(cls, latex: str, backend: str, version: str) -> Union[str, None]:
+        return cls.read(cls.get_path(latex, backend, version))
+
+    @classmethod
+    def put(cls, latex: str, backend: str, version: str, xml: str):
+        cls.write(cls.get_path(latex, backend, version), xml)
+
+
+class DocContext():
+    # 一次渲染所用的文档及其索引，各次渲染互不影响，可以在多个线程/协程中同时进行
+    # 模板内容hash -> 模板骨架，在所有DocContext间共享
+    __skeletons: Dict[str, TemplateSkeleton] = {}
+
+    def __init__(self) -> None:
+        self.__doc_target = None
+        # body段落的索引，与文档中的w:p一一对应，增删段落时同步维护，
+        # 避免每次访问doc.paragraphs都重新构建整个列表
+        self.__paragraphs: List[Paragraph] = []
+        # 模板加载时各段落的(段落, 文本, 样式名)，供get_anchor_position查找，
+        # 避免每次查找都重新拼接段落文本、解析样式
+        self.__template_texts: List[Tuple[Paragraph, str, str]] = []
+        self.__template_mark: Tuple[int, int] = (0, 0)  # 模板段落下标的版本
+        # (anchor_text, anchor_style_name) -> 已找到的(段落, 下标, 记下下标时的版本)
+        self.__anchors: Dict[Tuple[str, str], Tuple[Paragraph, int, Tuple[int, int]]] = {}
+        # 段落增删的记录[offset, delta]，之前记下的下标按此换算为当前的下标，
+        # 不必在__paragraphs中查找；从同一处连续插入、删除的段落合并为一条
+        self.__edits: List[List[int]] = []
+        self.__sealed = 0  # 已被引用的记录不能再合并
+        self.__epoch = 0  # 重建索引后之前记下的下标全部作废
+        # 已渲染的增量单元(key, 第一个元素, 最后一个元素)，按渲染顺序，见Block.set_key
+        self.__units: List[Tuple[str, OxmlElement, OxmlElement]] = []
+
     # doc_target: path-like string, file-like object or docx.Document
-    def set_doc(cls, doc_target: Union[docx.Document, str, BytesIO]):
+    def set_doc(self, doc_target: Union[docx.Document, str, BytesIO]):
         if type(doc_target) == str:
             actual_path = os.path.join(SRC_ROOT, doc_target)
             logging.info(f"reading from template:{actual_path}")
-            cls.__doc_target = docx.Document(actual_path)
+            self.__doc_target = docx.Document(actual_path)
         elif type(doc_target) == docx.Document:
-            cls.__doc_target = doc_target
+            self.__doc_target = doc_target
         elif type(doc_target) == BytesIO:
-            cls.__doc_target = docx.Document(doc_target)
+            self.__doc_target = docx.Document(doc_target)
         else:
             raise TypeError(f"invalid doc target: expecting str or docx.Document type,\
                  got {type(doc_target)}")
-        cls.__clear_tables()
-
-    @classmethod
-    def get_doc(cls) -> docx.Document:
-        if not cls.__doc_target:
-            raise DocNotSetException("doc target is not set, call DM.set_doc")
-        return cls.__doc_target
+        self.__clear_tables()
+        self.rebuild_index()
+        self.__template_texts = [(p, p.text, p.style.name)
+                                for p in self.__paragraphs]
+        self.__template_mark = self.__mark()
+        self.__anchors = {}
+
+    # 与set_doc相同，但模板的处理结果会被缓存，相同的模板不必重复处理
+    # body_anchor: 非空时按build模式截断正文，见Paper.body_anchor
+    # placeholders: 预先删去的示例内容，见Paper.placeholders
+    def load_template(self, template: Union[str, BytesIO], body_anchor: Tuple[str, str] = None,
+                      placeholders: List[Placeholder] = None):
+        if type(template) == str:
+            actual_path = os.path.join(SRC_ROOT, template)
+            logging.info(f"reading from template:{actual_path}")
+            with open(actual_path, "rb") as f:
+                data = f.read()
+        elif type(template) == BytesIO:
+            data = template.getvalue()
+        else:
+            raise TypeError(f"invalid template: expecting str or BytesIO type,\
+                 got {type(template)}")
+
+        key = TemplateSkeleton.get_key(data, body_anchor, placeholders)
+        skeleton = self.__skeletons.get(key)
+        if skeleton is None:
+            skeleton = TemplateSkeleton.load(key)
+        if skeleton is None:
+            skeleton = self.__make_skeleton(data, body_anchor, placeholders)
+            skeleton.dump(key)
+        self.__skeletons[key] = skeleton
+
+        self.__doc_target = docx.Document(BytesIO(skeleton.data))
+        self.rebuild_index()
+        body = self.__doc_target._body
+        self.__template_texts = [(p, text, style_name) for p, (text, style_name)
+                                in zip(self.__paragraphs, skeleton.texts)]
+        self.__template_texts += [(Paragraph(parse_xml(xml), body), text, style_name)
+                                 for xml, text, style_name in skeleton.prototypes]
+        self.__template_mark = self.__mark()
+        # 示例内容的锚点已在骨架中找到，不必再查找
+        self.__anchors = {(text, style_name): (self.__paragraphs[position], position,
+                                               self.__template_mark)
+                          for text, style_name, position in skeleton.anchors}
+
+    # 读取之前生成的文档，用于增量渲染：不清除表格，也没有模板段落可供查找
+    def load_output(self, data: BytesIO):
+        self.__doc_target = docx.Document(data)
+        self.rebuild_index()
+        self.__template_texts = []
+        self.__template_mark = self.__mark()
+        self.__anchors = {}
+        self.__units = []
 
     @classmethod
-    def __clear_tables(cls):
+    def __make_skeleton(cls, data: bytes, body_anchor: Tuple[str, str] = None,
+                        placeholders: List[Placeholder] = None) -> TemplateSkeleton:
+        ctx = DocContext()
+        ctx.set_doc(BytesIO(data))
+        prototypes = []
+        if body_anchor:
+            ctx.truncate(ctx.get_anchor_position(*body_anchor) - 1)
+            prototypes = [(_p._p.xml, text, style_name)
+                          for _p, text, style_name in ctx.__template_texts
+                          if _p._p.getparent() is None]
+        placeholders = placeholders or []
+        for anchor_text, anchor_style_name, keep, keyword, startswith in placeholders:
+            ctx.delete_paragraphs_until(ctx.get_anchor_position(anchor_text, anchor_style_name),
+                                        keyword, keep, startswith)
+        anchors = [(anchor_text, anchor_style_name,
+                    ctx.get_anchor_position(anchor_text, anchor_style_name) - 1)
+                   for anchor_text, anchor_style_name, _, _, _ in placeholders]
+        out = BytesIO()
+        ctx.get_doc().save(out)
+        texts = [(p.text, p.style.name) for p in ctx.__paragraphs]
+        return TemplateSkeleton(out.getvalue(), texts, prototypes, anchors)
+
+    def get_doc(self) -> docx.Document:
+        if not self.__doc_target:
+            raise DocNotSetException("doc target is not set, call set_doc")
+        return self.__doc_target
+
+    def __clear_tables(self):
         # delete all tables on startup as we don't need them
-        for i in range(len(cls.get_doc().tables)):
-            t = cls.get_doc().tables[0]._element
+        for i in range(len(self.get_doc().tables)):
+            t = self.get_doc().tables[0]._element
             t.getparent().remove(t)
             t._t = t._element = None
 
-    @classmethod
-    def delete_paragraph_by_index(cls, index):
+    # 直接通过get_doc()增删body段落后需要调用，以重建段落索引
+    def rebuild_index(self):
+        self.__paragraphs = list(self.get_doc().paragraphs)
+        self.__edits = []
+        self.__sealed = 0
+        self.__epoch += 1
+
+    # 记下下标时的版本，之后用__resolve换算
+    def __mark(self) -> Tuple[int, int]:
+        self.__sealed = len(self.__edits)
+        return (self.__epoch, self.__sealed)
+
+    # 在offset处插入(delta > 0)或删除(delta < 0)了段落
+    def __record_edit(self, offset: int, delta: int):
+        if len(self.__edits) > self.__sealed:
+            last = self.__edits[-1]
+            if delta > 0 and last[1] > 0 and offset == last[0] + last[1]:
+                last[1] += delta
+                return
+            if delta < 0 and last[1] < 0 and offset == last[0]:
+                last[1] += delta
+                return
+        self.__edits.append([offset, delta])
+
+    # 把mark时的下标换算为当前的下标，段落已被删除或索引已重建时返回-1
+    def __resolve(self, position: int, mark: Tuple[int, int]) -> int:
+        epoch, start = mark
+        if epoch != self.__epoch:
+            return -1
+        for offset, delta in self.__edits[start:]:
+            if position < offset:
+                continue
+            if position < offset - delta:
+                return -1
+            position += delta
+        return position
+
+    def delete_paragraph_by_index(self, index):
         logging.debug(
-            f"deleting idx={index} text={cls.get_paragraph(index).text}")
-        p = cls.get_doc().paragraphs[index]._element
+            f"deleting idx={index} text={self.get_paragraph(index).text}")
+        p = self.__paragraphs.pop(index)._element
         p.getparent().remove(p)
         p._p = p._element = None
-
-    @classmethod
-    def get_anchor_position(cls, anchor_text: str, anchor_style_name="") -> int:
-        # FIXME: 需要优化
-        # 目前被设计成无状态的，只依赖template.docx文件以便测试，增加了性能开销
+        self.__record_edit(index, -1)
+
+    # 删除[start, end)范围内的段落，end为None则删到文档末尾，返回删除的段落数
+    def delete_paragraphs(self, start: int, end: int = None) -> int:
+        if end is None:
+            end = len(self.__paragraphs)
+        deleted = self.__paragraphs[start:end]
+        for paragraph in deleted:
+            p = paragraph._element
+            p.getparent().remove(p)
+            p._p = p._element = None
+        del self.__paragraphs[start:end]
+        if deleted:
+            self.__record_edit(start, -len(deleted))
+        logging.debug(f"deleted paragraphs [{start}, {end})")
+        return len(deleted)
+
+    # 从start开始删除段落，直到包含keyword（startswith为True时要求以keyword开头）的段落
+    # 前面还剩keep个段落为止；找不到keyword时视最后一段为keyword所在段落
+    def delete_paragraphs_until(self, start: int, keyword: str, keep: int = 0, startswith=False) -> int:
+        end = len(self.__paragraphs) - 1
+        for i in range(start + keep, len(self.__paragraphs)):
+            text = self.__paragraphs[i].text
+            if (text.startswith(keyword) if startswith else keyword in text):
+                end = i
+                break
+        return self.delete_paragraphs(start, max(start, end - keep))
+
+    # 删除offset处段落及其后的全部body内容（保留body末尾的sectPr），
+    # build模式在模板的样式、封面等基础上从这里开始向后追加正文
+    def truncate(self, offset: int):
+        element = self.__paragraphs[offset]._p
+        while element is not None and element.tag != qn('w:sectPr'):
+            next_element = element.getnext()
+            element.getparent().remove(element)
+            element = next_element
+        if offset < len(self.__paragraphs):
+            self.__record_edit(offset, offset - len(self.__paragraphs))
+        del self.__paragraphs[offset:]
+        logging.debug(f"truncated body from paragraph {offset}")
+
+    # 复制模板加载时的段落（即使已被删除），用于在build模式中复用模板标题的格式
+    def copy_template_paragraph(self, anchor_text: str, anchor_style_name="") -> OxmlElement:
+        for _p, text, style_name in self.__template_texts:
+            if anchor_text in text and\
+                    ((not anchor_style_name) or (style_name == anchor_style_name)):
+                return deepcopy(_p._p)
+        raise ValueError(f"template paragraph `{anchor_text}` not found")
+
+    # 在offset处的段落前插入新段落，新段落的offset即为原offset
+    def insert_paragraph_before(self, offset: int) -> Paragraph:
+        p = self.get_paragraph(offset).insert_paragraph_before()
+        self.__paragraphs.insert(offset, p)
+        self.__record_edit(offset, 1)
+        return p
+
+    # 在文档末尾追加新段落
+    def add_paragraph(self) -> Paragraph:
+        p = self.get_doc().add_paragraph()
+        self.__paragraphs.append(p)
+        return p
+
+    def paragraph_count(self) -> int:
+        return len(self.__paragraphs)
+
+    def __is_anchor(self, paragraph: Paragraph, anchor_text: str, anchor_style_name: str) -> bool:
+        # 段落可能已被删除，或在加载模板后被修改了文本
+        if paragraph._p.getparent() is None:
+            return False
+        return anchor_text in paragraph.text and\
+            ((not anchor_style_name) or (paragraph.style.name == anchor_style_name))
+
+    def get_anchor_position(self, anchor_text: str, anchor_style_name="") -> int:
         # USE-WITH-CARE
         # 只靠标题的anchor-text找paragraph很容易找错，用的时候注意
-        i = -1
-        for _i, paragraph in enumerate(cls.get_doc().paragraphs):
-            if anchor_text in paragraph.text:
-                if (not anchor_style_name) or (paragraph.style.name == anchor_style_name):
-                    i = _i
+        # 查找顺序：已找到过的锚点 -> 模板加载时的段落文本 -> 逐段扫描当前文档
+        # 模板段落的下标是加载模板时的位置，与记下的锚点一样换算为当前的下标
+        key = (anchor_text, anchor_style_name)
+        paragraph, position, mark = self.__anchors.get(key, (None, 0, None))
+        if paragraph is None or not self.__is_anchor(paragraph, anchor_text, anchor_style_name):
+            paragraph = None
+            for position, (_p, text, style_name) in enumerate(self.__template_texts):
+                if anchor_text in text and\
+                        ((not anchor_style_name) or (style_name == anchor_style_name)) and\
+                        self.__is_anchor(_p, anchor_text, anchor_style_name):
+                    paragraph = _p
+                    mark = self.__template_mark
                     break
 
-        if i == -1:
-            raise ValueError(f"anchor `{anchor_text}` not found")
-        return i + 1
+        if paragraph is None:
+            for position, _p in enumerate(self.__paragraphs):
+                if self.__is_anchor(_p, anchor_text, anchor_style_name):
+                    paragraph = _p
+                    mark = None
+                    break
 
-    @classmethod
-    def get_paragraph(cls, offset: int):
-        return cls.get_doc().paragraphs[offset]
+        if paragraph is None:
+            raise ValueError(f"anchor `{anchor_text}` not found")
+        if mark is not None:
+            position = self.__resolve(position, mark)
+        if not 0 <= position < len(self.__paragraphs) or\
+                self.__paragraphs[position] is not paragraph:
+            # 直接修改文档后重建了索引，或是不在文档中的模板段落
+            position = self.__paragraphs.index(paragraph)
+        self.__anchors[key] = (paragraph, position, self.__mark())
+        return position + 1
+
+    def get_paragraph(self, offset: int) -> Paragraph:
+        return self.__paragraphs[offset]
+
+    # 获取插入位置为offset处段落之前的cursor
+    def get_cursor(self, offset: int) -> Cursor:
+        element = self.__paragraphs[offset]._p.getprevious()
+        if element is None:
+            raise ValueError(f"no element before paragraph {offset}")
+        return Cursor(self, element, offset)
+
+    # 获取body末尾（sectPr之前）的cursor
+    def get_end_cursor(self) -> Cursor:
+        element = self.get_doc().element.body[-1]
+        if element.tag == qn('w:sectPr'):
+            element = element.getprevious()
+        return Cursor(self, element, len(self.__paragraphs))
+
+    # 在cursor处插入新段落（或给定的w:p），并将cursor移到新段落之后
+    def insert_paragraph_after(self, cursor: Cursor, p: OxmlElement = None) -> Paragraph:
+        if p is None:
+            p = OxmlElement('w:p')
+        cursor.element.addnext(p)
+        paragraph = Paragraph(p, self.get_doc()._body)
+        self.__paragraphs.insert(cursor.offset, paragraph)
+        self.__record_edit(cursor.offset, 1)
+        cursor.element = p
+        cursor.offset += 1
+        return paragraph
+
+    def add_unit(self, key: str, first: OxmlElement, last: OxmlElement):
+        self.__units.append((key, first, last))
+
+    # 各增量单元(key, 在body中的起始下标, 元素数, 引用的图片rId)，
+    # 单元的元素在渲染后被删除、移动时返回None
+    def get_units(self) -> Union[List[Tuple[str, int, int, List[str]]], None]:
+        body = self.get_doc().element.body
+        units = []
+        for key, first, last in self.__units:
+            if first.getparent() is not body or last.getparent() is not body:
+                return None
+            start, end = body.index(first), body.index(last) + 1
+            if start >= end:
+                return None
+            rIds = []
+            for element in body[start:end]:
+                for blip in element.iter(qn('a:blip')):
+                    rId = blip.get(qn('r:embed'))
+                    if rId and rId not in rIds:
+                        rIds.append(rId)
+            units.append((key, start, end - start, rIds))
+        return units
+
+    # 删除增量单元原有的元素，在原处重新渲染block
+    def rerender(self, elements: List[OxmlElement], block: Block) -> Cursor:
+        element = elements[0].getprevious()
+        prev_p = element
+        while prev_p is not None and prev_p.tag != qn('w:p'):
+            prev_p = prev_p.getprevious()
+        offset = 0
+        if prev_p is not None:
+            offset = [p._p for p in self.__paragraphs].index(prev_p) + 1
+        count = 0
+        for e in elements:
+            if e.tag == qn('w:p'):
+                count += 1
+            e.getparent().remove(e)
+        del self.__paragraphs[offset:offset + count]
+        if count:
+            self.__record_edit(offset, -count)
+        return block.render_template(Cursor(self, element, offset))
+
+    # 删除不再被正文引用的图片关系，图片本身随之不再保存
+    def drop_unused_images(self, rIds: List[str]):
+        part = self.get_doc().part
+        used = set(part.element.xpath('//@r:embed | //@r:id | //@r:link'))
+        for rId in rIds:
+            if rId not in used and rId in part.rels:
+                part.drop_rel(rId)
 
     # https://stackoverflow.com/questions/51360649/how-to-update-table-of-contents-in-docx-file-with-python-on-linux?rq=1
-    @classmethod
-    def update_toc(cls):
+    def update_toc(self):
         namespace = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
         # add child to doc.settings element
         element_updatefields = lxml.etree.SubElement(
-            cls.get_doc().settings.element, f"{namespace}updateFields"
+            self.get_doc().settings.element, f"{namespace}updateFields"
         )
         element_updatefields.set(f"{namespace}val", "true")
 
+    def save(self, out: Union[str, StringIO]):
+        self.__doc_target.save(out)
+
+
+class DocManager():
+    # 兼容旧接口：把调用转发给当前线程/协程的DocContext
+    # 新代码应直接创建DocContext并在渲染时传递
+    __context: ContextVar[DocContext] = ContextVar("md2paper_doc_context")
+
+    @classmethod
+    def get_context(cls) -> DocContext:
+        ctx = cls.__context.get(None)
+        if ctx is None:
+            ctx = DocContext()
+            cls.__context.set(ctx)
+        return ctx
+
+    @classmethod
+    def set_context(cls, ctx: DocContext):
+        return cls.__context.set(ctx)
+
+    @classmethod
+    def reset_context(cls, token):
+        cls.__context.reset(token)
+
+    @classmethod
+    def set_doc(cls, doc_target: Union[docx.Document, str, BytesIO]):
+        cls.get_context().set_doc(doc_target)
+
+    @classmethod
+    def load_template(cls, template: Union[str, BytesIO], body_anchor: Tuple[str, str] = None,
+                      placeholders: List[Placeholder] = None):
+        cls.get_context().load_template(template, body_anchor, placeholders)
+
+    @classmethod
+    def get_doc(cls) -> docx.Document:
+        return cls.get_context().get_doc()
+
+    @classmethod
+    def rebuild_index(cls):
+        cls.get_context().rebuild_index()
+
+    @classmethod
+    def delete_paragraph_by_index(cls, index):
+        cls.get_context().delete_paragraph_by_index(index)
+
+    @classmethod
+    def delete_paragraphs(cls, start: int, end: int = None) -> int:
+        return cls.get_context().delete_paragraphs(start, end)
+
+    @classmethod
+    def delete_paragraphs_until(cls, start: int, keyword: str, keep: int = 0, startswith=False) -> int:
+        return cls.get_context().delete_paragraphs_until(start, keyword, keep, startswith)
+
+    @classmethod
+    def truncate(cls, offset: int):
+        cls.get_context().truncate(offset)
+
+    @classmethod
+    def copy_template_paragraph(cls, anchor_text: str, anchor_style_name="") -> OxmlElement:
+        return cls.get_context().copy_template_paragraph(anchor_text, anchor_style_name)
+
+    @classmethod
+    def insert_paragraph_before(cls, offset: int) -> Paragraph:
+        return cls.get_context().insert_paragraph_before(offset)
+
+    @classmethod
+    def add_paragraph(cls) -> Paragraph:
+        return cls.get_context().add_paragraph()
+
+    @classmethod
+    def paragraph_count(cls) -> int:
+        return cls.get_context().paragraph_count()
+
+    @classmethod
+    def get_anchor_position(cls, anchor_text: str, anchor_style_name="") -> int:
+        return cls.get_context().get_anchor_position(anchor_text, anchor_style_name)
+
+    @classmethod
+    def get_paragraph(cls, offset: int) -> Paragraph:
+        return cls.get_context().get_paragraph(offset)
+
+    @classmethod
+    def get_cursor(cls, offset: int) -> Cursor:
+        return cls.get_context().get_cursor(offset)
+
+    @classmethod
+    def get_end_cursor(cls) -> Cursor:
+        return cls.get_context().get_end_cursor()
+
+    @classmethod
+    def update_toc(cls):
+        cls.get_context().update_toc()
+
     @classmethod
     def save(cls, out: Union[str, StringIO]):
-        cls.__doc_target.save(out)
+        cls.get_context().save(out)
 
 
 DM = DocManager
 
 
+class Cursor():
+    # 文档body中的插入位置，新内容直接作为element的后继插入，
+    # 不必每次都用offset重新定位段落
+    # ctx: 所在文档的DocContext，渲染内容时通过它访问文档
+    # element: 插入位置前的最后一个元素（w:p/w:tbl）
+    # offset: 插入位置后第一个段落在ctx段落索引中的下标
+    def __init__(self, ctx: DocContext, element, offset: int) -> None:
+        self.ctx = ctx
+        self.element = element
+        self.offset = offset
+
+    def add_paragraph(self, p: OxmlElement = None) -> Paragraph:
+        return self.ctx.insert_paragraph_after(self, p)
+
+    def add_table(self, table: docx.table.Table):
+        self.element.addnext(table._tbl)
+        self.element = table._tbl
+
+    # 删除cursor前的最后一个段落，调用前需保证element是段落
+    def delete_last_paragraph(self):
+        element = self.element.getprevious()
+        self.ctx.delete_paragraph_by_index(self.offset - 1)
+        self.element = element
+        self.offset -= 1
+
+
 class BaseContent():
 
-    # 在指定offset 【向上】填充paragraph，返回填充后最后一段的offset+1
-    def render_paragraph(offset: int) -> int:
+    # 在cursor处【向后】填充paragraph，返回填充后的cursor
+    def render_paragraph(cursor: Cursor) -> Cursor:
         raise NotImplementedError
 
 
@@ -158,21 +867,27 @@ class Component():
     # incr_next: 用于在插入新内容后往后删老模板当前段内容，
     # 直到删除到incr_kw往前incr_next个paragraph
     # incr_kw：见上面incr_next
-    def render_template(self, anchor_text: str,  incr_next: int, incr_kw, anchor_style_name="") -> int:
-        offset = DM.get_anchor_position(
+    # ctx: 渲染所用的DocContext，为空时使用DM当前的context
+    def render_template(self, anchor_text: str,  incr_next: int, incr_kw, anchor_style_name="",
+                        ctx: DocContext = None) -> int:
+        ctx = ctx or DM.get_context()
+        offset = ctx.get_anchor_position(
             anchor_text=anchor_text, anchor_style_name=anchor_style_name)
-        i = 0
-        while not incr_kw in DM.get_doc().paragraphs[offset+incr_next].text\
-                and (offset+incr_next) != (len(DM.get_doc().paragraphs)-1):
-            logging.debug("deleted content: {}...".format(
-                DM.get_paragraph(offset).text[:min(
-                    10, len(DM.get_paragraph(offset).text))]
-            ))
-            DM.delete_paragraph_by_index(offset)
-            i = i+1
+        i = ctx.delete_paragraphs_until(offset, incr_kw, keep=incr_next)
         logging.debug(
             "Component:deleted {} lines when rendering template".format(i))
-        return self.__internal_text.render_template(offset)
+        return self.__internal_text.render_template(ctx.get_cursor(offset)).offset
+
+    # build模式：模板正文已被DocContext.truncate清空，
+    # 在文档末尾依次追加模板中的标题段落（anchor_text）和内容
+    def build_template(self, anchor_text: str = "", anchor_style_name="",
+                       ctx: DocContext = None) -> Cursor:
+        ctx = ctx or DM.get_context()
+        cursor = ctx.get_end_cursor()
+        if anchor_text:
+            cursor.add_paragraph(ctx.copy_template_paragraph(
+                anchor_text, anchor_style_name))
+        return self.__internal_text.render_template(cursor)
 
 
 class Run():
@@ -230,7 +945,7 @@ class Text(BaseContent):
         self.__runs.append(Run.get_tabstop())
         return self
 
-    def render_paragraph(self, position: Union[int, Paragraph]) -> int:
+    def render_paragraph(self, position: Union[Cursor, Paragraph]) -> Cursor:
         if type(position) == Paragraph:
             for run in self.__runs:
                 if not run.is_tabstop():
@@ -239,16 +954,15 @@ class Text(BaseContent):
                     raise ValueError(
                         "no tabstops in direct paragraph position assignment")
             return
-        if type(position) != int:
+        if type(position) != Cursor:
             raise TypeError("invalid type", type(position))
-        new_offset = position
-        p = DM.get_doc().paragraphs[new_offset].insert_paragraph_before()
+        p = position.add_paragraph()
         for run in self.__runs:
             if not run.is_tabstop():
                 run.render_run(p.add_run())
             else:
                 # https://stackoverflow.com/questions/58656450/how-to-use-tabletop-by-python-docx
-                sec = DM.get_doc().sections[0]
+                sec = position.ctx.get_doc().sections[0]
                 margin_end = docx.shared.Inches(
                     sec.page_width.inches - (sec.left_margin.inches + sec.right_margin.inches))
                 tab_stops = p.paragraph_format.tab_stops
@@ -257,8 +971,7 @@ class Text(BaseContent):
                     margin_end, docx.enum.text.WD_TAB_ALIGNMENT.RIGHT)
 
         p.paragraph_format.first_line_indent = Cm(0.82)
-        new_offset = new_offset + 1
-        return new_offset
+        return position
 
     @classmethod
     def read(cls, txt: str) -> List[Text]:
@@ -311,33 +1024,27 @@ class Image(BaseContent):
         super().__init__()
         self.__images = data
 
-    def render_paragraph(self, offset: int) -> int:
-        new_offset = offset
+    def render_paragraph(self, cursor: Cursor) -> Cursor:
         for img in self.__images:
-            DM.get_doc().paragraphs[new_offset].insert_paragraph_before()
-            new_offset = new_offset + 1
+            cursor.add_paragraph()
 
-            p = DM.get_doc().paragraphs[new_offset].insert_paragraph_before()
-            new_offset = new_offset + 1
+            p = cursor.add_paragraph()
             p.alignment = WD_ALIGN_PARAGRAPH.CENTER
-            p.style = DM.get_doc().styles['图名中文']
+            p.style = cursor.ctx.get_doc().styles['图名中文']
             if img.img_src:
                 r = p.add_run()
                 r.add_picture(img.img_src, *img.get_size_in_doc())
 
-                p = DM.get_doc(
-                ).paragraphs[new_offset].insert_paragraph_before()
-                new_offset = new_offset + 1
+                p = cursor.add_paragraph()
                 p.alignment = WD_ALIGN_PARAGRAPH.CENTER
-                p.style = DM.get_doc().styles['图名中文']
+                p.style = cursor.ctx.get_doc().styles['图名中文']
 
             p.add_run().add_text(img.img_alt)
 
         # 结尾再换
-        DM.get_paragraph(new_offset).insert_paragraph_before()
-        new_offset = new_offset + 1
+        cursor.add_paragraph()
 
-        return new_offset
+        return cursor
 
 
 class Formula(BaseContent):
@@ -347,15 +1054,11 @@ class Formula(BaseContent):
         self.__formula: str = formula
         self.__transform_required = transform_required
 
-    def render_paragraph(self, offset: int) -> int:
+    def render_paragraph(self, cursor: Cursor) -> Cursor:
         logging.debug("rendering formula `{}`: {}".format(
             self.__title, self.__formula))
-        new_offset = offset
-        p = DM.get_doc().paragraphs[new_offset].insert_paragraph_before()
-        p.alignment = WD_ALIGN_PARAGRAPH.CENTER
-        table = DM.get_doc().add_table(rows=1, cols=3)
-        p._p.addnext(table._tbl)
-        DM.delete_paragraph_by_index(new_offset)
+        table = cursor.ctx.get_doc().add_table(rows=1, cols=3)
+        cursor.add_table(table)
 
         # 公式cell
         if self.__formula:
@@ -381,7 +1084,7 @@ class Formula(BaseContent):
         cell_idx_p = cell_idx.paragraphs[0]
         cell_idx_p.text = self.__title
         cell_idx_p.alignment = WD_ALIGN_PARAGRAPH.RIGHT
-        return new_offset
+        return cursor
 
 # Row of Table
 
@@ -415,38 +1118,30 @@ class Table(BaseContent):
         self.__auto_fit = False
         self.__columns_width = widths
 
-    def render_paragraph(self, offset: int) -> int:
-        new_offset = offset
+    def render_paragraph(self, cursor: Cursor) -> Cursor:
         # 先换一行
-        DM.get_doc().paragraphs[new_offset].insert_paragraph_before()
-        new_offset = new_offset + 1
-        p1 = DM.get_doc().paragraphs[new_offset].insert_paragraph_before()
-        new_offset = new_offset + 1
+        cursor.add_paragraph()
+        p1 = cursor.add_paragraph()
         p1.alignment = WD_ALIGN_PARAGRAPH.CENTER
-        p1.style = DM.get_doc().styles['图名中文']
+        p1.style = cursor.ctx.get_doc().styles['图名中文']
         # 先换一行
         p1.add_run().add_text(self.__title)
 
-        p2 = DM.get_doc().paragraphs[new_offset].insert_paragraph_before()
-        table = DM.get_doc().add_table(rows=self.__rows, cols=self.__cols, style='Table Grid')
+        table = cursor.ctx.get_doc().add_table(rows=self.__rows, cols=self.__cols, style='Table Grid')
         table.alignment = WD_TABLE_ALIGNMENT.CENTER
         if not self.__auto_fit:
             table.autofit = False
             table.allow_autofit = False
 
-        # 将table挪到paragrpah里
-        p2._p.addnext(table._tbl)
-        # 挪完删掉paragraph
-        DM.delete_paragraph_by_index(new_offset)
+        # 将table挪到cursor处
+        cursor.add_table(table)
 
-        #new_offset = new_offset + 1
         if not self.__auto_fit:
             for i in range(len(table.columns)):
                 table.columns[i].width = Inches(self.__columns_width[i] * 6)
 
         # 结尾再换
-        p1 = DM.get_doc().paragraphs[new_offset].insert_paragraph_before()
-        new_offset = new_offset + 1
+        cursor.add_paragraph()
 
         # 填充内容, 编辑表格样式
         for i, row in enumerate(self.__table):
@@ -482,9 +1177,9 @@ class Table(BaseContent):
                         raise TypeError(
                             "invalid type {}".format(type(cell_content)))
                     p.alignment = WD_ALIGN_PARAGRAPH.CENTER
-                    p.style = DM.get_doc().styles['图名中文']
+                    p.style = cursor.ctx.get_doc().styles['图名中文']
 
-        return new_offset
+        return cursor
 
     # https://stackoverflow.com/questions/33069697/how-to-setup-cell-borders-with-python-docx
     @classmethod
@@ -549,10 +1244,19 @@ class Block():  # content
         self.__content_list: List[Union[Text, Image, Table, Formula]] = []
         self.__sub_blocks: List[Block] = []
         self.__id: int = None
+        self.__key: str = None
 
     def set_id(self, id: int):
         self.__id = id
 
+    # 设置了key的block是增量渲染的单元：渲染时记录其在文档中的范围，
+    # 之后key不变时可以保留原有内容，不必重新渲染
+    def set_key(self, key: str):
+        self.__key = key
+
+    def get_key(self) -> str:
+        return self.__key
+
     # 由level决定标题的样式（heading1，2，3）
     def set_title(self, title: str, level: int) -> Block:
         self.__title = title
@@ -582,51 +1286,45 @@ class Block():  # content
     # render_template是基于render_block的api，增加了嵌套blocks的渲染 以支持递归生成章节/段落，
     # 同时增加了对段落标题和段落号的支持
     # 顺序：先title，再自己的content-list，再自己的sub-block
-    def render_template(self, offset: int) -> int:
-        new_offset = offset
-
+    def render_template(self, cursor: Cursor) -> Cursor:
+        start = cursor.element
         # 如果是一级，给头上（标题前面）增加分页符
         if self.__title and self.__level == self.heading_1:
-            p = DM.get_doc().paragraphs[new_offset].insert_paragraph_before()
+            p = cursor.add_paragraph()
             run = p.add_run()
             run.add_break(WD_BREAK.PAGE)
-            new_offset = new_offset + 1
 
         if self.__title:
             logging.debug(f"block(level={self.__level}) title: {self.__title}")
-            p_title = DM.get_doc(
-            ).paragraphs[new_offset].insert_paragraph_before()
-            p_title.style = DM.get_doc().styles['Heading '+str(self.__level)]
+            p_title = cursor.add_paragraph()
+            p_title.style = cursor.ctx.get_doc().styles['Heading '+str(self.__level)]
             p_title.add_run()
             title_idx = "" if not self.__id else str(self.__id) + "  "
             p_title.runs[0].text = title_idx + self.__title
-            new_offset = new_offset + 1
 
-        new_offset = self.render_block(new_offset)
+        cursor = self.render_block(cursor)
 
         logging.debug(f"this block has {len(self.__sub_blocks)} sub-blocks")
         for i, block in enumerate(self.__sub_blocks):
-            new_offset = block.render_template(new_offset)
+            cursor = block.render_template(cursor)
 
-        return new_offset
+        if self.__key and cursor.element is not start:
+            cursor.ctx.add_unit(self.__key, start.getnext(), cursor.element)
+        return cursor
 
     # render_block是最底层的api，只将自己的content-list加到已有文档给定位置
-    # render_block takes the desired paragraph position's offset,
+    # render_block takes the cursor of the desired position,
     # renders the block with native elements: text, image and formulas,
-    # and returns the final paragraph's offset
+    # and returns the cursor after the rendered content
 
-    def render_block(self, offset: int) -> int:
-        if not self.__content_list:
-            return offset
-        new_offset = offset
+    def render_block(self, cursor: Cursor) -> Cursor:
         for i, content in enumerate(self.__content_list):
-            new_offset = content.render_paragraph(new_offset)
+            cursor = content.render_paragraph(cursor)
             _media_types = [Image, Table]
             if i < len(self.__content_list)-1 and\
                     type(content) in _media_types and\
                     type(self.__content_list[i+1]) in _media_types:
-                # 多媒体内容之间也只空一行
-                DM.delete_paragraph_by_index(new_offset)
-                new_offset = new_offset - 1
+                # 多媒体内容之间也只空一行，删去前一个多媒体结尾的空行
+                cursor.delete_last_paragraph()
 
-        return new_offset
+        return cursor
@@ -1,20 +1,21 @@
 from md2paper.md_paper import *
+from md2paper.md_paper import _file_stamp
 
 
 # 论文模块
 
 class MetaPart(PaperPart):
-    def load_contents(self, soup: BeautifulSoup):
-        mete_h1 = soup.find("h1")
+    def load_contents(self, doc: MDDocument):
+        mete_h1 = doc.find("h1")
 
-        data_table = mete_h1.find_next_sibling("table").find("tbody")
-        data_lines = data_table.find_all("tr")
-        data_pairs = [list(map(lambda x: rbk(x.text), i.find_all("td")))
+        data_table = doc[doc.find("table", start=mete_h1 + 1)].find("tbody")
+        data_lines = data_table.iter("tr")
+        data_pairs = [list(map(lambda x: rbk(get_text(x)), i.iter("td")))
                       for i in data_lines]
         data_dict = dict(data_pairs)
 
-        self.title_zh_CN = rbk(mete_h1.text)
-        self.title_en = rbk(mete_h1.find_next_sibling("h2").text)
+        self.title_zh_CN = rbk(get_text(doc[mete_h1]))
+        self.title_en = rbk(get_text(doc[doc.find("h2", start=mete_h1 + 1)]))
         self.school = data_dict["学院（系）"]
         self.major = data_dict["专业"]
         self.name = data_dict["学生姓名"]
@@ -38,29 +39,32 @@ class MetaPart(PaperPart):
 
 
 class AbsPart(PaperPart):
-    def load_contents(self, soup: BeautifulSoup):
+    def load_contents(self, doc: MDDocument):
         # 摘要
-        abs_cn_h1 = soup.find("h1", string=re_space("摘要"))
-        abs_cn_ul = abs_cn_h1.find_next_sibling("ul")
-        conts_cn = self._get_content_until(abs_cn_h1.next_sibling, abs_cn_ul)
-        assert_warning(conts_cn[-1] == ("p", [{"type": "text", "text": "关键词："}]),
+        abs_cn_h1 = doc.find_h1("摘要")
+        abs_cn_ul = doc.find("ul", start=abs_cn_h1 + 1)
+        conts_cn = self._get_section(doc, abs_cn_h1 + 1, abs_cn_ul)
+        assert_warning(conts_cn[-1] == Paragraph([Run(RunType.TEXT, "关键词：")]),
                        '摘要应该以"关键词："后接关键词列表结尾')
         self.conts_zh_CN = conts_cn[:-1]
-        self.keywords_zh_CN = [rbk(i.text)
-                               for i in abs_cn_h1.find_next_sibling("ul").find_all("li")]
+        self.keywords_zh_CN = [rbk(get_text(i))
+                               for i in doc[abs_cn_ul].iter("li")]
         self.title_zh_CN = ""
 
         # Abstract
-        abs_en_h1 = soup.find("h1", string=re_space("Abstract"))
-        abs_en_ul = abs_en_h1.find_next_sibling("ul")
-        conts_en = self._get_content_until(abs_en_h1.next_sibling, abs_en_ul)
-        assert_warning(conts_en[-1] == ("p", [{"type": "text", "text": "Key Words:"}]),
+        abs_en_h1 = doc.find_h1("Abstract")
+        abs_en_ul = doc.find("ul", start=abs_en_h1 + 1)
+        conts_en = self._get_section(doc, abs_en_h1 + 1, abs_en_ul)
+        assert_warning(conts_en[-1] == Paragraph([Run(RunType.TEXT, "Key Words:")]),
                        'Abstract应该以"Key Words:"后接关键词列表结尾')
         self.conts_en = conts_en[:-1]
-        self.keywords_en = [rbk(i.text)
-                            for i in abs_en_h1.find_next_sibling("ul").find_all("li")]
+        self.keywords_en = [rbk(get_text(i))
+                            for i in doc[abs_en_ul].iter("li")]
         self.title_en = ""
 
+    def _get_content_lists(self) -> list:
+        return []  # 以纯文本渲染
+
     def _block_load_contents(self):
         self.block = word.Abstract()
         self.block.set_title(self.title_zh_CN,
@@ -72,22 +76,25 @@ class AbsPart(PaperPart):
 
 
 class IntroPart(PaperPart):
-    def load_contents(self, soup: BeautifulSoup):
-        intro_h1 = soup.find("h1", string=re_space("引言"))
-        conts = self._get_content_until(intro_h1.next_sibling,
-                                        soup.find("h1", string=re_space("正文")))
+    def load_contents(self, doc: MDDocument):
+        intro_h1 = doc.find_h1("引言")
+        conts = self._get_section(doc, intro_h1 + 1,
+                                  doc.find_h1("正文"))
         self.contents = conts
 
+    def _get_content_lists(self) -> list:
+        return []  # 以纯文本渲染
+
     def _block_load_contents(self):
         self.block = word.Introduction()
         self.block.add_text(assemble_ps(self.contents))
 
 
 class MainPart(PaperPart):
-    def load_contents(self, soup: BeautifulSoup):
-        main_h1 = soup.find("h1", string=re_space("正文"))
-        conts = self._get_content_until(main_h1.next_sibling,
-                                        soup.find("h1", string=re_space("结论")))
+    def load_contents(self, doc: MDDocument):
+        main_h1 = doc.find_h1("正文")
+        conts = self._get_section(doc, main_h1 + 1,
+                                  doc.find_h1("结论"))
         self.contents = conts
 
     def _block_load_contents(self):
@@ -96,61 +103,68 @@ class MainPart(PaperPart):
 
 
 class ConcPart(PaperPart):
-    def load_contents(self, soup: BeautifulSoup):
-        conclusion_h1 = soup.find("h1", string=re_space("结论"))
+    def load_contents(self, doc: MDDocument):
+        conclusion_h1 = doc.find_h1("结论")
         if conclusion_h1 == None:
-            conclusion_h1 = soup.find("h1", string=re_space("设计总结"))
+            conclusion_h1 = doc.find_h1("设计总结")
         assert_error(conclusion_h1 != None, "应该有结论或设计总结")
-        conts = self._get_content_until(conclusion_h1.next_sibling,
-                                        soup.find("h1", string=re_space("参考文献")))
+        conts = self._get_section(doc, conclusion_h1 + 1,
+                                  doc.find_h1("参考文献"))
         self.contents = conts
-        headline = rbk(conclusion_h1.text)
+        headline = rbk(get_text(doc[conclusion_h1]))
         assert_warning(headline in ["结论", "设计总结"],
                        "结论部分的标题应该是结论/设计总结: "+headline)
         if headline == "结论":
             headline = "结    论"
         self.headline = headline
 
+    def _get_content_lists(self) -> list:
+        return []  # 以纯文本渲染
+
     def _block_load_contents(self):
         self.block = word.Conclusion()
         self.block.add_text(assemble_ps(self.contents))
 
-    def render(self):
-        self._block_load_contents()
-        self.block.render_template(self.headline)
+    def render(self, ctx: word.DocContext = None):
+        self.block.render_template(self.headline, ctx=ctx)
+
+    def build(self, ctx: word.DocContext = None):
+        self.block.build_template(self.headline, ctx=ctx)
 
 
 class RefPart(PaperPart):
+    # BibTeX文件名 -> (修改时间和大小, 解析、格式化后的条目)，同一进程中多次编译时复用
+    __bibs: Dict[str, Tuple[List[int], Dict[str, str]]] = {}
+
     def __init__(self):
         super().__init__()
         self.ref_map: Dict[str, str] = {}
         self.ref_list: List[str] = []
 
-    def load_contents(self, soup: BeautifulSoup):
-        reference_h1 = soup.find("h1", string=re_space("参考文献"))
-        until_h1 = until_h1 = soup.find("h1", string=re.compile("^ *附录"))
-        if until_h1 == None:
-            until_h1 = soup.find("h1", string=re_space("修改记录"))
+    def load_contents(self, doc: MDDocument):
+        reference_h1 = doc.find_h1("参考文献")
+        appendix_h1s = doc.find_h1s("附录")
+        if appendix_h1s:
+            until_h1 = appendix_h1s[0]
+        else:
+            until_h1 = doc.find_h1("修改记录")
 
         self.bib_path = ""
         refs: List[str] = []
 
-        cur = reference_h1.next_sibling
-        while cur != until_h1:
-            if cur.name != "p":
-                cur = cur.next_sibling
+        for cur in doc[reference_h1 + 1:until_h1]:
+            if cur.tag != "p":
                 continue
-            for i in cur.children:
-                if i.name == "code":
-                    text = i.text.split("\n")
+            for i in cur:
+                if i.tag == "code":
+                    text = get_text(i).split("\n")
                     if text[0] == "literature":
                         refs += text[1:]
                     elif text[0] == "bib":
                         bib_path = os.path.join(self.file_dir, text[1])
                         self.bib_path = bib_path
                     else:
-                        log_error("这啥? " + i)
-            cur = cur.next_sibling
+                        log_error("这啥? " + get_text(i))
 
         for ref_item in refs:
             pos = ref_item.find("]")
@@ -255,6 +269,10 @@ class RefPart(PaperPart):
     def _load_bib(self) -> Dict[str, str]:
         if self.bib_path == "":
             return {}
+        stamp = _file_stamp(self.bib_path)
+        cached = self.__bibs.get(self.bib_path)
+        if cached != None and cached[0] == stamp:
+            return dict(cached[1])
         with open(self.bib_path) as bibtex_file:
             parser = BibTexParser(common_strings=True,
                                   ignore_nonstandard_types=False)
@@ -262,7 +280,14 @@ class RefPart(PaperPart):
         ref_map = {}
         for item in bib_database.entries:
             ref_map["@"+item["ID"]] = self._ref_GB_T_7714_2005(item)
-        return ref_map
+        self.__bibs[self.bib_path] = (stamp, ref_map)
+        return dict(ref_map)
+
+    def get_sources(self) -> List[str]:
+        sources = super().get_sources()
+        if self.bib_path != "":
+            sources.append(self.bib_path)
+        return sources
 
     def compile(self):
         super().compile()
@@ -285,11 +310,12 @@ class RefPart(PaperPart):
             if ali in self.ref_map:
                 self.ref_list.append(
                     "[{}] {}".format(index, self.ref_map[ali]))
-        self.contents = [("p", [{"type": "text", "text": text}])
+        self.contents = [Paragraph([Run(RunType.TEXT, text)])
                          for text in self.ref_list]
 
 
 class AppenPart(PaperPart):
+    @ir_class
     class AppenOne:
         def __init__(self, title: str, conts):
             self.title = title
@@ -299,21 +325,22 @@ class AppenPart(PaperPart):
         super().__init__()
         self.appens: List[self.AppenOne] = []
 
-    def load_contents(self, soup: BeautifulSoup):
-        appendix_h1s = soup.find_all("h1", string=re.compile("^ *附录"))
-        appendix_h1s.append(soup.find("h1", string=re_space("修改记录")))
+    def load_contents(self, doc: MDDocument):
+        appendix_h1s = doc.find_h1s("附录")
+        appendix_h1s.append(doc.find_h1("修改记录"))
         appens = []
         for i in range(0, len(appendix_h1s)-1):
-            conts = self._get_content_until(appendix_h1s[i].next_sibling,
-                                            appendix_h1s[i+1])
-            title = self._process_title(appendix_h1s[i].text, i)
+            conts = self._get_section(doc, appendix_h1s[i] + 1,
+                                      appendix_h1s[i+1])
+            title = self._process_title(get_text(doc[appendix_h1s[i]]), i)
             appens.append(self.AppenOne(title, conts))
         self.appens = appens
 
     def _block_load_contents(self):
         self.block = word.Appendixes()
-        for appen in self.appens:
-            self.block.add_appendix(appen.title)
+        for i, appen in enumerate(self.appens):
+            block = self.block.add_appendix(appen.title)
+            self.units.append((block, self.appens, i, i + 1))
             self._block_load_body(appen.contents)
 
     def _process_title(self, title: str, index: int):
@@ -327,6 +354,9 @@ class AppenPart(PaperPart):
         title = title[:3] + "  " + rbk(title[4:])
         return title
 
+    def _get_content_lists(self) -> list:
+        return [appen.contents for appen in self.appens]
+
     def get_ref_items(self):
         ref_items_list = [self._get_ref_items(appen.contents, appen.title[2])
                           for appen in self.appens]
@@ -334,10 +364,10 @@ class AppenPart(PaperPart):
 
 
 class RecordPart(PaperPart):
-    def load_contents(self, soup: BeautifulSoup):
-        mod_record_h1 = soup.find("h1", string=re_space("修改记录"))
-        conts = self._get_content_until(mod_record_h1.next_sibling,
-                                        soup.find("h1", string=re_space("致谢")))
+    def load_contents(self, doc: MDDocument):
+        mod_record_h1 = doc.find_h1("修改记录")
+        conts = self._get_section(doc, mod_record_h1 + 1,
+                                  doc.find_h1("致谢"))
         self.contents = conts
 
     def _block_load_contents(self):
@@ -346,9 +376,12 @@ class RecordPart(PaperPart):
 
 
 class ThanksPart(PaperPart):
-    def load_contents(self, soup: BeautifulSoup):
-        thanks_h1 = soup.find("h1", string=re_space("致谢"))
-        self.contents = self._get_content_from(thanks_h1.next_sibling)
+    def load_contents(self, doc: MDDocument):
+        thanks_h1 = doc.find_h1("致谢")
+        self.contents = self._get_section(doc, thanks_h1 + 1)
+
+    def _get_content_lists(self) -> list:
+        return []  # 以纯文本渲染
 
     def _block_load_contents(self):
         self.block = word.Acknowledgments()
@@ -358,6 +391,9 @@ class ThanksPart(PaperPart):
 # 论文
 
 class GraduationPaper(Paper):
+    body_anchor = ("引    言", "Heading 1")
+    placeholders = word.PLACEHOLDERS
+
     def __init__(self):
         super().__init__()
         self.meta = MetaPart()
@@ -382,8 +418,8 @@ class GraduationPaper(Paper):
             self.thanks
         ]
 
-    def compile(self):
-        super().compile()
+    def _compile(self, diags: Diagnostics, jobs: int = 1):
+        super()._compile(diags, jobs)
 
         self.abs.title_zh_CN = self.meta.title_zh_CN
         self.abs.title_en = self.meta.title_en
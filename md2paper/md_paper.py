@@ -1,34 +1,138 @@
 from io import BytesIO, StringIO
 import markdown
-from bs4 import BeautifulSoup, Comment
 import logging
 import re
-from functools import reduce
+from functools import reduce, lru_cache
 import os
+import json
+import gzip
+import hashlib
+import datetime
 import bibtexparser
 from bibtexparser.bparser import BibTexParser
-from typing import Dict, List, Union
+from typing import Dict, List, Tuple, Union
+from enum import Enum
 import pypandoc
 import docx
-import tempfile
-from md2paper.mdext import MDExt
+import subprocess
+import zipfile
+from copy import deepcopy
+from contextvars import ContextVar
+from lxml import etree
+from xml.etree import ElementTree
+from xml.etree.ElementTree import Element
+from docx.oxml.ns import qn
+from md2paper.mdext import MDExt, MathBlockProcessor
+from md2paper.pandoc_server import PandocServer
 import md2paper.dut_paper as word
 
 debug = False
+# 设置后公式交给长期运行的pandoc server转换，见use_pandoc_server
+pandoc_server: PandocServer = None
 
 
 # 检查
+# 检查中发现的问题记为Diagnostic，收集在当前的Diagnostics中；
+# 错误抛出PaperError，不退出进程，调用者（命令行、监视、批量转换）自行决定如何处理
+
+class Diagnostic:
+    WARNING = "warning"
+    ERROR = "error"
+
+    # line: 所在小节标题在markdown中的行号，section: 小节标题
+    # index: 所在块在MDDocument中的下标
+    def __init__(self, level: str, message: str, path: str = "", part: str = "",
+                 line: int = None, section: str = "", index: int = None):
+        self.level = level
+        self.message = message
+        self.path = path
+        self.part = part
+        self.line = line
+        self.section = section
+        self.index = index
+
+    def __str__(self):
+        where = self.path
+        if self.line != None:
+            where += ":{}".format(self.line)
+        if self.section != "":
+            where += " [{}]".format(self.section)
+        elif self.part != "":
+            where += " [{}]".format(self.part)
+        return (where.strip() + ": " if where != "" else "") + self.message
+
+    def __repr__(self):
+        return "Diagnostic({!r}, {!r})".format(self.level, str(self))
+
+
+class PaperError(Exception):
+    def __init__(self, diagnostic: Diagnostic):
+        super().__init__(str(diagnostic))
+        self.diagnostic = diagnostic
+
+
+class Diagnostics:
+    # 一次load_contents或compile中的诊断信息，与DocContext一样按线程/协程保存
+    __context: ContextVar["Diagnostics"] = ContextVar("md2paper_diagnostics")
+
+    def __init__(self, path: str = "", doc: "MDDocument" = None):
+        self.items: List[Diagnostic] = []
+        self.path = path
+        self.doc = doc
+        self.part = ""  # 正在处理的部分
+        self.index: int = None  # 正在处理的块在doc中的下标
+        self.section = ""  # 没有doc或找不到块时使用的小节标题
+
+    @classmethod
+    def current(cls) -> Union["Diagnostics", None]:
+        return cls.__context.get(None)
+
+    @classmethod
+    def set_current(cls, diags: "Diagnostics"):
+        return cls.__context.set(diags)
+
+    @classmethod
+    def reset_current(cls, token):
+        cls.__context.reset(token)
+
+    # 标题为section的块的下标，section中的连续空白当作一个空格
+    def find_section(self, section: str) -> Union[int, None]:
+        if self.doc == None or section == "":
+            return None
+        for i, (_, title) in enumerate(self.doc.locations):
+            if " ".join(title.split()) == section:
+                return i
+        return None
+
+    def report(self, level: str, message: str, index: int = None) -> Diagnostic:
+        if index == None:
+            index = self.index
+        line, section = None, self.section
+        if self.doc != None and index != None:
+            line, section = self.doc.locations[index]
+        diag = Diagnostic(level, message, self.path, self.part, line, section, index)
+        self.items.append(diag)
+        return diag
+
+
+def _report(level: str, s: str) -> Diagnostic:
+    diags = Diagnostics.current()
+    if diags == None:
+        return Diagnostic(level, s)
+    return diags.report(level, s)
+
 
 def assert_warning(e: bool, s: str):
     if not e:
-        logging.warning(s)
+        logging.warning(str(_report(Diagnostic.WARNING, s)))
     return e
 
 
 def assert_error(e: bool, s: str):
     if not e:
-        logging.error(s)
-        exit(-1)
+        diag = _report(Diagnostic.ERROR, s)
+        logging.error(str(diag))
+        raise PaperError(diag)
     return e
 
 
@@ -42,38 +146,38 @@ def log_warning(s: str):
 
 # 处理文本
 
+CN_CHAR = u'[\u4e00-\u9fa5。，：《》、（）“”‘’\u00a0]'
+# 中文字符前后的连续空格
+re_cn_blank = re.compile(u' +(?={0})|(?<={0}) +'.format(CN_CHAR))
+# 删除换行符
+NEWLINE_TABLE = str.maketrans({"\n": " ", "\r": None})
+RBK_CACHE_LEN = 64  # 不超过此长度的文本（如表格单元格）缓存结果
+
+
+def _rbk(text: str) -> str:
+    text = text.translate(NEWLINE_TABLE).strip(' ')
+    text = re_cn_blank.sub("", text)
+    return text.replace("\u00a0", " ")  # 替换为普通空格
+
+
+_rbk_cached = lru_cache(maxsize=4096)(_rbk)
+
+
 def rbk(text: str):  # remove_blank
-    # 删除换行符
-    text = text.replace("\n", " ")
-    text = text.replace("\r", "")
-    text = text.strip(' ')
-
-    cn_char = u'[\u4e00-\u9fa5。，：《》、（）“”‘’\u00a0]'
-    # 中文字符后空格
-    should_replace_list = re.compile(
-        cn_char + u' +').findall(text)
-    # 中文字符前空格
-    should_replace_list += re.compile(
-        u' +' + cn_char).findall(text)
-    # 删除空格
-    for i in should_replace_list:
-        if i == u' ':
-            continue
-        new_i = i.strip(" ")
-        text = text.replace(i, new_i)
-    text = text.replace("\u00a0", " ")  # 替换为普通空格
-    return text
+    if len(text) <= RBK_CACHE_LEN:
+        return _rbk_cached(text)
+    return _rbk(text)
 
 
 def raw_text(runs):
-    strs = [i["text"] for i in runs]
+    strs = [i.text for i in runs]
     return reduce(lambda x, y: x+y, strs)
 
 
 def assemble_ps(ps):
     strs = []
-    for (_, runs) in ps:
-        strs.append(raw_text(runs))
+    for p in ps:
+        strs.append(raw_text(p.runs))
     return reduce(lambda x, y: x+"\n"+y, strs)
 
 
@@ -87,10 +191,83 @@ def ref_items_list_unfold(ref_items_list: list):
     return unfold_ref_items
 
 
+def get_text(el: Element) -> str:
+    return "".join(el.itertext())
+
+
+def get_string(el: Element) -> Union[str, None]:
+    # 元素只有唯一的文本时返回该文本，同bs4的.string
+    if len(el) == 0:
+        return el.text or ""
+    if len(el) == 1 and not el.text and not el[0].tail:
+        return get_string(el[0])
+    return None
+
+
+def iter_children(el: Element):
+    # 依次给出元素内的文本和子元素，同bs4的.children
+    if el.text:
+        yield el.text
+    for child in el:
+        yield child
+        if child.tail:
+            yield child.tail
+
+
+re_math_fence_start = re.compile(MathBlockProcessor.RE_FENCE_START)
+re_math_fence_end = re.compile(MathBlockProcessor.RE_FENCE_END)
+re_atx_heading = re.compile(r'^(#{1,6})(?!#)')
+re_setext_heading = re.compile(r'^(=+|-+) *$')
+
+
+def iter_headings(lines: List[str]):
+    # 依次给出标题所在的行（从0开始）和标题级别
+    # 跳过行间公式和html注释中的内容
+    in_math = False
+    in_comment = False
+    prev_blank = True
+    prev_starts_block = False  # 上一行是否是块的第一行
+    for i, line in enumerate(lines):
+        starts_block = prev_blank
+        if in_comment:
+            in_comment = "-->" not in line
+        elif in_math:
+            in_math = not re_math_fence_end.search(line)
+        elif prev_blank and re_math_fence_start.match(line):
+            fence = re_math_fence_start.match(line)
+            in_math = not re_math_fence_end.search(line[fence.end():])
+        elif prev_blank and line.startswith("<!--"):
+            in_comment = "-->" not in line
+        elif re_atx_heading.match(line):
+            yield i, len(re_atx_heading.match(line).group(1))
+        elif re_setext_heading.match(line) and not prev_blank and prev_starts_block:
+            # 上一行是标题，同markdown的setext标题只能在块的开头
+            yield i - 1, 1 if line[0] == "=" else 2
+        prev_blank = line.strip() == ""
+        prev_starts_block = starts_block
+
+
+def split_chapters(md_file: str) -> List[str]:
+    # 在一级标题处把markdown分成若干章，各章单独解析的结果与整体解析相同
+    lines = md_file.split("\n")
+    starts = [0]
+    for i, level in iter_headings(lines):
+        if level == 1 and i > starts[-1]:
+            starts.append(i)
+    starts.append(len(lines))
+    return ["\n".join(lines[a:b]) for a, b in zip(starts, starts[1:])]
+
+
+def is_heading(el: Element) -> bool:
+    return len(el.tag) == 2 and el.tag[0] == "h" and el.tag[1].isdigit()
+
+
+@lru_cache(maxsize=None)
 def re_space(s: str):
     return re.compile("^ *{} *".format(s))
 
 
+@lru_cache(maxsize=None)
 def check_pandoc() -> bool:
     try:
         pypandoc._ensure_pandoc_path(quiet=True)
@@ -99,12 +276,237 @@ def check_pandoc() -> bool:
     return True
 
 
+def use_pandoc_server(url: str, pool_size: int = 4, max_in_flight: int = 8):
+    global pandoc_server
+    if pandoc_server != None:
+        pandoc_server.close()
+    pandoc_server = PandocServer(url, pool_size, max_in_flight)
+    get_formula_backend.cache_clear()
+
+
+@lru_cache(maxsize=None)
+def get_formula_backend() -> str:
+    # 公式转换使用的后端，不同后端转换的OMML不同
+    if pandoc_server != None:
+        version = pandoc_server.get_version()
+        if version != None:
+            return "pandoc-server " + version
+    elif check_pandoc():
+        return "pandoc " + get_pandoc_version()
+    return "xslt " + word.get_xslt_version()
+
+
+def get_pandoc_version() -> str:
+    return pypandoc.get_pandoc_version()
+
+
+def pandoc_to_docx(md: str) -> bytes:
+    # pandoc把docx直接写到标准输出，不经过临时文件
+    result = subprocess.run([pypandoc.get_pandoc_path(),
+                             "-f", "markdown", "-t", "docx", "-o", "-"],
+                            input=md.encode("utf-8"),
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise RuntimeError("pandoc failed: " +
+                           result.stderr.decode("utf-8", "replace"))
+    return result.stdout
+
+
+def omml_from_docx(data: bytes) -> List[Union[str, None]]:
+    # 取出正文每个段落中的公式，段落中没有公式时为None
+    with zipfile.ZipFile(BytesIO(data)) as docx_zip:
+        root = etree.fromstring(docx_zip.read("word/document.xml"))
+    word_maths = []
+    for p in root.find(qn("w:body")).iterchildren(qn("w:p")):
+        oMath = p.find(".//" + qn("m:oMath"))
+        if oMath is None:
+            word_maths.append(None)
+            continue
+        oMath = deepcopy(oMath)
+        etree.cleanup_namespaces(oMath)
+        word_maths.append(etree.tostring(oMath, encoding="unicode"))
+    return word_maths
+
+
 # 数据类型
 
-class PLike:
-    def __init__(self, name, runs):
-        self.name = name
+class MDDocument:
+    # markdown解析出的顶层块元素，各部分用下标表示起止位置
+    # chapters: 各章的(起始下标, 结束下标, 源文本的hash)，用于按章缓存
+    # heading_lines: 各个标题块在markdown中的行号
+    def __init__(self, root: Element, chapters: List[Tuple[int, int, str]] = None,
+                 heading_lines: List[int] = None):
+        self.root = root
+        self.blocks: List[Element] = list(root)
+        if chapters == None:
+            chapters = [(0, len(self.blocks), "")]
+        self.chapters = chapters
+        # 各块所在的小节(标题的行号, 标题)，用于诊断信息
+        self.locations: List[Tuple[Union[int, None], str]] = []
+        location = (None, "")
+        headings = iter(heading_lines or [])
+        for el in self.blocks:
+            if is_heading(el):
+                location = (next(headings, None), get_text(el).strip(" "))
+            self.locations.append(location)
+        self.cache_tag = ""  # 影响编译结果的其他条件，如公式转换后端
+        # 本次重新编译的段，编译后保存到ChapterCache：(key, 内容, 标题编号, 警告)
+        self.pending: List[Tuple[str, list, List[int], list]] = []
+        # 一级标题索引，各部分按标题查找起止位置时不必遍历文档
+        self.h1s: List[Tuple[str, int]] = []  # (去掉首尾空格的标题, 下标)
+        self.h1_index: Dict[str, int] = {}
+        for i, el in enumerate(self.blocks):
+            if el.tag != "h1":
+                continue
+            title = get_string(el)
+            if title == None:
+                continue
+            title = title.strip(" ")
+            self.h1s.append((title, i))
+            self.h1_index.setdefault(title, i)
+
+    def __getitem__(self, index):
+        return self.blocks[index]
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def find_all(self, tag: str, string: re.Pattern = None, start: int = 0) -> List[int]:
+        res = []
+        for i in range(start, len(self.blocks)):
+            el = self.blocks[i]
+            if el.tag != tag:
+                continue
+            if string != None:
+                text = get_string(el)
+                if text == None or not string.search(text):
+                    continue
+            res.append(i)
+        return res
+
+    def find(self, tag: str, string: re.Pattern = None, start: int = 0) -> Union[int, None]:
+        res = self.find_all(tag, string, start)
+        return res[0] if res else None
+
+    def find_h1(self, title: str) -> Union[int, None]:
+        # 与re_space相同，标题以title开头即可，如“结论与展望”
+        if title in self.h1_index:
+            return self.h1_index[title]
+        res = self.find_h1s(title)
+        return res[0] if res else None
+
+    def find_h1s(self, prefix: str) -> List[int]:
+        # 标题以prefix开头的一级标题，如各个附录
+        return [i for title, i in self.h1s if title.startswith(prefix)]
+
+    def segments(self, start: int, end: Union[int, None]):
+        # 把[start, end)按章分段，给出(段起始, 段结束, 章起始, 章的hash)
+        if end == None:
+            end = len(self.blocks)
+        for ch_start, ch_end, ch_hash in self.chapters:
+            seg_start = max(start, ch_start)
+            seg_end = min(end, ch_end)
+            if seg_start < seg_end:
+                yield seg_start, seg_end, ch_start, ch_hash
+
+
+# 中间表示：每个模块的内容是块的列表，段落由run组成
+# 使用__slots__，大论文中有大量的run
+
+IR_CLASSES: Dict[str, type] = {}  # 可以序列化的类，见Paper.save_ir
+
+
+def ir_class(cls):
+    IR_CLASSES[cls.__name__] = cls
+    return cls
+
+
+class RunType(Enum):
+    TEXT = "text"
+    STRONG = "strong"
+    EM = "em"
+    STRONG_EM = "strong-em"
+    MATH_INLINE = "math-inline"
+    REF = "ref"
+
+
+RUN_STYLES = {
+    RunType.TEXT: word.Run.Normal,
+    RunType.STRONG: word.Run.Bold,
+    RunType.EM: word.Run.Italics,
+    RunType.STRONG_EM: word.Run.Italics | word.Run.Bold,
+    RunType.MATH_INLINE: word.Run.Formula,
+    RunType.REF: word.Run.Superscript
+}
+
+
+@ir_class
+class Run:
+    __slots__ = ("type", "text", "need_trans")
+
+    # need_trans: 公式还是LaTeX，需要转换为OMML
+    def __init__(self, type: RunType, text: str, need_trans: bool = False):
+        self.type = type
+        self.text = text
+        self.need_trans = need_trans
+
+    def __eq__(self, other):
+        return isinstance(other, Run) and \
+            (self.type, self.text, self.need_trans) == \
+            (other.type, other.text, other.need_trans)
+
+    def __repr__(self):
+        return "Run({}, {!r})".format(self.type.value, self.text)
+
+    def as_word_run(self) -> word.Run:
+        return word.Run(self.text, RUN_STYLES[self.type],
+                        transform_required=self.need_trans)
+
+
+class Block:
+    __slots__ = ()
+
+    def add_to(self, block: word.Component): pass
+
+
+@ir_class
+class Heading(Block):
+    __slots__ = ("level", "text")
+
+    def __init__(self, level: int, text: str):
+        self.level = level
+        self.text = text
+
+    def add_to(self, block: word.Component):
+        if self.level == 1:
+            block.add_chapter(self.text)
+        elif self.level == 2:
+            block.add_section(self.text)
+        elif self.level == 3:
+            block.add_subsection(self.text)
+        else:
+            print("还没实现now", "h" + str(self.level))
+
+
+@ir_class
+class Paragraph(Block):
+    __slots__ = ("runs", "list_level")
+
+    # list_level: 列表项所在的层次，4为一级列表，5为二级列表，0不是列表项
+    def __init__(self, runs: List[Run], list_level: int = 0):
         self.runs = runs
+        self.list_level = list_level
+
+    def __eq__(self, other):
+        return isinstance(other, Paragraph) and \
+            self.runs == other.runs and self.list_level == other.list_level
+
+    def __repr__(self):
+        return "Paragraph({!r})".format(self.runs)
+
+    @property
+    def name(self) -> str:
+        return "fh" + str(self.list_level) if self.list_level else "p"
 
     def as_word_text(self):
         if not debug:
@@ -112,26 +514,55 @@ class PLike:
         else:
             para = word.Text(self.name)
         for run in self.runs:
-            if run["type"] == "text":
-                para.add_run(word.Run(run["text"], word.Run.Normal))
-            elif run["type"] == "strong":
-                para.add_run(word.Run(run["text"], word.Run.Bold))
-            elif run["type"] == "em":
-                para.add_run(word.Run(run["text"], word.Run.Italics))
-            elif run["type"] == "strong-em":
-                para.add_run(word.Run(run["text"],
-                                      word.Run.Italics | word.Run.Bold))
-            elif run["type"] == "math-inline":
-                para.add_run(word.Run(run["text"],
-                                      word.Run.Formula,
-                                      transform_required=run["need-trans"]))
-            elif run["type"] == "ref":
-                para.add_run(
-                    word.Run(run["text"], word.Run.Superscript))
-            else:
-                print("还没实现now", self.name)
+            para.add_run(run.as_word_run())
         return para
 
+    def add_to(self, block: word.Component):
+        block.add_text([self.as_word_text()])
+
+
+@ir_class
+class Image(Block):
+    __slots__ = ("alias", "title", "ratio", "src")
+
+    def __init__(self, alias: str, title: str, ratio: float, src: str):
+        self.alias = alias
+        self.title = title
+        self.ratio = ratio
+        self.src = src
+
+    def add_to(self, block: word.Component):
+        block.add_text([word.Image(
+            [word.ImageData(self.src, self.title, self.ratio)])])
+
+
+@ir_class
+class Table(Block):
+    __slots__ = ("alias", "title", "rows")
+
+    def __init__(self, alias: str, title: str, rows: List["TableRow"]):
+        self.alias = alias
+        self.title = title
+        self.rows = rows
+
+    def add_to(self, block: word.Component):
+        data = [row.as_word_row() for row in self.rows]
+        block.add_text([word.Table(self.title, data)])
+
+
+@ir_class
+class Math(Block):
+    __slots__ = ("alias", "title", "text", "need_trans")
+
+    def __init__(self, alias: str, title: str, text: str, need_trans: bool = True):
+        self.alias = alias
+        self.title = title
+        self.text = text
+        self.need_trans = need_trans
+
+    def add_to(self, block: word.Component):
+        block.add_text([word.Formula(self.title, self.text, self.need_trans)])
+
 
 class RefItem:
     IMG = "img"
@@ -145,8 +576,11 @@ class RefItem:
         self.type = type
 
 
+@ir_class
 class TableRow:
-    def __init__(self, ps, top_border=False):
+    __slots__ = ("ps", "top_border")
+
+    def __init__(self, ps: List[Union[Paragraph, None]], top_border=False):
         self.ps = ps
         self.top_border = top_border
 
@@ -155,7 +589,7 @@ class TableRow:
             if p == None:
                 return False
             cnt = 0
-            for i in raw_text(p[1]):
+            for i in raw_text(p.runs):
                 if i != '-':
                     return False
                 else:
@@ -165,7 +599,7 @@ class TableRow:
         return True
 
     def as_word_row(self):
-        return word.Row([PLike(p[0], p[1]).as_word_text() if p != None else None for p in self.ps], self.top_border)
+        return word.Row([p.as_word_text() if p != None else None for p in self.ps], self.top_border)
 
 
 # 每个论文模块
@@ -175,44 +609,82 @@ class PaperPart:
         self.contents = []
         self.block: word.Component = None
         self.file_dir: str = ""
+        # 增量渲染的单元(block, 所在列表, 起始下标, 结束下标)，在建立block时记录
+        self.units: List[Tuple[word.Block, list, int, int]] = []
 
     def set_file_dir(self, file_dir: str):
         self.file_dir = file_dir
 
     # 获取内容
 
-    def load_contents(self, soup: BeautifulSoup): pass
-
-    def _get_content_until(self, cur, until, ollevel=4):
+    def load_contents(self, doc: MDDocument): pass
+
+    def _get_section(self, doc: MDDocument, start: int, end: Union[int, None] = None):
+        # 逐章处理[start, end)中的块，内容未改动的章直接使用缓存中编译好的中间表示
+        # 使用缓存时重新报告编译这一段时的警告
+        diags = Diagnostics.current()
+        if diags == None:
+            diags = Diagnostics(doc=doc)
+            token = Diagnostics.set_current(diags)
+            try:
+                return self._get_section(doc, start, end)
+            finally:
+                Diagnostics.reset_current(token)
         conts = []
         head_counter = [0]
-        while cur != until:
-            if cur.name == None:
-                cur = cur.next_sibling
-                continue
-            if cur.name[0] == "h":  # h1 h2 h3
-                head_counter, pair = self._process_headline(head_counter,
-                                                            cur.name, cur.text)
-                conts.append(pair)
-            elif cur.name == "p":
+        for seg_start, seg_end, ch_start, ch_hash in doc.segments(start, end):
+            key = ChapterCache.get_key(ch_hash, seg_start - ch_start, seg_end - ch_start,
+                                       type(self).__name__, head_counter,
+                                       self.file_dir, doc.cache_tag)
+            cached = ChapterCache.get(key) if ch_hash != "" else None
+            if cached != None:
+                seg_conts, head_counter, warnings = cached
+                for level, message, offset in warnings:
+                    diag = diags.report(level, message, ch_start + offset)
+                    logging.warning(str(diag))
+            else:
+                n = len(diags.items)
+                seg_conts, head_counter = self._process_blocks(doc[seg_start:seg_end],
+                                                               head_counter, start=seg_start)
+                warnings = [[i.level, i.message, i.index - ch_start]
+                            for i in diags.items[n:]]
+                doc.pending.append((key, seg_conts, list(head_counter), warnings))
+            conts += seg_conts
+        return conts
+
+    def _get_contents(self, blocks: List[Element], ollevel=4):
+        conts, _ = self._process_blocks(blocks, [0], ollevel)
+        return conts
+
+    # start: blocks在文档中的起始下标，用于定位诊断信息
+    def _process_blocks(self, blocks: List[Element], head_counter: List[int], ollevel=4,
+                        start: int = None):
+        conts = []
+        diags = Diagnostics.current()
+        for i, cur in enumerate(blocks):
+            if start != None and diags != None:
+                diags.index = start + i
+            if cur.tag[0] == "h":  # h1 h2 h3
+                head_counter, heading = self._process_headline(head_counter,
+                                                               cur.tag, get_text(cur))
+                conts.append(heading)
+            elif cur.tag == "p":
                 conts += self._process_ps(cur)
-            elif cur.name == "table":
-                table_name = raw_text(conts[-1][1])
+            elif cur.tag == "table":
+                table_name = raw_text(conts[-1].runs)
                 conts = conts[:-1]
                 conts.append(self._process_table(table_name, cur))
-            elif cur.name == "ol":
+            elif cur.tag == "ol":
                 conts += self._process_ol(cur, ollevel)
-            elif cur.name == "math":
-                math_title = raw_text(conts[-1][1])
+            elif cur.tag == "math":
+                math_title = raw_text(conts[-1].runs)
                 conts = conts[:-1]
                 conts.append(self._process_math(math_title, cur))
             else:
-                log_error("这是啥？" + cur.prettify())
-            cur = cur.next_sibling
-        return conts
-
-    def _get_content_from(self, cur, ollevel=4):
-        return self._get_content_until(cur, None, ollevel)
+                log_error("这是啥？" + ElementTree.tostring(cur, encoding="unicode"))
+        if start != None and diags != None:
+            diags.index = None
+        return conts, head_counter
 
     # 处理标签
 
@@ -240,64 +712,60 @@ class PaperPart:
                        "MD 中编号后应该有一个空格: {} {}".format(h_label, headline))
         headline = headline[:len(index)] + "  " + rbk(headline[len(index)+1:])
 
-        return head_counter, (h_label, headline)
+        return head_counter, Heading(level, headline)
 
     def _process_ps(self, p, ollevel=4):
         ps = []
         data = []
-        for i in p.children:
-            if i.name == None:
-                if not hasattr(i, "text"):
-                    setattr(i, "text", str(i))
-                if i.text == "\n":
+        for i in iter_children(p):
+            if isinstance(i, str):
+                if i == "\n":
                     continue
-                data.append({"type": "text", "text": rbk(i.text)})
-            elif i.name == "strong":
-                assert_warning(len(i.contents) == 1, "只允许粗斜体，不允许复杂嵌套")
-                if i.contents[0].name == "em":
-                    data.append({"type": "strong-em", "text": rbk(i.text)})
+                data.append(Run(RunType.TEXT, rbk(i)))
+            elif i.tag == "strong":
+                contents = list(iter_children(i))
+                assert_warning(len(contents) == 1, "只允许粗斜体，不允许复杂嵌套")
+                if not isinstance(contents[0], str) and contents[0].tag == "em":
+                    data.append(Run(RunType.STRONG_EM, rbk(get_text(i))))
                 else:
-                    data.append({"type": "strong", "text": rbk(i.text)})
-            elif i.name == "em":
-                data.append({"type": "em", "text": rbk(i.text)})
-            elif i.name == "math-inline":
-                data.append({"type": "math-inline",
-                             "text": i.text,
-                             "need-trans": True})
-            elif i.name == "ref":
-                data.append({"type": "ref", "text": rbk(i.text)})
+                    data.append(Run(RunType.STRONG, rbk(get_text(i))))
+            elif i.tag == "em":
+                data.append(Run(RunType.EM, rbk(get_text(i))))
+            elif i.tag == "math-inline":
+                data.append(Run(RunType.MATH_INLINE, get_text(i), True))
+            elif i.tag == "ref":
+                data.append(Run(RunType.REF, rbk(get_text(i))))
+            elif i.tag == "html":
+                log_error("不支持的HTML: " + i.get("raw"))
             else:  # 需要分段
                 if data:
-                    ps.append(("p", data))
+                    ps.append(Paragraph(data))
                     data = []
-                if i.name == "br":  # 分段
+                if i.tag == "br":  # 分段
                     pass
-                elif i.name == "img":  # 图片
+                elif i.tag == "img":  # 图片
                     ps.append(self._process_img(i))
-                elif i.name == "ol":
+                elif i.tag == "ol":
                     ps += self._process_ol(i, ollevel)
                 else:
-                    log_error("缺了什么？" + str(i))
+                    log_error("缺了什么？" + ElementTree.tostring(i, encoding="unicode"))
         if data:
-            ps.append(("p", data))
+            ps.append(Paragraph(data))
         return ps
 
     def _process_img(self, img):
-        if img["src"] == "":
+        if img.get("src", "") == "":
             img_path = ""
         else:
-            img_path = os.path.join(self.file_dir, img["src"])
-        ali, title, ratio = self._split_title(img["alt"])
-        return ("img", {"alias": ali,
-                        "title": title,
-                        "ratio": ratio,
-                        "src": img_path})
+            img_path = os.path.join(self.file_dir, img.get("src"))
+        ali, title, ratio = self._split_title(img.get("alt", ""))
+        return Image(ali, title, ratio, img_path)
 
     def _process_table(self, title, table):
         data = []
         # 表头，有上实线
         row = []
-        for th in table.find("thead").find_all("th"):
+        for th in table.find("thead").iter("th"):
             ps = self._process_ps(th)
             if len(ps) == 0:
                 row.append(None)
@@ -308,9 +776,9 @@ class PaperPart:
         data = [TableRow(row, True)]
 
         has_border = True  # 表身第一行有上实线
-        for tr in table.find("tbody").find_all("tr"):
+        for tr in table.find("tbody").iter("tr"):
             row = []
-            for td in tr.find_all("td"):
+            for td in tr.iter("td"):
                 ps = self._process_ps(td)
                 if len(ps) == 0:
                     row.append(None)
@@ -332,42 +800,35 @@ class PaperPart:
                 data.append(tableRow)
 
         ali, title, _ = self._split_title(title)
-        return ("table", {"alias": ali,
-                          "title": title,
-                          "data": data})
+        return Table(ali, title, data)
 
     def _process_lis(self, li, level):
-        if not hasattr(li.contents[0], "text"):
-            setattr(li.contents[0], "text", str(li.contents[0]))
-        if (li.contents[0].text == "\n"):  # <p>
-            conts = self._get_content_from(li.contents[0], level+1)
+        if li.text == "\n":  # <p>
+            conts = self._get_contents(list(li), level+1)
         else:  # text
             conts = self._process_ps(li, level+1)
-        conts[0] = ("fh" + str(level), conts[0][1])
+        conts[0].list_level = level
         return conts
 
     def _process_ol(self, ol, level):
         assert_error(level <= 5, "层次至多两层")
         datas = [self._process_lis(i, level)
-                 for i in ol.find_all("li", recursive=False)]
+                 for i in ol.findall("li")]
         # make index
         for i in range(len(datas)):
             li_data = datas[i][0]
             if level == 4:
-                li_data[1].insert(
-                    0, {"type": "text", "text": "（{}） ".format(i+1)})
+                li_data.runs.insert(
+                    0, Run(RunType.TEXT, "（{}） ".format(i+1)))
             else:
                 assert_warning(i < 20, "层次二不能超过 20 项")
-                li_data[1].insert(
-                    0, {"type": "text", "text": "{} ".format(chr(i+0x2460))})  # get ①②..⑳
+                li_data.runs.insert(
+                    0, Run(RunType.TEXT, "{} ".format(chr(i+0x2460))))  # get ①②..⑳
         data = reduce(lambda x, y: x + y, datas)
         return data
 
     def _process_math(self, title, math):
-        return ("math", {"alias": title,
-                         "title": title,
-                         "need-trans": True,
-                         "text": math.text})
+        return Math(title, title, get_text(math))
 
     def _split_title(self, title: str):
         sp = title.split(':')
@@ -395,60 +856,39 @@ class PaperPart:
 
     def check(self): pass
 
-    def _math_pandoc_word(self):
-        if check_pandoc() == False:
-            return
-
-        tmp_fp = tempfile.NamedTemporaryFile(delete=False)
-        tmp_fp.close()
-        # get math
-        math_list: List[str] = []
-        for name, cont in self.contents:
-            if name == "p":
-                for run in cont:
-                    if run["type"] == "math-inline" and run["text"].strip() != "":
-                        math_list.append(run["text"])
-            elif name == "math" and cont["text"].strip() != "":
-                math_list.append(cont["text"])
-
-        # get word
-        if math_list == []:
-            return
-        md_list = ["${}$".format(i.strip()) for i in math_list]
-        md = reduce(lambda x, y: x+'\n\n'+y, md_list)
-        pypandoc.convert_text(md, "docx", "md", outputfile=tmp_fp.name)
-        doc = docx.Document(tmp_fp.name)
-        paras_xml = [str(i._element.xml) for i in doc.paragraphs]
-        os.unlink(tmp_fp.name)
-        oMath_head = "<m:oMath>"
-        oMath_tail = "</m:oMath>"
-        word_maths = [para_xml[para_xml.find(oMath_head):
-                               para_xml.find(oMath_tail) + len(oMath_tail)]
-                      for para_xml in paras_xml]
-        word_maths_m: List[str] = []
-        for word_math in word_maths:
-            pos = word_math.find('>')
-            word_math = word_math[:pos] + \
-                ' xmlns:m="http://schemas.openxmlformats.org/officeDocument/2006/math"' + \
-                word_math[pos:]
-            word_maths_m.append(word_math)
-
-        # put back
-        count = 0
-        for name, cont in self.contents:
-            if name == "p":
-                for run in cont:
-                    if run["type"] == "math-inline" and run["text"].strip() != "":
-                        run["text"] = word_maths_m[count]
-                        run["need-trans"] = False
-                        count += 1
-            elif name == "math" and cont["text"].strip() != "":
-                cont["text"] = word_maths_m[count]
-                cont["need-trans"] = False
-                count += 1
-
-    def compile(self):
-        self._math_pandoc_word()
+    def compile(self): pass
+
+    def _get_content_lists(self) -> list:
+        # 会逐段渲染的内容列表，其中的公式需要转换为OMML
+        return [self.contents]
+
+    # 除markdown外依赖的文件
+    def get_sources(self) -> List[str]:
+        return _ir_images([v for k, v in vars(self).items()
+                           if k not in IR_SKIP_ATTRS])
+
+    def get_math_items(self) -> List[Union[Run, Math]]:
+        # 收集行内公式的run和行间公式，包括表格中的行内公式
+        return [item for _, item in self._iter_math_items()]
+
+    def _iter_math_items(self):
+        # 依次给出(所在小节的标题, 公式)
+        for conts in self._get_content_lists():
+            section = ""
+            for cont in conts:
+                runs = []
+                if isinstance(cont, Heading):
+                    section = " ".join(cont.text.split())
+                elif isinstance(cont, Paragraph):
+                    runs = cont.runs
+                elif isinstance(cont, Math):
+                    yield section, cont
+                elif isinstance(cont, Table):
+                    runs = [run for table_row in cont.rows for p in table_row.ps
+                            if p != None for run in p.runs]
+                for run in runs:
+                    if run.type == RunType.MATH_INLINE:
+                        yield section, run
 
     def _get_ref_items(self, conts, index_prefix: str = "") -> Dict[str, RefItem]:
         def get_index(index_prefix: str, chapter_cnt: int, item_cnt: int):
@@ -469,32 +909,32 @@ class PaperPart:
         ref_items = {}
         chapter_cnt = 0
 
-        for name, cont in conts:
-            if name == "h1":
+        for cont in conts:
+            if isinstance(cont, Heading) and cont.level == 1:
                 chapter_cnt += 1
                 img_cnt = 0
                 table_cnt = 0
                 formula_cnt = 0
-            elif name in ["img", "table", "math"]:
-                ali = cont['alias']
+            elif isinstance(cont, (Image, Table, Math)):
+                ali = cont.alias
                 assert_warning(ali not in ref_items, "有重复别名" + ali)
-                if name == "img":
+                if isinstance(cont, Image):
                     img_cnt += 1
                     ref_items[ali] = RefItem(
                         img_index(), "图" + img_index(), RefItem.IMG)
-                    cont['title'] = "图{}  {}".format(
-                        img_index(), cont['title'])
-                elif name == "table":
+                    cont.title = "图{}  {}".format(
+                        img_index(), cont.title)
+                elif isinstance(cont, Table):
                     table_cnt += 1
                     ref_items[ali] = RefItem(
                         table_index(), "表" + table_index(), RefItem.TABLE)
-                    cont['title'] = "表{}  {}".format(
-                        table_index(), cont['title'])
-                elif name == "math":
+                    cont.title = "表{}  {}".format(
+                        table_index(), cont.title)
+                else:
                     formula_cnt += 1
                     ref_items[ali] = RefItem(
                         math_index(), "式" + math_index(), RefItem.MATH)
-                    cont['title'] = "（{}）".format(
+                    cont.title = "（{}）".format(
                         table_index())
         return ref_items
 
@@ -502,16 +942,16 @@ class PaperPart:
         return self._get_ref_items(self.contents)
 
     def link_ref(self, ref_items: Dict[str, RefItem], liter_cnt: int) -> int:
-        for name, cont in self.contents:
-            if name not in ["p", "fh4", "fh5"]:
+        for cont in self.contents:
+            if not isinstance(cont, Paragraph):
                 continue
             is_text = False
-            for run in cont:
-                if run["type"] != "ref":
-                    if run["type"] == "text" and run["text"].endswith("文献"):
+            for run in cont.runs:
+                if run.type != RunType.REF:
+                    if run.type == RunType.TEXT and run.text.endswith("文献"):
                         is_text = True
                     continue
-                ali = run["text"]
+                ali = run.text
                 if ali.find(",") == -1:
                     if ali not in ref_items:
                         ref_items[ali] = RefItem(
@@ -519,15 +959,15 @@ class PaperPart:
                         liter_cnt += 1
                     ref_item = ref_items[ali]
                     if ref_item.type == RefItem.LITER:
-                        run["text"] = "[{}]".format(
+                        run.text = "[{}]".format(
                             ref_item.index)
                         if is_text:
-                            run["type"] = "text"
+                            run.type = RunType.TEXT
                         else:
-                            run["type"] = "ref"
+                            run.type = RunType.REF
                     else:
-                        run["type"] = "text"
-                        run["text"] = ref_item.text
+                        run.type = RunType.TEXT
+                        run.text = ref_item.text
                 else:
                     alis = ali.split(",")
                     for ali in alis:
@@ -551,138 +991,620 @@ class PaperPart:
                     sort_list = [str(x[0]) if x[0] == x[1]
                                  else "{}-{}".format(x[0], x[1])
                                  for x in sort_list]
-                    run["text"] = "[{}]".format(
+                    run.text = "[{}]".format(
                         reduce(lambda x, y: x+","+y, sort_list))
                     if is_text:
-                        run["type"] = "text"
+                        run.type = RunType.TEXT
                     else:
-                        run["type"] = "ref"
+                        run.type = RunType.REF
                 is_text = False
         return liter_cnt
 
     # 渲染
 
-    def _make_para(self, name: str, cont):
-        if not debug:
-            para = word.Text()
-        else:
-            para = word.Text(name)
-        for run in cont:
-            if run["type"] == "text":
-                para.add_run(word.Run(run["text"], word.Run.Normal))
-            elif run["type"] == "strong":
-                para.add_run(word.Run(run["text"], word.Run.Bold))
-            elif run["type"] == "em":
-                para.add_run(word.Run(run["text"], word.Run.Italics))
-            elif run["type"] == "strong-em":
-                para.add_run(word.Run(run["text"],
-                                      word.Run.Italics | word.Run.Bold))
-            elif run["type"] == "math-inline":
-                para.add_run(word.Run(run["text"],
-                                      word.Run.Formula,
-                                      transform_required=run["need-trans"]))
-            elif run["type"] == "ref":
-                para.add_run(
-                    word.Run(run["text"], word.Run.Superscript))
-            else:
-                print("还没实现now", name)
-        return para
-
     def _block_load_body(self, conts=None):
         if conts == None:
             conts = self.contents
-        for (name, cont) in conts:
-            if name == "h1":
-                self.block.add_chapter(cont)
-            elif name == "h2":
-                self.block.add_section(cont)
-            elif name == "h3":
-                self.block.add_subsection(cont)
-            elif name in ["p", "fh4", "fh5"]:
-                para = self._make_para(name, cont)
-                self.block.add_text([para])
-            elif name == "img":
-                img = word.Image(
-                    [word.ImageData(cont["src"], cont["title"], cont["ratio"])])
-                self.block.add_text([img])
-            elif name == "table":
-                data = [tableRow.as_word_row() for tableRow in cont['data']]
-                table = word.Table(cont['title'], data)
-                self.block.add_text([table])
-            elif name == "math":
-                formula = word.Formula(cont['title'],
-                                       cont['text'],
-                                       cont["need-trans"])
-                self.block.add_text([formula])
-            else:
-                print("还没实现now", name)
+        chapters = []
+        for i, cont in enumerate(conts):
+            cont.add_to(self.block)
+            if isinstance(cont, Heading) and cont.level == 1:
+                chapters.append(
+                    (i, self.block.get_internal_text().get_last_sub_block()))
+        # 每章（一级标题及其后的内容）是一个增量渲染的单元
+        ends = [i for i, _ in chapters[1:]] + [len(conts)]
+        for (start, block), end in zip(chapters, ends):
+            self.units.append((block, conts, start, end))
 
     def _block_load_contents(self):
         self._block_load_body()
 
-    def render(self):
-        self._block_load_contents()
-        self.block.render_template()
+    # 渲染前需要先调用_block_load_contents
+
+    def render(self, ctx: word.DocContext = None):
+        self.block.render_template(ctx=ctx)
+
+    def build(self, ctx: word.DocContext = None):
+        self.block.build_template(ctx=ctx)
+
+
+# 中间表示的序列化
+# 保存编译后各模块的状态，公式已经是OMML，引用已经链接，
+# 读取后可以直接渲染，不再需要markdown、pandoc和参考文献
+# 对象保存为{"$": 类名, 字段: 值}，图片路径保存为相对于中间表示文件的路径
+
+IR_FORMAT = "md2paper-ir"
+IR_VERSION = 1
+IR_SKIP_ATTRS = ["block", "file_dir", "units"]  # 渲染时重新生成的属性
+IR_ENUM_FIELDS = {"Run": {"type": RunType}}
+
+
+def _ir_fields(obj) -> List[str]:
+    if hasattr(obj, "__dict__"):
+        return list(vars(obj))
+    return [f for cls in type(obj).__mro__ for f in getattr(cls, "__slots__", ())]
+
+
+def _ir_dump(value, base_dir: str):
+    if value == None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, Enum):
+        return value.value
+    if isinstance(value, (list, tuple)):
+        return [_ir_dump(i, base_dir) for i in value]
+    if isinstance(value, dict):
+        return {"$": "dict",
+                "items": {k: _ir_dump(v, base_dir) for k, v in value.items()}}
+    name = type(value).__name__
+    assert_error(IR_CLASSES.get(name) == type(value), "无法序列化的中间表示: " + name)
+    data = {"$": name}
+    for field in _ir_fields(value):
+        data[field] = _ir_dump(getattr(value, field), base_dir)
+    if isinstance(value, Image) and value.src != "" and base_dir != None:
+        data["src"] = os.path.relpath(value.src, base_dir)
+    return data
+
+
+def _ir_load(data, base_dir: str):
+    if isinstance(data, list):
+        return [_ir_load(i, base_dir) for i in data]
+    if not isinstance(data, dict):
+        return data
+    name = data["$"]
+    if name == "dict":
+        return {k: _ir_load(v, base_dir) for k, v in data["items"].items()}
+    assert_error(name in IR_CLASSES, "未知的中间表示类型: " + name)
+    cls = IR_CLASSES[name]
+    obj = cls.__new__(cls)
+    enums = IR_ENUM_FIELDS.get(name, {})
+    for field, v in data.items():
+        if field == "$":
+            continue
+        v = _ir_load(v, base_dir)
+        if field in enums:
+            v = enums[field](v)
+        setattr(obj, field, v)
+    if isinstance(obj, Image) and obj.src != "" and base_dir != None:
+        obj.src = os.path.join(base_dir, obj.src)
+    return obj
+
+
+def _file_stamp(path: str) -> Union[List[int], None]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+class ChapterCache(word.DiskCache):
+    # 按章缓存：章的源文本 -> markdown解析出的块，
+    # 章中的一段在同样条件下 -> 编译好的中间表示（公式已转换，编号、引用尚未处理）
+    # 引用的图片被修改时缓存失效；同时保存编译时的警告，使用缓存时重新报告
+    VERSION = 2
+    name = "chapters"
+
+    @classmethod
+    def get_hash(cls, md: str) -> str:
+        return hashlib.sha256(
+            json.dumps([cls.VERSION, markdown.__version__, md]).encode()
+        ).hexdigest()
+
+    @classmethod
+    def get_blocks(cls, md_hash: str) -> Union[List[Element], None]:
+        xml = cls.read(cls.get_file(md_hash, ".xml"))
+        if xml == None:
+            return None
+        try:
+            return list(ElementTree.fromstring(xml))
+        except ElementTree.ParseError:
+            return None
+
+    @classmethod
+    def put_blocks(cls, md_hash: str, blocks: List[Element]):
+        root = Element("div")
+        root.extend(blocks)
+        cls.write(cls.get_file(md_hash, ".xml"),
+                  ElementTree.tostring(root, encoding="unicode"))
+
+    @classmethod
+    def get_key(cls, md_hash: str, *context) -> str:
+        return hashlib.sha256(
+            json.dumps([cls.VERSION, md_hash, context]).encode()
+        ).hexdigest()
+
+    @classmethod
+    def get(cls, key: str) -> Union[Tuple[list, List[int], list], None]:
+        text = cls.read(cls.get_file(key, ".json"))
+        if text == None:
+            return None
+        try:
+            data = json.loads(text)
+        except ValueError:
+            return None
+        for path, stamp in data["images"]:
+            if _file_stamp(path) != stamp:
+                return None
+        return _ir_load(data["contents"], None), data["head_counter"], data["warnings"]
+
+    # warnings: [级别, 信息, 块相对于章起始的下标]
+    @classmethod
+    def put(cls, key: str, conts: list, head_counter: List[int], warnings: list):
+        images = [[i.src, _file_stamp(i.src)] for i in conts
+                  if isinstance(i, Image) and i.src != ""]
+        data = {"images": images,
+                "head_counter": head_counter,
+                "warnings": warnings,
+                "contents": _ir_dump(conts, None)}
+        cls.write(cls.get_file(key, ".json"),
+                  json.dumps(data, ensure_ascii=False, separators=(",", ":")))
+
+
+# 增量渲染
+# 生成docx时在旁边保存清单<docx>.manifest.json，记录文档的hash、各章以外内容的key，
+# 以及各章的key和在body中的范围、引用的图片；再次生成时若只有部分章改动，
+# 在之前的文档中删除这些章并在原处重新渲染，其余内容保持不变
+
+MANIFEST_FORMAT = "md2paper-manifest"
+MANIFEST_VERSION = 1
+
+
+def get_manifest_path(out: str) -> str:
+    return out + ".manifest.json"
+
+
+# 中间表示中引用的图片，图片只出现在内容列表中，不会在段落、表格里
+def _ir_images(value) -> List[str]:
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, (list, tuple)):
+        return [path for i in value for path in _ir_images(i)]
+    if isinstance(value, Image):
+        return [value.src] if value.src != "" else []
+    if isinstance(value, Block) or not hasattr(value, "__dict__"):
+        return []
+    return _ir_images(list(vars(value).values()))
+
+
+def _render_key(value) -> str:
+    images = [[path, _file_stamp(path)] for path in _ir_images(value)]
+    return hashlib.sha256(
+        json.dumps([MANIFEST_VERSION, _ir_dump(value, None), images]).encode()
+    ).hexdigest()
 
 
 class Paper:
+    # build模式下模板正文的起始段落(anchor_text, anchor_style_name)，
+    # 该段落及之后的内容被清空后重新生成
+    body_anchor = ("", "")
+    placeholders: List[word.Placeholder] = []  # 渲染前预先删去的模板示例内容
+
     def __init__(self):
         self.parts: list[PaperPart] = []
         self.ref_items: Dict[str, Dict[str, str]] = {}
         self.file_dir: str = ""
+        self.doc: MDDocument = None
+        self.path: str = ""  # markdown或中间表示的文件名
+        self.diagnostics: List[Diagnostic] = []  # 历次load_contents、compile中的诊断信息
 
     def load_md(self, md_path: str):
         with open(md_path, "r") as f:
             md_file = f.read()
+        self.path = md_path
         self.file_dir = os.path.dirname(md_path)
         for part in self.parts:
             part.set_file_dir(self.file_dir)
-        md_html = markdown.markdown(md_file,
-                                    tab_length=3,
-                                    extensions=['markdown.extensions.tables',
-                                                MDExt()])
-        self.soup = BeautifulSoup(md_html, 'html.parser')
-        for i in self.soup(text=lambda text: isinstance(text, Comment)):
-            i.extract()  # 删除 html 注释
+        md = markdown.Markdown(tab_length=3,
+                               extensions=['markdown.extensions.tables',
+                                           MDExt(tree_only=True)])
+        # 逐章解析，未改动的章使用缓存中解析好的块
+        root = Element("div")
+        chapters = []
+        heading_lines = []
+        line = 1
+        for chapter in split_chapters(md_file):
+            md_hash = ChapterCache.get_hash(chapter)
+            blocks = ChapterCache.get_blocks(md_hash)
+            if blocks == None:
+                md.reset()
+                md.tree = None  # 空文档不会运行treeprocessor
+                md.convert(chapter)  # html 注释在转换时删除
+                blocks = list(md.tree) if md.tree != None else []
+                ChapterCache.put_blocks(md_hash, blocks)
+            start = len(root)
+            root.extend(blocks)
+            chapters.append((start, len(root), md_hash))
+            # 找不到对应的标题行时（如列表中的标题）使用章的起始行
+            lines = chapter.split("\n")
+            found = [line + i for i, _ in iter_headings(lines)]
+            count = len([i for i in blocks if is_heading(i)])
+            heading_lines += found if len(found) == count else [line] * count
+            line += len(lines)
+        self.doc = MDDocument(root, chapters, heading_lines)
+        self.doc.cache_tag = get_formula_backend()
 
         if debug:
             with open("out.html", "w") as f:
-                f.write(self.soup.prettify())
-
-    def load_contents(self):
+                f.write(ElementTree.tostring(self.doc.root, encoding="unicode",
+                                             method="html"))
+
+    # 在Diagnostics中运行func，返回其中的诊断信息；出错时抛出PaperError
+    def _collect(self, func, *args) -> List[Diagnostic]:
+        diags = Diagnostics(self.path, self.doc)
+        token = Diagnostics.set_current(diags)
+        try:
+            func(diags, *args)
+        finally:
+            Diagnostics.reset_current(token)
+            self.diagnostics += diags.items
+        return diags.items
+
+    def load_contents(self) -> List[Diagnostic]:
+        return self._collect(self._load_contents)
+
+    def _load_contents(self, diags: Diagnostics):
+        for part in self.parts:
+            diags.part = type(part).__name__
+            try:
+                part.load_contents(self.doc)
+            except PaperError:
+                raise
+            except Exception as e:
+                # 格式不对的markdown常在读取内容时引起各种异常
+                log_error("无法读取内容: {!r}".format(e))
+
+    # 生成论文依赖的文件：markdown或中间表示、引用的图片和BibTeX文件
+    def get_sources(self) -> List[str]:
+        sources = [self.path]
         for part in self.parts:
-            part.load_contents(self.soup)
+            sources += [i for i in part.get_sources() if i not in sources]
+        return sources
 
-    def compile(self):
-        if check_pandoc() == False:
+    # jobs: 转换公式使用的进程数
+    def compile(self, jobs: int = 1) -> List[Diagnostic]:
+        return self._collect(self._compile, jobs)
+
+    def _compile(self, diags: Diagnostics, jobs: int = 1):
+        if pandoc_server == None and check_pandoc() == False:
             print("Pandoc not found, install pandoc get better math support.")
 
+        converted = self._math_pandoc_word()
+        self._math_xslt_word(jobs)
+        if converted:
+            self._save_chapters()
+        elif self.doc != None:
+            # pandoc出错时部分公式改用了XSLT，与cache_tag不符，不保存到按章缓存
+            self.doc.pending = []
         for part in self.parts:
+            diags.part = type(part).__name__
             part.compile()
+        diags.part = ""
 
-    def render(self, doc: Union[str, BytesIO], out: Union[str, StringIO], update_toc=True):
-        word.DM.set_doc(doc)
+    def _save_chapters(self):
+        # 公式转换后、编号与链接引用前的内容，之后各次编译可以直接使用
+        if self.doc == None:
+            return
+        for key, conts, head_counter, warnings in self.doc.pending:
+            ChapterCache.put(key, conts, head_counter, warnings)
+        self.doc.pending = []
+
+    def _math_pandoc_word(self) -> bool:
+        # 整篇论文的公式只调用一次pandoc；设置了pandoc server时交给它转换，
+        # 服务不可用时公式留给XSLT
+        # 返回公式是否都由get_formula_backend给出的后端转换
+        if pandoc_server != None:
+            version = pandoc_server.get_version()
+            if version == None:
+                return True
+
+            def to_docx(md: str) -> bytes:
+                return pandoc_server.convert(md, "markdown", "docx")
+        elif check_pandoc():
+            version = get_pandoc_version()
+            to_docx = pandoc_to_docx
+        else:
+            return True
+
+        # get math
+        items = [item
+                 for part in self.parts
+                 for item in part.get_math_items()
+                 if item.need_trans and item.text.strip() != ""]
+        math_list: List[str] = [i.text for i in items]
 
+        # get word
+        if math_list == []:
+            return True
+        # 先查磁盘缓存，只把没有缓存的公式交给pandoc
+        word_maths_m: List[str] = [word.FormulaCache.get(i, "pandoc", version)
+                                   for i in math_list]
+        miss_list = list(dict.fromkeys(
+            i for i, word_math in zip(math_list, word_maths_m)
+            if word_math is None))
+        if miss_list != []:
+            md_list = ["${}$".format(i.strip()) for i in miss_list]
+            md = reduce(lambda x, y: x+'\n\n'+y, md_list)
+            try:
+                word_maths = omml_from_docx(to_docx(md))
+            except (OSError, RuntimeError, zipfile.BadZipFile) as e:
+                logging.warning(f"pandoc failed, using XSLT instead: {e}")
+                word_maths = [None] * len(miss_list)
+            assert_warning(len(word_maths) == len(miss_list),
+                           "pandoc输出的公式数量不一致，改用XSLT转换")
+            miss_map: Dict[str, str] = {}
+            if len(word_maths) == len(miss_list):
+                for latex, word_math in zip(miss_list, word_maths):
+                    if word_math is None:
+                        continue
+                    word.FormulaCache.put(latex, "pandoc", version, word_math)
+                    miss_map[latex] = word_math
+            word_maths_m = [miss_map.get(latex) if word_math is None else word_math
+                            for latex, word_math in zip(math_list, word_maths_m)]
+
+        # put back，pandoc没能转换的公式留给XSLT
+        for item, word_math in zip(items, word_maths_m):
+            if word_math is None:
+                continue
+            item.text = word_math
+            item.need_trans = False
+        return all(i != None for i in word_maths_m)
+
+    def _math_xslt_word(self, jobs: int = 1):
+        # 没有被pandoc转换的公式在这里一次性转换好，渲染时不再逐个转换
+        items = [item
+                 for part in self.parts
+                 for item in part.get_math_items()
+                 if item.need_trans and item.text.strip() != ""]
+        try:
+            word_maths = word.latex_to_omml_batch([i.text for i in items], jobs)
+        except word.FormulaError as e:
+            self._formula_error(e)
+        for item, word_math in zip(items, word_maths):
+            item.text = word_math
+            item.need_trans = False
+
+    def _formula_error(self, e: word.FormulaError):
+        # 报告出错的公式所在的部分和小节
+        diags = Diagnostics.current()
+        found = [(part, section) for part in self.parts
+                 for section, item in part._iter_math_items()
+                 if item.need_trans and item.text == e.latex]
+        if found and diags != None:
+            part, section = found[0]
+            diags.part = type(part).__name__
+            diags.index = diags.find_section(section)
+            diags.section = section
+        log_error("无法转换的公式 ${}$: {}".format(e.latex.strip(), e.reason))
+
+    # 保存编译后的中间表示，文件名以.gz结尾时用gzip压缩
+    def save_ir(self, path: str):
+        base_dir = os.path.dirname(os.path.abspath(path))
+        parts = []
         for part in self.parts:
-            part.render()
-        if update_toc:
-            word.DM.update_toc()
-        word.DM.save(out)
+            data = {k: _ir_dump(v, base_dir) for k, v in vars(part).items()
+                    if k not in IR_SKIP_ATTRS}
+            parts.append({"part": type(part).__name__, "data": data})
+        ir = {"format": IR_FORMAT,
+              "version": IR_VERSION,
+              "paper": type(self).__name__,
+              "parts": parts}
+        raw = json.dumps(ir, ensure_ascii=False,
+                         separators=(",", ":")).encode("utf-8")
+        if path.endswith(".gz"):
+            raw = gzip.compress(raw)
+        with open(path, "wb") as f:
+            f.write(raw)
+
+    # 读取save_ir保存的中间表示，代替load_md、load_contents和compile
+    def load_ir(self, path: str):
+        with open(path, "rb") as f:
+            raw = f.read()
+        if raw[:2] == b"\x1f\x8b":  # gzip
+            raw = gzip.decompress(raw)
+        ir = json.loads(raw.decode("utf-8"))
+        assert_error(isinstance(ir, dict) and ir.get("format") == IR_FORMAT,
+                     "不是md2paper的中间表示: " + path)
+        assert_error(ir["version"] == IR_VERSION,
+                     "不支持的中间表示版本: {}".format(ir["version"]))
+        assert_error(ir["paper"] == type(self).__name__ and
+                     [i["part"] for i in ir["parts"]] ==
+                     [type(part).__name__ for part in self.parts],
+                     "中间表示不是{}: {}".format(type(self).__name__, ir["paper"]))
+
+        base_dir = os.path.dirname(os.path.abspath(path))
+        self.path = path
+        self.file_dir = os.path.dirname(path)
+        for part, saved in zip(self.parts, ir["parts"]):
+            part.set_file_dir(self.file_dir)
+            for k, v in saved["data"].items():
+                setattr(part, k, _ir_load(v, base_dir))
+
+    # build为True时不再在模板原有内容中查找、删除，而是保留模板的样式、封面等，
+    # 清空正文后从前往后依次生成
+    # incremental为True时保存增量渲染的清单，并尽量只重新渲染改动过的章，out需要是文件名
+    def render(self, doc: Union[str, BytesIO], out: Union[str, StringIO], update_toc=True, build=False,
+               incremental=False):
+        for part in self.parts:
+            part.units = []
+            part._block_load_contents()
+        incremental = incremental and type(out) == str
+        if incremental:
+            base = self._get_render_key(doc, update_toc, build)
+            if self._rerender(out, base):
+                return
+
+        # 每次渲染使用独立的文档上下文，多篇论文可以同时渲染
+        ctx = word.DocContext()
+        token = word.DM.set_context(ctx)
+        try:
+            self.load_template(ctx, doc, build)
+            if build:
+                for part in self.parts:
+                    part.build(ctx)
+            else:
+                for part in self.parts:
+                    part.render(ctx)
+            if update_toc:
+                ctx.update_toc()
+            if incremental:
+                self._save_output(ctx, out, base)
+            else:
+                ctx.save(out)
+        finally:
+            word.DM.reset_context(token)
+
+    # build模式截断模板的正文，否则预先删去模板中的示例内容
+    @classmethod
+    def load_template(cls, ctx: word.DocContext, doc: Union[str, BytesIO], build=False):
+        if build:
+            ctx.load_template(doc, cls.body_anchor)
+        else:
+            ctx.load_template(doc, placeholders=cls.placeholders)
+
+    def _get_units(self) -> List[word.Block]:
+        return [block for part in self.parts for block, _, _, _ in part.units]
+
+    # 计算各章的key并设置到对应的block上，返回各章以外内容的key：
+    # 模板、渲染选项和各模块的中间表示，其中的各章只保留占位
+    def _get_render_key(self, doc: Union[str, BytesIO], update_toc: bool, build: bool) -> str:
+        if type(doc) == str:
+            with open(os.path.join(word.SRC_ROOT, doc), "rb") as f:
+                template = f.read()
+        else:
+            template = doc.getvalue()
+        parts = []
+        for part in self.parts:
+            spans = {}
+            for block, conts, start, end in part.units:
+                block.set_key(_render_key(conts[start:end]))
+                spans[(id(conts), start)] = end
+            data = {}
+            for k, v in vars(part).items():
+                if k in IR_SKIP_ATTRS:
+                    continue
+                if not isinstance(v, list):
+                    data[k] = v
+                    continue
+                items = []
+                i = 0
+                while i < len(v):
+                    if (id(v), i) in spans:
+                        i = spans[(id(v), i)]
+                        items.append("$unit")
+                    else:
+                        items.append(v[i])
+                        i += 1
+                data[k] = items
+            parts.append([type(part).__name__, data])
+        # 封面的完成日期为空时使用当天的日期
+        return _render_key([type(self).__name__,
+                            hashlib.sha256(template).hexdigest(),
+                            update_toc, build,
+                            datetime.date.today().isoformat(),
+                            parts])
+
+    # 在之前生成的文档中只重新渲染改动过的章，
+    # 清单或文档不存在、文档被修改过、各章以外的内容有改动时返回False
+    def _rerender(self, out: str, base: str) -> bool:
+        try:
+            with open(get_manifest_path(out), "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            with open(out, "rb") as f:
+                data = f.read()
+        except (OSError, ValueError):
+            return False
+        blocks = self._get_units()
+        if not isinstance(manifest, dict) or \
+                manifest.get("format") != MANIFEST_FORMAT or \
+                manifest.get("version") != MANIFEST_VERSION or \
+                manifest.get("base") != base or \
+                manifest.get("docx") != hashlib.sha256(data).hexdigest() or \
+                len(manifest["units"]) != len(blocks):
+            logging.info(f"{out} cannot be updated incrementally, rendering all")
+            return False
+
+        ctx = word.DocContext()
+        token = word.DM.set_context(ctx)
+        try:
+            ctx.load_output(BytesIO(data))
+            body = list(ctx.get_doc().element.body)
+            ranges = []
+            for _, start, count, _ in manifest["units"]:
+                if start < 1 or count < 1 or start + count > len(body):
+                    return False
+                ranges.append(body[start:start + count])
+
+            rIds = []
+            changed = 0
+            for block, unit, elements in zip(blocks, manifest["units"], ranges):
+                if block.get_key() == unit[0]:
+                    ctx.add_unit(unit[0], elements[0], elements[-1])
+                else:
+                    ctx.rerender(elements, block)
+                    rIds += unit[3]
+                    changed += 1
+            logging.info(f"re-rendered {changed} of {len(blocks)} chapters in {out}")
+            if changed > 0:
+                ctx.drop_unused_images(rIds)
+                self._save_output(ctx, out, base)
+        finally:
+            word.DM.reset_context(token)
+        return True
+
+    # 保存文档及其增量渲染的清单
+    def _save_output(self, ctx: word.DocContext, out: str, base: str):
+        data = BytesIO()
+        ctx.save(data)
+        data = data.getvalue()
+        with open(out, "wb") as f:
+            f.write(data)
+
+        path = get_manifest_path(out)
+        units = ctx.get_units()
+        if units == None or \
+                [unit[0] for unit in units] != [block.get_key() for block in self._get_units()]:
+            logging.warning(f"failed to locate chapters in {out}, it will be rendered all next time")
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        manifest = {"format": MANIFEST_FORMAT,
+                    "version": MANIFEST_VERSION,
+                    "docx": hashlib.sha256(data).hexdigest(),
+                    "base": base,
+                    "units": units}
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, separators=(",", ":"))
 
 
 '''
-("h1", "something")
-("h2", "something")
-("h3", "something")
-
-("fh4", like p)
-("fh5", like p)
-
-("p", [("text",      "something"),
-       ("strong",    "something"),
-       ("strong-em", "something"),
-       ("em",        "something")])
-("img",     (title, src))
-("table",   (title, [Row]))
-("formula", (title, "somthing"))
+Heading(1, "something")   # h1 h2 h3
+
+Paragraph([Run(RunType.TEXT,      "something"),
+           Run(RunType.STRONG,    "something"),
+           Run(RunType.STRONG_EM, "something"),
+           Run(RunType.EM,        "something")])
+Paragraph(runs, 4)        # 列表项 fh4 fh5
+Image(alias, title, ratio, src)
+Table(alias, title, [TableRow])
+Math(alias, title, "something")
 '''
@@ -29,18 +29,19 @@ class TranslationPart(PaperPart):
 
 
 class TransMetaPart(TranslationPart):
-    def load_contents(self, soup: BeautifulSoup):
-        mete_h1 = soup.find("h1")
+    def load_contents(self, doc: MDDocument):
+        mete_h1 = doc.find("h1")
+        tables = doc.find_all("table", start=mete_h1 + 1)
 
         # 个人信息
-        data_table = mete_h1.find_next_sibling("table").find("tbody")
-        data_lines = data_table.find_all("tr")
-        data_pairs = [list(map(lambda x: rbk(x.text), i.find_all("td")))
+        data_table = doc[tables[0]].find("tbody")
+        data_lines = data_table.iter("tr")
+        data_pairs = [list(map(lambda x: rbk(get_text(x)), i.iter("td")))
                       for i in data_lines]
         data_dict = dict(data_pairs)
 
-        self.title_zh_CN = rbk(mete_h1.text)
-        self.title_en = rbk(mete_h1.find_next_sibling("h2").text)
+        self.title_zh_CN = rbk(get_text(doc[mete_h1]))
+        self.title_en = rbk(get_text(doc[doc.find("h2", start=mete_h1 + 1)]))
         self.school = data_dict["学部（院）"]
         self.major = data_dict["专业"]
         self.name = data_dict["学生姓名"]
@@ -49,9 +50,9 @@ class TransMetaPart(TranslationPart):
         self.finish_date = data_dict["完成日期"]
 
         # 外文作者信息
-        data_table = mete_h1.find_next_siblings("table")[1].find("tbody")
-        data_lines = data_table.find_all("tr")
-        data_pairs = [list(map(lambda x: rbk(x.text), i.find_all("td")))
+        data_table = doc[tables[1]].find("tbody")
+        data_lines = data_table.iter("tr")
+        data_pairs = [list(map(lambda x: rbk(get_text(x)), i.iter("td")))
                       for i in data_lines]
         data_dict = dict(data_pairs)
 
@@ -72,23 +73,28 @@ class TransMetaPart(TranslationPart):
 
 
 class TransAbsPart(TranslationPart):
-    def load_contents(self, soup: BeautifulSoup):
+    def load_contents(self, doc: MDDocument):
         # 摘要
-        abs_cn_h1 = soup.find("h1", string=re_space("摘要"))
+        abs_cn_h1 = doc.find_h1("摘要")
         if abs_cn_h1 == None:
             self.conts_zh_CN = None
             return
-        abs_cn_ul = abs_cn_h1.find_next_sibling("ul")
-        conts_cn = self._get_content_until(abs_cn_h1.next_sibling, abs_cn_ul)
-        assert_warning(conts_cn[-1] == ("p", [{"type": "text", "text": "关键词："}]),
+        abs_cn_ul = doc.find("ul", start=abs_cn_h1 + 1)
+        conts_cn = self._get_section(doc, abs_cn_h1 + 1, abs_cn_ul)
+        assert_warning(conts_cn[-1] == Paragraph([Run(RunType.TEXT, "关键词：")]),
                        '摘要应该以"关键词："后接关键词列表结尾')
         self.conts_zh_CN = conts_cn[:-1]
-        self.keywords_zh_CN = [rbk(i.text)
-                               for i in abs_cn_h1.find_next_sibling("ul").find_all("li")]
+        self.keywords_zh_CN = [rbk(get_text(i))
+                               for i in doc[abs_cn_ul].iter("li")]
         self.title_zh_CN = ""
         self.author = ""
         self.organization = ""
 
+    def _get_content_lists(self) -> list:
+        if self.conts_zh_CN == None:
+            return []
+        return [self.conts_zh_CN]
+
     def _block_load_contents(self):
         self.block = transword.TranslationAbstract(self.title_zh_CN,
                                                    self.author,
@@ -98,27 +104,27 @@ class TransAbsPart(TranslationPart):
 
 
 class TransMainPart(TranslationPart):
-    def load_contents(self, soup: BeautifulSoup):
-        main_h1 = soup.find("h1", string=re_space("正文"))
-        conts = self._get_content_from(main_h1.next_sibling)
+    def load_contents(self, doc: MDDocument):
+        main_h1 = doc.find_h1("正文")
+        conts = self._get_section(doc, main_h1 + 1)
         self.contents = conts
 
     def _link_ref(self) -> int:
-        for name, cont in self.contents:
-            if name not in ["p", "fh4", "fh5"]:
+        for cont in self.contents:
+            if not isinstance(cont, Paragraph):
                 continue
             is_text = False
-            for run in cont:
-                if run["type"] != "ref":
-                    if run["type"] == "text" and run["text"].endswith("文献"):
+            for run in cont.runs:
+                if run.type != RunType.REF:
+                    if run.type == RunType.TEXT and run.text.endswith("文献"):
                         is_text = True
                     continue
 
                 if is_text:
-                    run["type"] = "text"
+                    run.type = RunType.TEXT
                 else:
-                    run["type"] = "ref"
-                run["text"] = "[{}]".format(run["text"])
+                    run.type = RunType.REF
+                run.text = "[{}]".format(run.text)
 
                 is_text = False
 
@@ -126,7 +132,7 @@ class TransMainPart(TranslationPart):
         super().compile()
         self._link_ref()
 
-        self.contents.insert(-2, ("p", []))
+        self.contents.insert(-2, Paragraph([]))
 
     def _block_load_contents(self):
         self.block = transword.TranslationMainContent()
@@ -136,6 +142,8 @@ class TransMainPart(TranslationPart):
 # 论文
 
 class TranslationPaper(Paper):
+    body_anchor = ("（此处空一行）", "")
+
     def __init__(self):
         super().__init__()
         self.meta = TransMetaPart()
@@ -148,8 +156,8 @@ class TranslationPaper(Paper):
             self.main
         ]
 
-    def compile(self):
-        super().compile()
+    def _compile(self, diags: Diagnostics, jobs: int = 1):
+        super()._compile(diags, jobs)
 
         self.abs.author = self.meta.author
         self.abs.organization = self.meta.organization
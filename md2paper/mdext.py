@@ -1,9 +1,12 @@
 from functools import reduce
+import html
+import logging
 import markdown
 from markdown.extensions import Extension
 from markdown.inlinepatterns import InlineProcessor
 from markdown.blockprocessors import BlockProcessor
-from markdown.util import AtomicString
+from markdown.treeprocessors import Treeprocessor
+from markdown.util import AtomicString, AMP_SUBSTITUTE, HTML_PLACEHOLDER, STX, ETX
 import xml.etree.ElementTree as etree
 from xml.etree.ElementTree import Element
 import re
@@ -53,7 +56,88 @@ class RawTextPattern(InlineProcessor):
         return node, m.start(0), m.end(0)
 
 
+class TreeCaptureProcessor(Treeprocessor):
+    # 把解析出的ElementTree保存到md.tree，并换成空的根节点，省去序列化为HTML
+    # 文本按序列化后再用HTML解析器读入的结果还原实体和转义字符，行内的HTML换成元素
+    re_entity = re.compile(r'&#?\w+;')
+    re_stash = re.compile(HTML_PLACEHOLDER % r'([0-9]+)')
+    re_escape = re.compile(r'{}(\d+){}'.format(STX, ETX))
+
+    def run(self, root):
+        self._remove_block_html(root)
+        for el in list(root.iter()):
+            for key, value in el.attrib.items():
+                el.set(key, self._restore(value))
+            self._restore_children(el)
+        self.md.tree = root
+        return Element(self.md.doc_tag)
+
+    def _stash(self, index: int) -> str:
+        return str(self.md.htmlStash.rawHtmlBlocks[index])
+
+    def _remove_block_html(self, root):
+        # 单独成段的块级HTML（主要是注释）不属于任何段落
+        for parent in list(root.iter()):
+            for child in list(parent):
+                if child.tag != "p" or len(child):
+                    continue
+                m = self.re_stash.fullmatch(child.text or "")
+                if m == None:
+                    continue
+                raw = self._stash(int(m.group(1)))
+                tag = re.match(r'</?(\w+)', raw)
+                if tag == None and raw.startswith("<") \
+                        or tag != None and self.md.is_block_level(tag.group(1)):
+                    self._log_html(raw)
+                    parent.remove(child)
+
+    def _log_html(self, raw: str):
+        if not raw.startswith("<!--"):
+            logging.warning("忽略不支持的HTML: " + raw)
+
+    def _restore_children(self, el: Element):
+        # 行内的HTML换成元素插入到文本之间：<br>同Markdown的换行，其余的换成html元素
+        children = []
+        el.text = self._restore_inline(el.text, children)
+        for child in list(el):
+            children.append(child)
+            child.tail = self._restore_inline(child.tail, children)
+        el[:] = children
+
+    def _restore_inline(self, text: Union[str, None], children: List[Element]) -> str:
+        # 返回第一个插入的元素前的文本，插入的元素（及其tail）加入children
+        if not text:
+            return text
+        parts = self.re_stash.split(text)  # 文本与占位符的编号交替
+        texts = [self._restore(parts[0])]
+        for i in range(1, len(parts), 2):
+            raw = self._stash(int(parts[i]))
+            if self.re_entity.fullmatch(raw):
+                texts[-1] += html.unescape(raw)
+            elif re.fullmatch(r'<br */?>', raw, re.I):
+                children.append(Element("br"))
+                texts.append("")
+            elif not raw.startswith("<!--"):
+                children.append(Element("html", raw=raw))
+                texts.append("")
+            texts[-1] += self._restore(parts[i + 1])
+        for child, tail in zip(children[len(children) - len(texts) + 1:], texts[1:]):
+            child.tail = tail or None
+        return texts[0]
+
+    def _restore(self, text: str) -> str:
+        text = self.re_entity.sub(lambda m: html.unescape(m.group()), text)
+        text = text.replace(AMP_SUBSTITUTE, "&")
+        return self.re_escape.sub(lambda m: chr(int(m.group(1))), text)
+
+
 class MDExt(Extension):
+    def __init__(self, **kwargs):
+        self.config = {
+            "tree_only": [False, "只解析出ElementTree保存到md.tree，不生成HTML"]
+        }
+        super().__init__(**kwargs)
+
     def extendMarkdown(self, md):
         ref_tag = SimpleTagPattern(r'(\[)(.*?)\]', 'ref')
         md.inlinePatterns.register(ref_tag, 'ref', 75)
@@ -71,6 +155,14 @@ class MDExt(Extension):
 
         md.ESCAPED_CHARS.append('$')
 
+        if self.getConfig("tree_only"):
+            md.tree = None
+            # 在prettify之后，保留与HTML中相同的换行
+            md.treeprocessors.register(
+                TreeCaptureProcessor(md),
+                'tree-capture',
+                5)
+
 
 if __name__ == "__main__":
     md = '''
@@ -0,0 +1,478 @@
+from __future__ import annotations
+import re
+from typing import Callable, Dict, List, Union
+from lxml import etree
+
+# mml2omml.xsl 的纯python实现，只覆盖latex2mathml常见的输出
+# 输出与样式表逐字节一致；遇到未实现的结构抛出MathMLNotSupported，由调用方回退到XSLT
+
+MML = "http://www.w3.org/1998/Math/MathML"
+M = "http://schemas.openxmlformats.org/officeDocument/2006/math"
+NSMAP = {"m": M, "mml": MML}
+
+TOKENS = {"mi", "mn", "mo", "mtext"}
+# 子节点中的token会被合并成run的父节点
+COLLECTING = {"math", "mrow", "msqrt"}
+SCRIPTS = {"msub", "msup", "msubsup", "munder", "mover", "munderover"}
+
+NARY_CHARS = set("\u222b\u222c\u222d\u222e\u222f\u2230\u2232\u2233\u2231"
+                 "\u2229\u222a\u220f\u2210\u2211\u22c0\u22c1\u22c2\u22c3")
+NARY_GROW = set("\u222b\u222e\u222f\u2232\u2233\u2229\u222a\u220f\u2211"
+                "\u22c0\u22c1\u22c2\u22c3")
+UPPER_COMBINING = {
+    "\u02d8": "\u0306", "\u00b8": "\u0312", "`": "\u0300",
+    "-": "\u0305", "\u2212": "\u0305", ".": "\u0307",
+    "\u02d9": "\u0307", "\u02dd": "\u030b", "\u00b4": "\u0301",
+    "~": "\u0303", "\u02dc": "\u0303", "\u00a8": "\u0308",
+    "\u02c7": "\u030c", "^": "\u0302", "\u00af": "\u0305",
+    "\u2192": "\u20d7", "\u27f6": "\u20d7", "\u2190": "\u20d6",
+}
+# mathvariant -> (m:scr, m:sty)
+SCR_STY = {
+    "bold": (None, "b"),
+    "script": ("script", None),
+    "bold-script": ("script", "b"),
+    "double-struck": ("double-struck", "p"),
+    "fraktur": ("fraktur", "p"),
+    "bold-fraktur": ("fraktur", "b"),
+    "sans-serif": ("sans-serif", "p"),
+    "bold-sans-serif": ("sans-serif", "b"),
+    "sans-serif-italic": ("sans-serif", None),
+    "sans-serif-bold-italic": ("sans-serif", "bi"),
+    "bi": (None, "bi"),
+    "bold-italic": (None, "bi"),
+}
+# 会改变字体分组或样式的token属性，样式表对它们有额外的规则
+UNSUPPORTED_ATTRS = {"fontstyle", "fontweight", "font-family"}
+
+ASCII_LOWER = str.maketrans("ABCDEFGHIJKLMNOPQRSTUVWXYZ",
+                            "abcdefghijklmnopqrstuvwxyz")
+re_xpath_space = re.compile(r"[ \t\r\n]+")
+# libxml2的number()也接受指数
+re_xpath_number = re.compile(
+    r"[ \t\r\n]*-?([0-9]+(\.[0-9]*)?|\.[0-9]+)([eE][+-]?[0-9]*)?[ \t\r\n]*")
+
+
+class MathMLNotSupported(Exception):
+    pass
+
+
+def mathml_to_omml(math: etree._Element) -> etree._Element:
+    # math: <math>元素，返回<m:oMath>
+    omath = etree.Element(qm("oMath"), nsmap=NSMAP)
+    for child in children(math):
+        apply(child, omath)
+    return omath
+
+
+def qm(tag: str) -> str:
+    return "{%s}%s" % (M, tag)
+
+
+def sub(parent: etree._Element, tag: str, val: str = None) -> etree._Element:
+    el = etree.SubElement(parent, qm(tag))
+    if val is not None:
+        el.set(qm("val"), val)
+    return el
+
+
+def local(el: etree._Element) -> str:
+    if not isinstance(el.tag, str):
+        raise MathMLNotSupported("comment or processing instruction")
+    ns, _, name = el.tag[1:].partition("}")
+    if ns != MML:
+        raise MathMLNotSupported(el.tag)
+    return name
+
+
+def children(el: etree._Element) -> List[etree._Element]:
+    for child in el:
+        local(child)
+    return list(el)
+
+
+def child_count(el: etree._Element, *counts: int) -> List[etree._Element]:
+    ch = children(el)
+    if len(ch) not in counts:
+        raise MathMLNotSupported(
+            "<{}> with {} children".format(local(el), len(ch)))
+    return ch
+
+
+def string(el: Union[etree._Element, None]) -> str:
+    # XPath的字符串值
+    return "" if el is None else "".join(el.itertext())
+
+
+def normalize_space(s: str) -> str:
+    return re_xpath_space.sub(" ", s).strip(" \t\r\n")
+
+
+def output_text(s: str) -> str:
+    s = s.replace("\u2062", "").replace("\u200b", "")
+    return s.replace("\u2a75", "==").replace("\u00a0", " ")
+
+
+def lower(el: etree._Element, attr: str) -> str:
+    # 样式表只转换ASCII字母的大小写
+    return el.get(attr, "").translate(ASCII_LOWER)
+
+
+# token
+
+def is_numeric(tok: etree._Element) -> bool:
+    return tok.text is not None and re_xpath_number.fullmatch(tok.text) is not None
+
+
+def get_font(tok: etree._Element) -> str:
+    name = local(tok)
+    mathvariant = tok.get("mathvariant", "")
+    if mathvariant != "":
+        return mathvariant
+    if (name == "mi" and len(normalize_space(string(tok))) <= 1
+            or name == "mn" and is_numeric(tok)
+            or name == "mo"):
+        return "italic"
+    return "normal"
+
+
+def same_run(font: str, tok: etree._Element) -> bool:
+    # tok能否并入字体为font的run
+    name = local(tok)
+    mathvariant = tok.get("mathvariant", "")
+    length = len(normalize_space(string(tok)))
+    if mathvariant == font:
+        return True
+    if font == "normal":
+        if mathvariant == "normal":
+            return True
+        if mathvariant == "":
+            return (name == "mi" and length > 1
+                    or name == "mn" and not is_numeric(tok)
+                    or name == "mtext")
+    elif font == "italic":
+        if mathvariant == "italic":
+            return True
+        if mathvariant == "":
+            return (name == "mn" and is_numeric(tok)
+                    or name == "mo"
+                    or name == "mi" and length <= 1)
+    elif font in ("bi", "bold-italic"):
+        return mathvariant == "bold-italic"
+    return False
+
+
+def is_token(el: Union[etree._Element, None]) -> bool:
+    if el is None or local(el) not in TOKENS:
+        return False
+    if len(el) or UNSUPPORTED_ATTRS.intersection(el.attrib):
+        raise MathMLNotSupported("<{}> with styling".format(local(el)))
+    return True
+
+
+def make_run(parent: etree._Element, first: etree._Element,
+             run: List[etree._Element]):
+    r = sub(parent, "r")
+    font = get_font(first)
+    nor = local(first) == "mtext"
+    if nor or font != "italic":
+        rpr = sub(r, "rPr")
+        if nor:
+            sub(rpr, "nor")
+        if font == "normal":
+            if not nor:
+                sub(rpr, "sty", "p")
+        elif font in SCR_STY:
+            scr, sty = SCR_STY[font]
+            if scr:
+                sub(rpr, "scr", scr)
+            if sty:
+                sub(rpr, "sty", sty)
+    t = sub(r, "t")
+    text = output_text("".join(normalize_space(string(tok)) for tok in run))
+    if text:
+        t.text = text
+
+
+def should_collect(parent: etree._Element) -> bool:
+    return (local(parent) in COLLECTING
+            and not is_linear_frac(parent) and not is_func(parent))
+
+
+def apply_token(el: etree._Element, out: etree._Element):
+    is_token(el)
+    parent = el.getparent()
+    if not should_collect(parent):
+        make_run(out, el, [el])
+        return
+    if is_token(el.getprevious()):
+        # 已经包含在前面token开始的run中
+        return
+    # 把相邻且字体相同的token合并为一个run
+    while el is not None:
+        font = get_font(el)
+        nor = local(el) == "mtext"
+        run = [el]
+        nxt = el.getnext()
+        while (is_token(nxt) and (local(nxt) == "mtext") == nor
+               and same_run(font, nxt)):
+            run.append(nxt)
+            nxt = nxt.getnext()
+        make_run(out, el, run)
+        el = nxt if is_token(nxt) else None
+
+
+def apply_mspace(el: etree._Element, out: etree._Element):
+    # 不输出内容，但会打断run
+    if len(el):
+        raise MathMLNotSupported("<mspace> with children")
+
+
+# mrow
+
+def is_linear_frac(el: etree._Element) -> bool:
+    ch = list(el)
+    return (local(el) == "mrow" and len(ch) == 3 and local(ch[1]) == "mo"
+            and normalize_space(string(ch[1])) == "/")
+
+
+def is_func(el: etree._Element) -> bool:
+    ch = list(el)
+    return (local(el) == "mrow" and len(ch) == 3 and local(ch[1]) == "mo"
+            and normalize_space(string(ch[1])) == "\u2061")
+
+
+def make_linear_frac(el: etree._Element, out: etree._Element):
+    ch = children(el)
+    f = sub(out, "f")
+    sub(sub(f, "fPr"), "type", "lin")
+    apply(ch[0], sub(f, "num"))
+    apply(ch[2], sub(f, "den"))
+
+
+def is_nary_argument(el: etree._Element) -> bool:
+    prev = el.getprevious()
+    if prev is None or local(prev) not in SCRIPTS or not len(prev):
+        return False
+    return is_nary(prev[0])
+
+
+def apply_mrow(el: etree._Element, out: etree._Element):
+    if is_nary_argument(el):
+        # 已作为前面n元运算符的m:e输出
+        return
+    if is_linear_frac(el):
+        make_linear_frac(el, out)
+    elif is_func(el):
+        ch = children(el)
+        func = sub(out, "func")
+        apply(ch[0], sub(func, "fName"))
+        apply(ch[2], sub(func, "e"))
+    else:
+        for child in children(el):
+            apply(child, out)
+
+
+# 分式、根式
+
+def apply_mfrac(el: etree._Element, out: etree._Element):
+    ch = child_count(el, 2)
+    thickness = lower(el, "linethickness")
+    bar = (thickness in ("", "thin", "medium", "thick")
+           or re.search("[1-9]", thickness) is not None)
+    if not bar:
+        frac_type = "noBar"
+    elif el.get("bevelled") == "true":
+        frac_type = "skw"
+    else:
+        frac_type = "bar"
+    f = sub(out, "f")
+    sub(sub(f, "fPr"), "type", frac_type)
+    apply(ch[0], sub(f, "num"))
+    apply(ch[1], sub(f, "den"))
+
+
+def apply_msqrt(el: etree._Element, out: etree._Element):
+    rad = sub(out, "rad")
+    sub(sub(rad, "radPr"), "degHide", "on")
+    sub(rad, "deg")
+    e = sub(rad, "e")
+    for child in children(el):
+        apply(child, e)
+
+
+def apply_mroot(el: etree._Element, out: etree._Element):
+    ch = child_count(el, 2)
+    rad = sub(out, "rad")
+    sub(sub(rad, "radPr"), "degHide", "off")
+    apply(ch[1], sub(rad, "deg"))
+    apply(ch[0], sub(rad, "e"))
+
+
+# 上下标、n元运算符
+
+def is_nary(el: etree._Element) -> bool:
+    if normalize_space(string(el)) not in NARY_CHARS:
+        return False
+    parent = el.getparent()
+    if local(parent) == "munder":
+        accent = lower(parent, "accentunder")
+    else:
+        accent = lower(parent, "accent")
+    if accent == "true":
+        return False
+    nodes = list(el.iter())
+    for node in nodes:
+        if local(node) == "mstyle":
+            raise MathMLNotSupported("<mstyle>")
+        if local(node) not in ("mo", "mrow"):
+            return False
+    return local(nodes[-1]) == "mo"
+
+
+def make_nary(el: etree._Element, out: etree._Element,
+              lower_lim: etree._Element, upper_lim: etree._Element):
+    name = local(el)
+    base = el[0]
+    chr = normalize_space(string(base))
+    grow = lower(base, "stretchy")
+    if grow == "true":
+        grow = "1"
+    elif grow == "false":
+        grow = "0"
+    else:
+        grow = "1" if chr in NARY_GROW else "0"
+    nary = sub(out, "nary")
+    pr = sub(nary, "naryPr")
+    sub(pr, "chr", chr)
+    sub(pr, "limLoc", "undOvr" if name.startswith("mu") or name == "mover"
+        else "subSup")
+    sub(pr, "grow", grow)
+    sub(pr, "subHide", "on" if name in ("mover", "msup") else "off")
+    sub(pr, "supHide", "on" if name in ("munder", "msub") else "off")
+    for tag, lim in (("sub", lower_lim), ("sup", upper_lim)):
+        parent = sub(nary, tag)
+        if lim is not None:
+            apply(lim, parent)
+    e = sub(nary, "e")
+    nxt = el.getnext()
+    if nxt is not None and local(nxt) == "mrow":
+        if is_linear_frac(nxt):
+            make_linear_frac(nxt, e)
+        else:
+            for child in children(nxt):
+                apply(child, e)
+    elif nxt is not None and local(nxt) == "mstyle":
+        raise MathMLNotSupported("<mstyle>")
+
+
+def apply_script(el: etree._Element, out: etree._Element):
+    name = local(el)
+    ch = child_count(el, 3 if name in ("msubsup", "munderover") else 2)
+    if is_nary(ch[0]):
+        if name in ("msub", "munder"):
+            make_nary(el, out, ch[1], None)
+        elif name in ("msup", "mover"):
+            make_nary(el, out, None, ch[1])
+        else:
+            make_nary(el, out, ch[1], ch[2])
+        return
+    if name == "msub":
+        node = sub(out, "sSub")
+        apply(ch[0], sub(node, "e"))
+        apply(ch[1], sub(node, "sub"))
+    elif name == "msup":
+        node = sub(out, "sSup")
+        apply(ch[0], sub(node, "e"))
+        apply(ch[1], sub(node, "sup"))
+    elif name == "msubsup":
+        node = sub(out, "sSubSup")
+        apply(ch[0], sub(node, "e"))
+        apply(ch[1], sub(node, "sub"))
+        apply(ch[2], sub(node, "sup"))
+    elif name == "munderover":
+        upp = sub(out, "limUpp")
+        low = sub(sub(upp, "e"), "limLow")
+        apply(ch[0], sub(low, "e"))
+        apply(ch[1], sub(low, "lim"))
+        apply(ch[2], sub(upp, "lim"))
+    else:
+        apply_under_over(el, out, ch)
+
+
+def apply_under_over(el: etree._Element, out: etree._Element,
+                     ch: List[etree._Element]):
+    under = local(el) == "munder"
+    accent = lower(el, "accentunder" if under else "accent")
+    if accent != "true" and local(ch[1]) == "mo":
+        bars = ("\u0332", "_") if under else ("\u0305", "\u00af")
+        if string(ch[1]) in bars:
+            bar = sub(out, "bar")
+            sub(sub(bar, "barPr"), "pos", "bot" if under else "top")
+            apply(ch[0], sub(bar, "e"))
+            return
+    if not under and is_acc(el, ch):
+        acc = sub(out, "acc")
+        chr = string(ch[1])
+        sub(sub(acc, "accPr"), "chr", UPPER_COMBINING.get(chr, chr))
+        apply(ch[0], sub(acc, "e"))
+        return
+    names = (local(ch[0]), local(ch[1]))
+    if accent == "false" and names in (("mrow", "mo"), ("mo", "mrow")):
+        mo = ch[names.index("mo")]
+        mrow = ch[names.index("mrow")]
+        if len(string(mo)) <= 1:
+            top = names[0] == "mrow"
+            if under:
+                top = not top
+            group = sub(out, "groupChr")
+            pr = sub(group, "groupChrPr")
+            sub(pr, "chr", string(mo))
+            sub(pr, "pos", "top" if top else "bot")
+            sub(pr, "vertJc", "top" if under else "bot")
+            apply(mrow, sub(group, "e"))
+            return
+    lim = sub(out, "limLow" if under else "limUpp")
+    apply(ch[0], sub(lim, "e"))
+    apply(ch[1], sub(lim, "lim"))
+
+
+def is_acc(el: etree._Element, ch: List[etree._Element]) -> bool:
+    # 第二个子节点的字符串值与某个<mo>子节点相同（样式表中的节点集比较）
+    op = string(ch[1])
+    if not any(local(c) == "mo" and string(c) == op for c in ch):
+        return False
+    mo_accent = lower(ch[1], "accent")
+    if not (mo_accent == "true"
+            or mo_accent == "" and lower(el, "accent") == "true"):
+        return False
+    return len(op) <= 1
+
+
+HANDLERS: Dict[str, Callable[[etree._Element, etree._Element], None]] = {
+    "mi": apply_token,
+    "mn": apply_token,
+    "mo": apply_token,
+    "mtext": apply_token,
+    "mspace": apply_mspace,
+    "mrow": apply_mrow,
+    "mfrac": apply_mfrac,
+    "msqrt": apply_msqrt,
+    "mroot": apply_mroot,
+    "msub": apply_script,
+    "msup": apply_script,
+    "msubsup": apply_script,
+    "munder": apply_script,
+    "mover": apply_script,
+    "munderover": apply_script,
+}
+
+
+def apply(el: etree._Element, out: etree._Element):
+    name = local(el)
+    if name not in HANDLERS:
+        raise MathMLNotSupported("<{}>".format(name))
+    for attr in el.attrib:
+        if attr.startswith("{"):
+            raise MathMLNotSupported("namespaced attribute " + attr)
+    HANDLERS[name](el, out)
@@ -0,0 +1,17 @@
+<?xml version="1.0" encoding="UTF-8" ?>
+<!-- 批量转换：根节点下的每个<math>分别转换为一个<m:oMath>，其余规则沿用mml2omml.xsl -->
+<xsl:stylesheet version="1.0" xmlns:xsl="http://www.w3.org/1999/XSL/Transform" xmlns:mml="http://www.w3.org/1998/Math/MathML"
+	xmlns:m="http://schemas.openxmlformats.org/officeDocument/2006/math">
+  <xsl:import href="mml2omml.xsl" />
+  <xsl:output method="xml" encoding="UTF-8" />
+
+  <xsl:template match="/">
+    <batch>
+      <xsl:for-each select="*/*">
+        <m:oMath>
+          <xsl:apply-templates select="." />
+        </m:oMath>
+      </xsl:for-each>
+    </batch>
+  </xsl:template>
+</xsl:stylesheet>
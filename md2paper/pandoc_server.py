@@ -0,0 +1,91 @@
+import http.client
+import json
+import logging
+import queue
+import threading
+from typing import Union
+from urllib.parse import urlsplit
+
+
+class PandocServer:
+    # 长期运行的 `pandoc server`（或兼容的HTTP服务）客户端
+    # 复用一组keep-alive连接，并限制同时进行的请求数，可以在多个线程中共用
+    def __init__(self, url: str, pool_size: int = 4, max_in_flight: int = 8,
+                 timeout: float = 30) -> None:
+        parts = urlsplit(url if "://" in url else "http://" + url)
+        self.host = parts.hostname or "localhost"
+        self.port = parts.port or 3030
+        self.path = parts.path or "/"
+        self.timeout = timeout
+        self.__pool: queue.LifoQueue = queue.LifoQueue(maxsize=pool_size)
+        self.__in_flight = threading.BoundedSemaphore(max_in_flight)
+        self.__version: Union[str, None] = None
+        self.__checked = False
+        self.__lock = threading.Lock()
+
+    def __get_conn(self) -> http.client.HTTPConnection:
+        try:
+            return self.__pool.get_nowait()
+        except queue.Empty:
+            return http.client.HTTPConnection(self.host, self.port,
+                                              timeout=self.timeout)
+
+    def __put_conn(self, conn: http.client.HTTPConnection):
+        try:
+            self.__pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def __request(self, method: str, path: str, body: bytes = None,
+                  headers: dict = {}) -> bytes:
+        with self.__in_flight:
+            # 连接池中的连接可能已被服务端关闭，失败时用新连接重试一次
+            for retry in [True, False]:
+                conn = self.__get_conn()
+                try:
+                    conn.request(method, path, body, headers)
+                    resp = conn.getresponse()
+                    data = resp.read()
+                except (OSError, http.client.HTTPException) as e:
+                    conn.close()
+                    if retry:
+                        continue
+                    raise OSError(f"pandoc server request failed: {e}") from e
+                if resp.will_close:
+                    conn.close()
+                else:
+                    self.__put_conn(conn)
+                if resp.status != 200:
+                    raise RuntimeError("pandoc server error {}: {}".format(
+                        resp.status, data.decode("utf-8", "replace")))
+                return data
+
+    def get_version(self) -> Union[str, None]:
+        # 服务不可用时返回None，结果只检查一次
+        with self.__lock:
+            if not self.__checked:
+                try:
+                    # 服务可能挂在路径前缀下，如 http://host/pandoc
+                    self.__version = self.__request(
+                        "GET", self.path.rstrip("/") + "/version"
+                    ).decode().strip().strip('"')
+                except (OSError, RuntimeError) as e:
+                    logging.warning(
+                        f"pandoc server {self.host}:{self.port} not available: {e}")
+                self.__checked = True
+            return self.__version
+
+    def convert(self, text: str, from_format: str, to_format: str) -> bytes:
+        body = json.dumps({"text": text,
+                           "from": from_format,
+                           "to": to_format}).encode("utf-8")
+        return self.__request("POST", self.path, body,
+                              {"Content-Type": "application/json",
+                               "Accept": "application/octet-stream"})
+
+    def close(self):
+        while True:
+            try:
+                self.__pool.get_nowait().close()
+            except queue.Empty:
+                return
@@ -0,0 +1,52 @@
+import logging
+import os
+import time
+from typing import Dict, List, Tuple, Union
+
+
+def _stat(path: str) -> Union[Tuple[int, int], None]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+class FileWatcher:
+    # 轮询文件的修改时间和大小，不依赖平台的文件通知接口
+    # 发现改动后等文件在debounce秒内不再变化才返回，
+    # 编辑器保存时常常先清空再写入、或连续写多个文件，避免对半写的文件生成
+    def __init__(self, interval: float = 0.2, debounce: float = 0.3) -> None:
+        self.interval = interval
+        self.debounce = debounce
+        self.__stats: Dict[str, Union[Tuple[int, int], None]] = {}
+
+    # 设置要监视的文件，已在监视的文件保留原来的状态，不会被当作改动
+    def set_files(self, paths: List[str]):
+        self.__stats = {path: self.__stats[path] if path in self.__stats else _stat(path)
+                        for path in paths}
+
+    def __changed(self) -> List[str]:
+        changed = []
+        for path, stat in self.__stats.items():
+            new_stat = _stat(path)
+            if new_stat != stat:
+                self.__stats[path] = new_stat
+                changed.append(path)
+        return changed
+
+    # 阻塞直到有文件改动，返回改动过的文件
+    def wait(self) -> List[str]:
+        changed = []
+        while not changed:
+            time.sleep(self.interval)
+            changed = self.__changed()
+        last_change = time.monotonic()
+        while time.monotonic() - last_change < self.debounce:
+            time.sleep(self.interval)
+            more = self.__changed()
+            if more:
+                changed += [path for path in more if path not in changed]
+                last_change = time.monotonic()
+        logging.debug(f"changed: {changed}")
+        return changed
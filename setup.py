@@ -5,7 +5,6 @@ REQUIREMENTS = [
     'python-docx==0.8.11',
     'latex2mathml==3.63.3',
     'Markdown==3.3.6',
-    'beautifulsoup4>=4.9.3',
     'bibtexparser==1.2.0',
     'Pillow==9.0.0'
 ]
@@ -0,0 +1,43 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from md2paper.md2paper import DocContext
+from conftest import TEMPLATE
+ANCHORS = ["摘    要", "引    言", "结    论", "参 考 文 献", "致    谢"]
+
+# 增删段落后，记下的锚点下标换算为当前的下标，与逐段查找的结果相同
+
+
+def scan(ctx: DocContext, anchor_text: str) -> int:
+    for i in range(ctx.paragraph_count()):
+        if anchor_text in ctx.get_paragraph(i).text:
+            return i + 1
+
+
+def check(ctx: DocContext, anchors=ANCHORS):
+    for anchor_text in anchors:
+        assert ctx.get_anchor_position(anchor_text) == scan(ctx, anchor_text)
+
+
+def test_anchor_position():
+    ctx = DocContext()
+    ctx.load_template(TEMPLATE)
+    check(ctx)
+    # 在两个锚点之间连续插入，再在前面删除
+    cursor = ctx.get_cursor(ctx.get_anchor_position("引    言"))
+    for _ in range(5):
+        ctx.insert_paragraph_after(cursor)
+    check(ctx)
+    ctx.insert_paragraph_before(0)
+    ctx.delete_paragraphs(1, 3)
+    ctx.delete_paragraph_by_index(0)
+    check(ctx)
+    # 锚点本身被删除后重新查找
+    ctx.delete_paragraph_by_index(ctx.get_anchor_position("结    论") - 1)
+    assert scan(ctx, "结    论") == None
+    check(ctx, [i for i in ANCHORS if i != "结    论"])
+
+
+if __name__ == "__main__":
+    test_anchor_position()
+    print("ok")
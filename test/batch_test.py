@@ -0,0 +1,51 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import tempfile
+from md2paper import GraduationPaper
+from md2paper.batch import BatchTask, BatchSettings, find_sources, run_batch
+from conftest import TEMPLATE, copy_example
+
+# 一篇论文出错不影响批量转换中的其他论文
+
+
+def make_papers(tmp: str):
+    for name in ["a", "b", "c"]:
+        os.makedirs(os.path.join(tmp, name))
+        # 缺少正文
+        copy_example(os.path.join(tmp, name), "# 题目\n" if name == "b" else None)
+
+
+def check(jobs: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        make_papers(tmp)
+        sources = find_sources(tmp)
+        assert [os.path.relpath(i, tmp) for i in sources] == \
+            [os.path.join(i, "论文.md") for i in ["a", "b", "c"]]
+        tasks = [BatchTask(GraduationPaper, TEMPLATE, i) for i in sources]
+        results = {os.path.relpath(i.md_path, tmp): i
+                   for i in run_batch(tasks, BatchSettings(), jobs)}
+        assert [results[os.path.join(i, "论文.md")].ok
+                for i in ["a", "b", "c"]] == [True, False, True]
+        assert results[os.path.join("b", "论文.md")].error != ""
+        assert os.path.exists(os.path.join(tmp, "c", "论文.docx"))
+
+        # 列表文件中的相对路径相对于列表文件
+        with open(os.path.join(tmp, "list.txt"), "w") as f:
+            f.write("# 注释\n\na/论文.md\n")
+        assert find_sources(os.path.join(tmp, "list.txt")) == \
+            [os.path.join(tmp, "a", "论文.md")]
+
+
+def test_batch_serial():
+    check(1)
+
+
+def test_batch_pool():
+    check(2)
+
+
+if __name__ == "__main__":
+    test_batch_serial()
+    test_batch_pool()
+    print("ok")
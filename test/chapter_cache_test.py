@@ -0,0 +1,129 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import logging
+import shutil
+import tempfile
+from xml.etree.ElementTree import tostring
+import markdown
+from md2paper import GraduationPaper
+import md2paper.md2paper as md2paper
+from md2paper.md_paper import ChapterCache, Heading, split_chapters
+from md2paper.mdext import MDExt
+from conftest import copy_example, read_example
+
+# 按章缓存：只重新编译改动过的章，结果与不使用缓存时相同
+
+CH1 = "## 1.3 正文中的编号"
+CH2 = "![样例图: Word 样式列表; 70%](image/image014.png)"
+
+
+def parse(md_file: str):
+    md = markdown.Markdown(tab_length=3,
+                           extensions=['markdown.extensions.tables',
+                                       MDExt(tree_only=True)])
+    md.tree = None
+    md.convert(md_file)
+    return [tostring(i, encoding="unicode") for i in md.tree] if md.tree != None else []
+
+
+def test_split_chapters():
+    # 各章单独解析的结果与整体解析相同
+    mds = [read_example(),
+           "# A\n\nline1\nline2\n===\n\nmore\n\nB\n===\n\nx",  # 不在块开头的不是标题
+           "A\n===\n\nx\n\n- a\n\n  B\n  ===\n\nC\n===\ny",
+           "# A\n\n$$\nx\n# y\n$$\n\n<!--\n# z\n-->\n\n# B\n"]
+    for md_file in mds:
+        chapters = split_chapters(md_file)
+        assert "\n".join(chapters) == md_file
+        assert sum([parse(i) for i in chapters], []) == parse(md_file)
+    assert len(split_chapters(mds[1])) == 2
+
+
+def compile_md(md_path: str, md: str):
+    # 返回论文和各段是否使用了缓存
+    with open(md_path, "w") as f:
+        f.write(md)
+    hits = []
+    get = ChapterCache.get.__func__
+
+    def counted_get(cls, key):
+        res = get(cls, key)
+        hits.append(res != None)
+        return res
+
+    ChapterCache.get = classmethod(counted_get)
+    try:
+        paper = GraduationPaper()
+        paper.load_md(md_path)
+        paper.load_contents()
+        paper.compile()
+    finally:
+        ChapterCache.get = classmethod(get)
+    return paper, hits
+
+
+def dump_ir(paper: GraduationPaper, path: str) -> bytes:
+    paper.save_ir(path)
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def check_cold(paper: GraduationPaper, md_path: str, md: str):
+    # 与不使用缓存的编译结果相同，包括标题编号和引用编号
+    ChapterCache.enabled = False
+    try:
+        cold, hits = compile_md(md_path, md)
+    finally:
+        ChapterCache.enabled = True
+    ir_path = md_path[:-3] + ".ir.json"
+    assert dump_ir(paper, ir_path) == dump_ir(cold, ir_path)
+
+
+def test_chapter_cache():
+    with tempfile.TemporaryDirectory() as tmp:
+        # 第二章的图片只在第二章中使用
+        md = read_example().replace(CH2, CH2.replace("image014", "ch2"))
+        md_path = copy_example(tmp, md)
+        shutil.copy(os.path.join(tmp, "image", "image014.png"),
+                    os.path.join(tmp, "image", "ch2.png"))
+
+        _, hits = compile_md(md_path, md)
+        assert hits != [] and not any(hits)
+        paper, hits = compile_md(md_path, md)
+        assert all(hits)
+        segments = len(hits)
+
+        # 只改动第二章
+        md2 = md.replace("也可以添加图、表、公式。", "也可以添加图、表、公式！", 1)
+        paper, hits = compile_md(md_path, md2)
+        assert hits.count(False) == 1 and len(hits) == segments
+        check_cold(paper, md_path, md2)
+
+        # 第一章增加一节，第二章开始时的标题编号随之改变，第三章不受影响
+        md3 = md2.replace(CH1, "## 1.3 新增的一节\n\n新增的内容。\n\n" +
+                          CH1.replace("1.3", "1.4"), 1)
+        paper, hits = compile_md(md_path, md3)
+        assert hits.count(False) == 2 and len(hits) == segments
+        check_cold(paper, md_path, md3)
+        # 缓存的章沿用之前的标题编号，编号错误时会有警告
+        assert paper.diagnostics == []
+        headings = [i.text for i in paper.main.contents if isinstance(i, Heading)]
+        assert headings[headings.index("1.3  新增的一节") + 1] == "1.4  正文中的编号"
+        assert "2.1  图的格式说明" in headings
+
+        # 引用的图片被修改时所在的章失效
+        image = os.path.join(tmp, "image", "ch2.png")
+        st = os.stat(image)
+        os.utime(image, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        paper, hits = compile_md(md_path, md3)
+        assert hits.count(False) == 1 and len(hits) == segments
+        check_cold(paper, md_path, md3)
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+    md2paper.CACHE_DIR = tempfile.mkdtemp()
+    test_split_chapters()
+    test_chapter_cache()
+    print("ok")
@@ -0,0 +1,49 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import re
+import shutil
+import zipfile
+import pytest
+import md2paper.md2paper as md2paper
+from md2paper.md2paper import FormulaCache
+from md2paper.md_paper import ChapterCache
+
+
+# 测试中的磁盘缓存写到临时目录，不污染用户的 ~/.cache/md2paper，各个测试之间也互不影响
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    path = str(tmp_path / "cache")
+    # spawn方式启动的工作进程重新导入模块时从环境变量读取
+    monkeypatch.setenv("XDG_CACHE_HOME", path)
+    monkeypatch.setattr(md2paper, "CACHE_DIR", os.path.join(path, "md2paper"))
+    for cache in [FormulaCache, ChapterCache]:
+        monkeypatch.setattr(cache, "_size", None)
+    return path
+
+
+# 使用样例论文的测试共用的辅助函数，以脚本运行时也可以直接导入
+EXAMPLE = os.path.join(md2paper.SRC_ROOT, "example")
+TEMPLATE = os.path.join(md2paper.SRC_ROOT, "word-template", "毕业设计（论文）模板-docx.docx")
+
+
+def read_example() -> str:
+    with open(os.path.join(EXAMPLE, "论文.md"), "r") as f:
+        return f.read()
+
+
+def copy_example(dir: str, md: str = None) -> str:
+    # 复制样例论文的图片和文库到dir，md为None时使用样例的正文，返回论文的路径
+    shutil.copytree(os.path.join(EXAMPLE, "image"), os.path.join(dir, "image"))
+    shutil.copy(os.path.join(EXAMPLE, "文库.bib"), dir)
+    md_path = os.path.join(dir, "论文.md")
+    with open(md_path, "w") as f:
+        f.write(read_example() if md == None else md)
+    return md_path
+
+
+def document_xml(path: str) -> str:
+    # 比较生成的文档时忽略图片的id、名称
+    with zipfile.ZipFile(path) as z:
+        xml = z.read("word/document.xml").decode("utf-8")
+    return re.sub(r'(<wp:docPr|<pic:cNvPr) id="\d+" name="[^"]*"', r'\1', xml)
@@ -0,0 +1,79 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import logging
+import tempfile
+from md2paper import GraduationPaper, PaperError
+from conftest import copy_example, read_example
+
+# 格式错误不退出进程，而是给出带位置的诊断信息
+
+
+def load_md(md_path: str):
+    paper = GraduationPaper()
+    paper.load_md(md_path)
+    return paper, paper.load_contents()
+
+
+def load(md: str, replace: str, to: str):
+    with tempfile.TemporaryDirectory() as tmp:
+        return load_md(copy_example(tmp, md.replace(replace, to, 1)))
+
+
+def summary(diags):
+    return [(i.level, i.part, i.line, i.section, i.message) for i in diags]
+
+
+def test_warning():
+    md = read_example()
+    line = md.split("\n").index("## 2.1 图的格式说明") + 1
+    md = md.replace("Word 样式列表; 70%", "Word 样式列表; 170%", 1)
+    with tempfile.TemporaryDirectory() as tmp:
+        md_path = copy_example(tmp, md)
+        paper, diags = load_md(md_path)
+        assert summary(diags) == [("warning", "MainPart", line, "2.1 图的格式说明",
+                                   "图片占页面宽度应该在 [0%, 100%] 间: Word样式列表")]
+        assert paper.diagnostics == diags
+        assert paper.doc.pending != []
+        paper.compile()  # 保存按章缓存
+
+        # 再次读取时各段都使用缓存中编译好的结果，警告应该相同
+        paper, cached = load_md(md_path)
+        assert paper.doc.pending == []
+        assert summary(cached) == summary(diags)
+
+
+def test_error():
+    md = read_example()
+    try:
+        load(md, "Word 样式列表; 70%", "Word 样式列表; 70%; 80%")
+    except PaperError as e:
+        assert e.diagnostic.level == "error"
+        assert e.diagnostic.section == "2.1 图的格式说明"
+        assert "图、表的标题格式错误" in e.diagnostic.message
+    else:
+        assert False, "should raise PaperError"
+
+
+def test_formula_error():
+    # latex2mathml不转义&，公式在转换时才出错
+    md = read_example().replace("行内公式$\\sum", "行内公式$a & \\sum", 1)
+    with tempfile.TemporaryDirectory() as tmp:
+        paper, _ = load_md(copy_example(tmp, md))
+        try:
+            paper.compile()
+        except PaperError as e:
+            assert e.diagnostic.part == "MainPart"
+            assert e.diagnostic.section == "2.3 公式的格式说明"
+            assert e.diagnostic.line == md.split("\n").index("## 2.3 公式的格式说明") + 1
+            assert "a & \\sum" in e.diagnostic.message
+        else:
+            assert False, "should raise PaperError"
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+    test_warning()
+    test_error()
+    test_formula_error()
+    print("ok")
@@ -0,0 +1,46 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import logging
+import tempfile
+import threading
+import md2paper.md2paper as md2paper
+from md2paper.md2paper import FormulaCache
+
+# 同一进程中的多个线程同时写入同一条缓存
+
+
+class Counter(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.warnings = 0
+
+    def emit(self, record):
+        if record.levelno >= logging.WARNING:
+            self.warnings += 1
+
+
+def test_concurrent_write():
+    values = ["<m:oMath>{}</m:oMath>".format(i) * 1000 for i in range(8)]
+    counter = Counter()
+    logging.getLogger().addHandler(counter)
+    try:
+        for _ in range(5):
+            threads = [threading.Thread(target=FormulaCache.put, args=("x", "xslt", "1", v))
+                       for v in values]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+    finally:
+        logging.getLogger().removeHandler(counter)
+    assert counter.warnings == 0
+    assert FormulaCache.get("x", "xslt", "1") in values
+    path = FormulaCache.get_path("x", "xslt", "1")
+    assert os.listdir(os.path.dirname(path)) == [os.path.basename(path)]
+
+
+if __name__ == "__main__":
+    md2paper.CACHE_DIR = tempfile.mkdtemp()
+    test_concurrent_write()
+    print("ok")
@@ -0,0 +1,39 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import logging
+import tempfile
+from md2paper import GraduationPaper
+from conftest import copy_example, read_example
+
+# 按一级标题划分论文的各部分
+
+
+def load(md: str):
+    with tempfile.TemporaryDirectory() as tmp:
+        paper = GraduationPaper()
+        paper.load_md(copy_example(tmp, md))
+        return paper, paper.load_contents()
+
+
+def test_h1_exact():
+    paper, diags = load(read_example())
+    assert diags == []
+    assert paper.doc.find_h1("结论") == paper.doc.h1_index["结论"]
+    assert paper.doc.find_h1("不存在的标题") == None
+
+
+def test_h1_prefix():
+    # 一级标题只需以规定的标题开头，不符合时给出警告
+    paper, diags = load(read_example().replace("结论\n===", "结论与展望\n===", 1))
+    assert [i.message for i in diags] == ["结论部分的标题应该是结论/设计总结: 结论与展望"]
+    assert "结论" not in paper.doc.h1_index
+    assert paper.doc.find_h1("结论") == paper.doc.h1_index["结论与展望"]
+    assert paper.conc.contents != []
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+    test_h1_exact()
+    test_h1_prefix()
+    print("ok")
@@ -0,0 +1,85 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import logging
+import tempfile
+from md2paper import GraduationPaper
+from md2paper.md2paper import DocContext
+from md2paper.md_paper import Paper, Paragraph, get_manifest_path
+from conftest import TEMPLATE, copy_example, document_xml, read_example
+
+# 增量渲染的结果应与全部重新渲染相同（图片的id、名称除外）
+
+
+def render(md_path: str, out: str, incremental: bool, build=False):
+    # 返回论文、_rerender的结果（没有调用时为None）和重新渲染的各章
+    paper = GraduationPaper()
+    paper.load_md(md_path)
+    paper.load_contents()
+    paper.compile()
+    results = []
+    rerendered = []
+    _rerender = Paper._rerender
+    rerender = DocContext.rerender
+
+    def spy_rerender(self, out, base):
+        results.append(_rerender(self, out, base))
+        return results[-1]
+
+    def spy(self, elements, block):
+        rerendered.append(block)
+        return rerender(self, elements, block)
+
+    Paper._rerender = spy_rerender
+    DocContext.rerender = spy
+    try:
+        paper.render(TEMPLATE, out, build=build, incremental=incremental)
+    finally:
+        Paper._rerender = _rerender
+        DocContext.rerender = rerender
+    return paper, results[0] if results else None, rerendered
+
+
+def find_unit(paper: GraduationPaper, text: str):
+    # 包含text所在段落的章
+    for part in paper.parts:
+        for block, conts, start, end in part.units:
+            for i in conts[start:end]:
+                if isinstance(i, Paragraph) and text in "".join(r.text for r in i.runs):
+                    return block
+
+
+def check(build: bool):
+    with tempfile.TemporaryDirectory() as tmp:
+        md = read_example()
+        md_path = copy_example(tmp, md)
+        out = os.path.join(tmp, "论文.docx")
+        _, incremental, _ = render(md_path, out, True, build)
+        assert incremental == False  # 还没有清单
+        assert os.path.exists(get_manifest_path(out))
+
+        # 只改动第二章，只重新渲染第二章
+        with open(md_path, "w") as f:
+            f.write(md.replace("也可以添加图、表、公式。", "也可以添加图、表、公式！", 1))
+        paper, incremental, rerendered = render(md_path, out, True, build)
+        assert incremental == True
+        assert rerendered == [find_unit(paper, "也可以添加图、表、公式！")]
+        assert rerendered[0] != None and len(paper._get_units()) > 1
+        full = os.path.join(tmp, "full.docx")
+        render(md_path, full, False, build)
+        assert document_xml(out) == document_xml(full)
+
+
+def test_incremental_render():
+    check(False)
+
+
+def test_incremental_build():
+    check(True)
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+    test_incremental_render()
+    test_incremental_build()
+    print("ok")
@@ -0,0 +1,88 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import gzip
+import json
+import logging
+import re
+import tempfile
+from md2paper import GraduationPaper, TranslationPaper, PaperError
+import md2paper.md2paper as md2paper
+from md2paper.md_paper import Image
+from conftest import TEMPLATE, copy_example, document_xml
+
+# 保存、读取中间表示后生成的文档与直接生成的相同
+
+
+def images(paper: GraduationPaper):
+    return [os.path.normpath(i.src) for part in paper.parts
+            for conts in part._get_content_lists() for i in conts
+            if isinstance(i, Image)]
+
+
+def read_ir(path: str) -> dict:
+    with open(path, "rb") as f:
+        raw = f.read()
+    if path.endswith(".gz"):
+        assert raw[:2] == b"\x1f\x8b"
+        raw = gzip.decompress(raw)
+    return json.loads(raw.decode("utf-8"))
+
+
+def expect_error(paper, path: str, message: str):
+    try:
+        paper.load_ir(path)
+    except PaperError as e:
+        assert message in e.diagnostic.message
+    else:
+        assert False, "should raise PaperError"
+
+
+def test_ir_round_trip():
+    with tempfile.TemporaryDirectory() as tmp:
+        paper_dir = os.path.join(tmp, "paper")
+        os.makedirs(paper_dir)
+        md_path = copy_example(paper_dir)
+
+        paper = GraduationPaper()
+        paper.load_md(md_path)
+        paper.load_contents()
+        paper.compile()
+        direct = os.path.join(tmp, "direct.docx")
+        paper.render(TEMPLATE, direct)
+        assert images(paper) != []
+
+        # 中间表示放在另一个目录中，图片的路径相对于中间表示所在的目录保存
+        ir_dir = os.path.join(tmp, "ir")
+        os.makedirs(ir_dir)
+        for ext in [".ir.json", ".ir.json.gz"]:
+            ir_path = os.path.join(ir_dir, "论文" + ext)
+            paper.save_ir(ir_path)
+            srcs = re.findall(r'"src":"([^"]*)"', json.dumps(read_ir(ir_path),
+                                                            ensure_ascii=False,
+                                                            separators=(",", ":")))
+            assert srcs != [] and all(i.startswith("../paper/image/") for i in srcs)
+
+            loaded = GraduationPaper()
+            loaded.load_ir(ir_path)
+            assert images(loaded) == images(paper)
+            out = os.path.join(ir_dir, "论文.docx")
+            loaded.render(TEMPLATE, out)
+            assert document_xml(out) == document_xml(direct)
+
+        # 版本或论文类型不符时拒绝读取
+        ir_path = os.path.join(ir_dir, "论文.ir.json")
+        expect_error(TranslationPaper(), ir_path, "中间表示不是TranslationPaper")
+        ir = read_ir(ir_path)
+        ir["version"] += 1
+        bad_path = os.path.join(ir_dir, "bad.ir.json")
+        with open(bad_path, "w") as f:
+            json.dump(ir, f)
+        expect_error(GraduationPaper(), bad_path, "不支持的中间表示版本")
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+    md2paper.CACHE_DIR = tempfile.mkdtemp()
+    test_ir_round_trip()
+    print("ok")
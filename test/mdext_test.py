@@ -0,0 +1,55 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import logging
+import tempfile
+from md2paper import GraduationPaper, PaperError
+from md2paper.md_paper import Paragraph
+from conftest import copy_example, read_example
+
+# 段落中的HTML：<br>分段，其他不支持的HTML报错
+
+TEXT = "也可以添加图、表、公式。"
+
+
+def load(to: str) -> GraduationPaper:
+    with tempfile.TemporaryDirectory() as tmp:
+        paper = GraduationPaper()
+        paper.load_md(copy_example(tmp, read_example().replace(TEXT, to, 1)))
+        paper.load_contents()
+        return paper
+
+
+def texts(paper: GraduationPaper):
+    return ["".join(r.text for r in i.runs) for i in paper.main.contents
+            if isinstance(i, Paragraph)]
+
+
+def test_br():
+    for br in ["<br>", "<br/>", "<br />"]:
+        ps = texts(load("也可以" + br + "添加图、表、公式。"))
+        i = ps.index("也可以")
+        assert ps[i + 1] == "添加图、表、公式。"
+
+
+def test_unsupported():
+    try:
+        load("也可以添加<sup>2</sup>公式。")
+    except PaperError as e:
+        assert e.diagnostic.section == "1.2 章节标题格式"
+        assert e.diagnostic.message == "不支持的HTML: <sup>"
+    else:
+        assert False, "should raise PaperError"
+
+
+def test_entity_and_comment():
+    ps = texts(load("也可以&lt;添加<!-- 注释 -->图、表、公式。"))
+    assert "也可以<添加图、表、公式。" in ps
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+    test_br()
+    test_unsupported()
+    test_entity_and_comment()
+    print("ok")
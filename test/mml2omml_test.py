@@ -0,0 +1,229 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lxml import etree
+import latex2mathml.converter
+from md2paper.md2paper import get_mml2omml
+from md2paper.mml2omml import mathml_to_omml, MathMLNotSupported
+
+# 原生转换器的输出必须与mml2omml.xsl逐字节一致
+
+LATEX = [
+    r"x",
+    r"ab",
+    r"x+1",
+    r"12.5",
+    r"-3",
+    r"\alpha",
+    r"x_i",
+    r"x^2",
+    r"x_i^2",
+    r"\frac{a}{b}",
+    r"\frac12",
+    r"\binom{a}{b}",
+    r"\sqrt{x}",
+    r"\sqrt[3]{x}",
+    r"\sqrt[n]{x+1}",
+    r"\sin x",
+    r"\sin(x)",
+    r"\log_2 n",
+    r"\det A",
+    r"\exp x",
+    r"\operatorname{foo}",
+    r"\sum_{i=1}^n i",
+    r"\int_0^1 f",
+    r"\prod_{i=1}^{n} x_i",
+    r"\iint x",
+    r"\int\limits_0^1 x dx",
+    r"\sum_{i=0}^{N} (x_i + y_i)",
+    r"\lim_{x\to0} x",
+    r"\max_i a",
+    r"\min_{x} f(x)",
+    r"\mathrm{d}x",
+    r"\mathrm{abc}",
+    r"\mathbf{v}",
+    r"\mathbb{R}",
+    r"\mathcal{S}",
+    r"\mathit{ab}",
+    r"\mathsf{a}",
+    r"\textbf{a}",
+    r"\text{abc}",
+    r"\text{if } x > 0",
+    r"\left( x \right)",
+    r"\left[ x \right]",
+    r"\left. x \right|",
+    r"(x)",
+    r"f(x)",
+    r"\|x\|",
+    r"\{a\}",
+    r"|x|",
+    r"\hat{x}",
+    r"\bar{x}",
+    r"\vec{x}",
+    r"\dot{x}",
+    r"\ddot{x}",
+    r"\tilde{x}",
+    r"\overline{ab}",
+    r"\underline{x}",
+    r"\overbrace{ab}",
+    r"\underbrace{ab}",
+    r"\overset{a}{b}",
+    r"\underset{a}{b}",
+    r"\stackrel{a}{=}",
+    r"a\,b",
+    r"a\quad b",
+    r"a\;b",
+    r"a\ b",
+    r"a/b",
+    r"x/2",
+    r"(a+b)/c",
+    r"\infty",
+    r"\cdots",
+    r"\ldots",
+    r"\nabla f",
+    r"\hbar",
+    r"\partial x",
+    r"\neq",
+    r"\not=",
+    r"\le",
+    r"a \leq b",
+    r"a \in A",
+    r"A \subseteq B",
+    r"x'",
+    r"f''(x)",
+    r"x_{i,j}",
+    r"{}^{a}x",
+    r"x^{2n+1}",
+    r"e^{-x^2}",
+    r"\pmod{n}",
+    r"a \bmod b",
+    r"E = mc^2",
+    r"a^2 + b^2 = c^2",
+    r"\frac{-b \pm \sqrt{b^2-4ac}}{2a}",
+    r"\sum_{k=1}^{\infty} \frac{1}{k^2} = \frac{\pi^2}{6}",
+    r"\int_{-\infty}^{\infty} e^{-x^2} dx = \sqrt{\pi}",
+    r"\mathscr{L}",
+    r"\mathfrak{g}",
+    r"\boldsymbol{\alpha}",
+    r"\alpha \beta \gamma",
+    r"\Gamma(n) = (n-1)!",
+    r"P(A|B) = \frac{P(B|A)P(A)}{P(B)}",
+    r"\forall x \exists y",
+    r"\cos^2\theta + \sin^2\theta = 1",
+    r"\sqrt{\frac{a}{b}}",
+    r"x_1, x_2, \dots, x_n",
+    r"\overrightarrow{AB}",
+    r"\widehat{xy}",
+    r"\bigcup_{i} A_i",
+    r"\bigcap_{i=1}^n A_i",
+    r"\oint_C f",
+    r"\lVert x \rVert",
+    r"\langle x, y \rangle",
+    r"\lfloor x \rfloor",
+    r"\mathrm{sin}",
+    r"123abc",
+    r"3.14\pi",
+    r"\arg\max_x f(x)",
+    r"\frac{\partial f}{\partial x}",
+    r"\nabla \cdot \vec{E} = \frac{\rho}{\varepsilon_0}",
+    r"\sum_{i=1}^{n}{i}",
+    r"\int x\,dx",
+    r"\sum i",
+    r"\int",
+    r"\mathcal{O}(n\log n)",
+    r"10^{-3}",
+    r"1{,}000",
+]
+
+# 样式表的各个分支
+MATHML = [
+    '<mrow><mi>sin</mi><mo>&#x2061;</mo><mi>x</mi></mrow>',
+    '<mrow><mrow><mi>a</mi><mi>b</mi></mrow><mo>/</mo><mn>2</mn></mrow>',
+    '<mfrac linethickness="0px"><mi>a</mi><mi>b</mi></mfrac>',
+    '<mfrac linethickness="2PX"><mi>a</mi><mi>b</mi></mfrac>',
+    '<mfrac linethickness="0.9"><mi>a</mi><mi>b</mi></mfrac>',
+    '<mfrac bevelled="true"><mi>a</mi><mi>b</mi></mfrac>',
+    '<mfrac linethickness="THIN"><mi>a</mi><mi>b</mi></mfrac>',
+    '<mover accent="false"><mrow><mi>a</mi><mi>b</mi></mrow><mo>&#x23DE;</mo></mover>',
+    '<munder accentunder="false"><mrow><mi>a</mi><mi>b</mi></mrow><mo>&#x23DF;</mo></munder>',
+    '<munder accentunder="false"><mo>&#x23DF;</mo><mrow><mi>a</mi></mrow></munder>',
+    '<mover accent="false"><mo>&#x23DE;</mo><mrow><mi>a</mi></mrow></mover>',
+    '<munder><mi>x</mi><mo>_</mo></munder>',
+    '<munder><mi>x</mi><mo>&#x332;</mo></munder>',
+    '<munder accentunder="TRUE"><mi>x</mi><mo>_</mo></munder>',
+    '<mover><mi>x</mi><mo>&#x305;</mo></mover>',
+    '<mover accent="true"><mi>x</mi><mo>~</mo></mover>',
+    '<mover accent="true"><mi>x</mi><mo>ab</mo></mover>',
+    '<mover accent="true"><mi>x</mi><mi>a</mi></mover>',
+    '<mover><mi>x</mi><mo accent="false">.</mo></mover>',
+    '<mover accent="true"><mi>x</mi><mo accent="false">.</mo></mover>',
+    '<mover><mi>x</mi><mo accent="true">&#x2190;</mo></mover>',
+    '<msubsup><mo stretchy="false">&#x222B;</mo><mn>0</mn><mn>1</mn></msubsup><mi>x</mi>',
+    '<msub><mo stretchy="TRUE">&#x2210;</mo><mn>0</mn></msub><mrow><mi>x</mi><mo>/</mo><mi>y</mi></mrow>',
+    '<msup><mrow><mo>&#x2211;</mo></mrow><mn>0</mn></msup><mrow><mi>x</mi></mrow><mrow><mi>y</mi></mrow>',
+    '<munder accentunder="true"><mo>&#x2211;</mo><mn>0</mn></munder><mrow><mi>x</mi></mrow>',
+    '<mover accent="true"><mo>&#x2211;</mo><mn>0</mn></mover><mrow><mi>x</mi></mrow>',
+    '<msub><mrow><mo>&#x2211;</mo><mi>a</mi></mrow><mn>0</mn></msub>',
+    '<msub><mo>&#x2211;</mo><mn>0</mn></msub><mrow><mi>sin</mi><mo>&#x2061;</mo><mi>x</mi></mrow>',
+    '<mi mathvariant="bold">a</mi><mi mathvariant="bold">b</mi><mi>c</mi>',
+    '<mi mathvariant="bold-italic">a</mi><mi mathvariant="bold-italic">b</mi>',
+    '<mi mathvariant="normal">a</mi><mi>ab</mi><mn>x1</mn><mn>2</mn>',
+    '<mi mathvariant="italic">a</mi><mn>2</mn><mo>+</mo><mi>ab</mi>',
+    '<mi mathvariant="monospace">a</mi><mi mathvariant="weird">b</mi>',
+    '<mtext>a  b </mtext><mtext mathvariant="bold">c</mtext><mtext>d</mtext><mi>x</mi>',
+    '<mtext mathvariant="italic">a</mtext>',
+    '<mi mathvariant="sans-serif-bold-italic">a</mi><mi mathvariant="bold-fraktur">a</mi><mi mathvariant="bold-script">a</mi><mi mathvariant="sans-serif-italic">a</mi><mi mathvariant="bold-sans-serif">a</mi>',
+    '<mn> 12 </mn><mn>1.</mn><mn>.5</mn><mn>-2</mn><mn>1e3</mn><mn>&#x0663;</mn>',
+    '<mi></mi><mo>&#x2062;</mo><mi>x</mi><mo>&#x2A75;</mo>',
+    '<mi mathcolor="red">x</mi><mi mathsize="big">y</mi>',
+    '<msqrt><mi>x</mi><mi>y</mi><mfrac><mi>a</mi><mi>b</mi></mfrac></msqrt>',
+    '<mroot><mi>x</mi><mn>3</mn></mroot>',
+    '<munderover><mi>x</mi><mi>a</mi><mi>b</mi></munderover>',
+    '<munderover><mo>&#x222B;</mo><mi>a</mi><mi>b</mi></munderover><mrow><mi>f</mi></mrow>',
+    '<mi fontweight="bold">x</mi>',
+    '<mstyle><mi>x</mi></mstyle>',
+    '<mfrac><mi>a</mi></mfrac>',
+    '<ms>x</ms>',
+]
+
+# 原生转换器未实现的结构
+UNSUPPORTED = [
+    r"\dfrac{a}{b}",
+    r"\tfrac{a}{b}",
+    r"\sum\limits_{i} a_i",
+    r"\lim\limits_{x} f",
+    r"\phantom{x}",
+    r"\displaystyle \sum_i x",
+    r"\color{red}x",
+    r"\boxed{x}",
+    r"\begin{matrix}a&b\\c&d\end{matrix}",
+    r"\begin{pmatrix}1&0\\0&1\end{pmatrix}",
+    r"\begin{cases}x & x>0\\0 & x\le0\end{cases}",
+]
+
+
+def compare(mathml: str) -> bool:
+    # 返回原生转换器是否支持该公式
+    tree = etree.fromstring(mathml)
+    expected = etree.tostring(get_mml2omml()(tree).getroot(), encoding="unicode")
+    try:
+        omml = mathml_to_omml(tree)
+    except MathMLNotSupported:
+        return False
+    assert etree.tostring(omml, encoding="unicode") == expected, mathml
+    return True
+
+
+def test_native_matches_xslt():
+    for latex in LATEX:
+        assert compare(latex2mathml.converter.convert(latex)), latex
+    for latex in UNSUPPORTED:
+        assert not compare(latex2mathml.converter.convert(latex)), latex
+    for mathml in MATHML:
+        compare('<math xmlns="http://www.w3.org/1998/Math/MathML"><mrow>{}</mrow></math>'
+                .format(mathml))
+
+
+if __name__ == "__main__":
+    test_native_matches_xslt()
+    print("ok")
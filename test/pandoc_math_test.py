@@ -0,0 +1,55 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import zipfile
+from io import BytesIO
+from lxml import etree
+from md2paper.md_paper import omml_from_docx
+
+# 从pandoc生成的docx中取出各段的公式
+
+W = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+M = "http://schemas.openxmlformats.org/officeDocument/2006/math"
+
+DOCUMENT = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<w:document xmlns:w="{w}" xmlns:m="{m}"
+  xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">
+<w:body>
+<w:p><m:oMathPara><m:oMathParaPr><m:jc m:val="center"/></m:oMathParaPr>
+<m:oMath><m:r><m:t>x</m:t></m:r></m:oMath></m:oMathPara></w:p>
+<w:p><w:r><w:t>没有公式</w:t></w:r></w:p>
+<w:p><m:oMath><m:sSup><m:e><m:r><w:rPr><w:rFonts w:ascii="Cambria Math"/></w:rPr><m:t>y</m:t></m:r></m:e><m:sup><m:r><m:t>2</m:t></m:r></m:sup></m:sSup></m:oMath></w:p>
+<w:tbl><w:tr><w:tc><w:p><m:oMath><m:r><m:t>z</m:t></m:r></m:oMath></w:p></w:tc></w:tr></w:tbl>
+<w:p><w:r><w:t>a</w:t></w:r><m:oMath><m:r><m:t>b</m:t></m:r></m:oMath></w:p>
+<w:sectPr/>
+</w:body>
+</w:document>""".format(w=W, m=M)
+
+
+def make_docx() -> bytes:
+    out = BytesIO()
+    with zipfile.ZipFile(out, "w") as z:
+        z.writestr("[Content_Types].xml", "<Types/>")
+        z.writestr("word/document.xml", DOCUMENT)
+    return out.getvalue()
+
+
+def test_omml_from_docx():
+    maths = omml_from_docx(make_docx())
+    # 只取正文中的段落，表格中的不算
+    assert [i != None for i in maths] == [True, False, True, True]
+    texts = []
+    for s in filter(None, maths):
+        oMath = etree.fromstring(s)
+        assert oMath.tag == "{%s}oMath" % M
+        # 单独解析时命名空间完整，且不带多余的声明
+        assert set(oMath.nsmap.values()) <= {W, M}
+        texts.append("".join(oMath.itertext()))
+    assert texts == ["x", "y2", "b"]
+    assert maths[2].count("xmlns:w=") == 1
+    assert "xmlns:r=" not in maths[0] and "xmlns:w=" not in maths[0]
+
+
+if __name__ == "__main__":
+    test_omml_from_docx()
+    print("ok")
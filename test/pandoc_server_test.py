@@ -0,0 +1,186 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import json
+import logging
+import socket
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from md2paper import GraduationPaper
+import md2paper.md2paper as md2paper
+import md2paper.md_paper as md_paper
+from md2paper.pandoc_server import PandocServer
+from conftest import copy_example
+
+# 用本地的HTTP服务代替pandoc server
+
+
+class StandIn(ThreadingHTTPServer):
+    # 挂在/pandoc下，GET /pandoc/version返回版本，POST /pandoc/原样返回text
+    daemon_threads = True
+
+    def __init__(self, delay: float = 0, close_after: bool = False, status: int = 200):
+        self.delay = delay
+        self.close_after = close_after  # 回复后关闭连接，但不告知客户端
+        self.status = status
+        self.connections = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+        super().__init__(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self) -> str:
+        return "http://127.0.0.1:{}/pandoc".format(self.server_address[1])
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status: int, data: bytes):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        if self.server.close_after:
+            self.close_connection = True
+
+    def do_GET(self):
+        if self.path != "/pandoc/version":
+            return self.reply(404, b"not found")
+        self.reply(200, b'"3.1"')
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        with self.server.lock:
+            self.server.in_flight += 1
+            self.server.max_in_flight = max(self.server.max_in_flight,
+                                            self.server.in_flight)
+        time.sleep(self.server.delay)
+        with self.server.lock:
+            self.server.in_flight -= 1
+        if self.path != "/pandoc" or self.server.status != 200:
+            return self.reply(self.server.status if self.path == "/pandoc" else 404,
+                              b"error")
+        self.reply(200, json.loads(body)["text"].encode("utf-8"))
+
+
+def unused_url() -> str:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return "http://127.0.0.1:{}".format(s.getsockname()[1])
+
+
+def test_convert():
+    server = StandIn()
+    try:
+        client = PandocServer(server.url)
+        assert client.get_version() == "3.1"
+        for i in range(3):
+            assert client.convert("x{}".format(i), "markdown", "docx") == \
+                "x{}".format(i).encode()
+        # 各次请求复用同一个keep-alive连接
+        assert server.connections == 1
+        client.close()
+    finally:
+        server.stop()
+
+
+def test_in_flight_limit():
+    server = StandIn(delay=0.1)
+    try:
+        client = PandocServer(server.url, pool_size=2, max_in_flight=2)
+        threads = [threading.Thread(target=client.convert, args=("x", "markdown", "docx"))
+                   for _ in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert server.max_in_flight == 2
+        client.close()
+    finally:
+        server.stop()
+
+
+def test_stale_connection():
+    # 连接池中的连接已被服务端关闭时用新连接重试
+    server = StandIn(close_after=True)
+    try:
+        client = PandocServer(server.url)
+        assert client.convert("a", "markdown", "docx") == b"a"
+        time.sleep(0.1)
+        assert client.convert("b", "markdown", "docx") == b"b"
+        assert server.connections == 2
+        client.close()
+    finally:
+        server.stop()
+
+
+def compile_example(md_path: str) -> GraduationPaper:
+    paper = GraduationPaper()
+    paper.load_md(md_path)
+    paper.load_contents()
+    paper.compile()
+    return paper
+
+
+def check_fallback(url: str, backend: str):
+    # 公式改用XSLT转换，且不以pandoc server的名义保存按章缓存
+    md_paper.use_pandoc_server(url)
+    try:
+        assert md_paper.get_formula_backend().startswith(backend)
+        with tempfile.TemporaryDirectory() as tmp:
+            md_path = copy_example(tmp)
+            paper = compile_example(md_path)
+            maths = paper.main.get_math_items()
+            assert maths != [] and all(not i.need_trans for i in maths)
+            paper = GraduationPaper()
+            paper.load_md(md_path)
+            paper.load_contents()
+            return paper.doc.pending
+    finally:
+        md_paper.pandoc_server.close()
+        md_paper.pandoc_server = None
+        md_paper.get_formula_backend.cache_clear()
+
+
+def test_unavailable():
+    client = PandocServer(unused_url())
+    assert client.get_version() == None
+    # 服务不可用时按XSLT后端编译、缓存
+    assert check_fallback(unused_url(), "xslt") == []
+
+
+def test_convert_error():
+    # 版本检查成功，但转换失败
+    server = StandIn(status=500)
+    try:
+        assert check_fallback(server.url, "pandoc-server 3.1") != []
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+    md2paper.CACHE_DIR = tempfile.mkdtemp()
+    test_convert()
+    test_in_flight_limit()
+    test_stale_connection()
+    test_unavailable()
+    test_convert_error()
+    print("ok")
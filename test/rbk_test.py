@@ -0,0 +1,79 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import random
+import re
+from md2paper.md_paper import rbk
+
+# 与原先逐个replace的实现对比
+
+
+def rbk_old(text: str):
+    text = text.replace("\n", " ")
+    text = text.replace("\r", "")
+    text = text.strip(' ')
+
+    cn_char = u'[\u4e00-\u9fa5。，：《》、（）“”‘’\u00a0]'
+    should_replace_list = re.compile(
+        cn_char + u' +').findall(text)
+    should_replace_list += re.compile(
+        u' +' + cn_char).findall(text)
+    for i in should_replace_list:
+        if i == u' ':
+            continue
+        new_i = i.strip(" ")
+        text = text.replace(i, new_i)
+    text = text.replace("\u00a0", " ")
+    return text
+
+
+def rbk_old_fixpoint(text: str):
+    # 旧实现的replace会作用于所有相同的子串，同一字符后有长短不一的空格时
+    # 只删掉较长空格的一部分，反复执行直到不变即为应有的结果
+    while True:
+        new_text = rbk_old(text)
+        if new_text == text:
+            return text
+        text = new_text
+
+
+CHARS = ["a", "Z", "1", ".", ",", "中", "文", "。", "，", "：", "《", "》", "、",
+         "（", "）", "“", "”", "‘", "’", "$", "\n", "\r", "\u00a0", " ", "  "]
+
+
+def random_text(rng: random.Random, chars) -> str:
+    return "".join(rng.choice(chars) for _ in range(rng.randint(0, 30)))
+
+
+def test_rbk_matches_old():
+    rng = random.Random(0)
+    checked = 0
+    while checked < 20000:
+        text = random_text(rng, CHARS + [" "])
+        # 没有连续空格时旧实现的结果是确定的
+        if "  " in text.replace("\n", " ").replace("\r", ""):
+            continue
+        assert rbk(text) == rbk_old(text), repr(text)
+        checked += 1
+
+
+def test_rbk_removes_all_blanks():
+    rng = random.Random(1)
+    for _ in range(20000):
+        # 不含\u00a0，否则替换后的空格会在下一轮参与删除
+        text = random_text(rng, CHARS[:-3] + CHARS[-2:])
+        assert rbk(text) == rbk_old_fixpoint(text), repr(text)
+
+
+def test_rbk_examples():
+    assert rbk(" 中文 abc 中文 \n") == "中文abc中文"
+    assert rbk("a\u00a0 b") == "a b"
+    assert rbk("x  y") == "x  y"
+    assert rbk("中  x 中 y") == rbk_old_fixpoint("中  x 中 y") == "中x中y"
+
+
+if __name__ == "__main__":
+    test_rbk_matches_old()
+    test_rbk_removes_all_blanks()
+    test_rbk_examples()
+    print("ok")
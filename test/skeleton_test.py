@@ -0,0 +1,71 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import logging
+import tempfile
+import threading
+from md2paper import GraduationPaper
+import md2paper.md2paper as md2paper
+from md2paper.md2paper import DocContext, TemplateSkeleton
+from md2paper.dut_paper import PLACEHOLDERS
+from conftest import TEMPLATE, copy_example, document_xml
+
+# 模板骨架中预先删去示例内容，渲染结果与渲染时再删相同
+
+
+class UnstrippedPaper(GraduationPaper):
+    placeholders = []
+
+
+def test_placeholders_stripped():
+    ctx = DocContext()
+    ctx.load_template(TEMPLATE, placeholders=PLACEHOLDERS)
+    for anchor_text, anchor_style_name, keep, keyword, _ in PLACEHOLDERS:
+        offset = ctx.get_anchor_position(anchor_text, anchor_style_name)
+        # 渲染时不再有可删的段落
+        assert ctx.delete_paragraphs_until(offset, keyword, keep) == 0
+
+
+def test_render_same():
+    with tempfile.TemporaryDirectory() as tmp:
+        md_path = copy_example(tmp)
+        outs = []
+        for paper_class in [GraduationPaper, UnstrippedPaper, GraduationPaper]:
+            paper = paper_class()
+            paper.load_md(md_path)
+            paper.load_contents()
+            paper.compile()
+            outs.append(os.path.join(tmp, "{}.docx".format(len(outs))))
+            paper.render(TEMPLATE, outs[-1])
+        # 第三次使用内存中缓存的骨架
+        assert document_xml(outs[0]) == document_xml(outs[1]) == document_xml(outs[2])
+
+
+def test_concurrent_dump():
+    # 同一进程中的多个线程同时保存同一骨架
+    key = TemplateSkeleton.get_key(b"template")
+    skeleton = TemplateSkeleton(b"skeleton" * 100000, [("引    言", "Heading 1")], [], [])
+    failed = []
+    logging.getLogger().addFilter(lambda record: failed.append(record) or True)
+    try:
+        threads = [threading.Thread(target=skeleton.dump, args=(key,)) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        logging.getLogger().filters.clear()
+    assert [i for i in failed if i.levelno >= logging.WARNING] == []
+    files = os.listdir(os.path.join(md2paper.CACHE_DIR, "templates"))
+    assert key + ".docx" in files and key + ".json" in files
+    assert [i for i in files if i.endswith(".tmp")] == []
+    assert TemplateSkeleton.load(key).data == skeleton.data
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+    md2paper.CACHE_DIR = tempfile.mkdtemp()
+    test_placeholders_stripped()
+    test_render_same()
+    test_concurrent_dump()
+    print("ok")
@@ -0,0 +1,50 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import tempfile
+import threading
+import time
+from md2paper.watch import FileWatcher
+
+
+def write_later(path: str, times: int, delay: float):
+    for i in range(times):
+        time.sleep(delay)
+        with open(path, "w") as f:
+            f.write("x" * (i + 1))
+
+
+def test_watch_debounce():
+    with tempfile.TemporaryDirectory() as tmp:
+        a = os.path.join(tmp, "a.md")
+        b = os.path.join(tmp, "b.png")  # 还不存在的文件
+        with open(a, "w") as f:
+            f.write("")
+        watcher = FileWatcher(interval=0.02, debounce=0.2)
+        watcher.set_files([a, b])
+
+        # 连续的多次写入只返回一次
+        thread = threading.Thread(target=write_later, args=(a, 4, 0.05))
+        thread.start()
+        start = time.monotonic()
+        assert watcher.wait() == [a]
+        thread.join()
+        assert time.monotonic() - start >= 0.35
+
+        # 新出现的文件也算改动
+        thread = threading.Thread(target=write_later, args=(b, 1, 0.05))
+        thread.start()
+        assert watcher.wait() == [b]
+        thread.join()
+
+        # 重新设置时已监视的文件保留原来的状态
+        watcher.set_files([a])
+        thread = threading.Thread(target=write_later, args=(a, 1, 0.05))
+        thread.start()
+        assert watcher.wait() == [a]
+        thread.join()
+
+
+if __name__ == "__main__":
+    test_watch_debounce()
+    print("ok")